@@ -825,6 +825,23 @@ CREATE TABLE `category_override` (
   CONSTRAINT `category_override_category_id_ibfk` FOREIGN KEY (`category_id`) REFERENCES `notification_category` (`id`) ON DELETE CASCADE ON UPDATE CASCADE,
   CONSTRAINT `category_override_mode_id_ibfk` FOREIGN KEY (`mode_id`) REFERENCES `mode` (`id`)
 ) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+DROP TABLE IF EXISTS `sender_checkpoint`;
+CREATE TABLE `sender_checkpoint` (
+  `name` VARCHAR(255) NOT NULL,
+  `state` MEDIUMTEXT NOT NULL,
+  `updated` DATETIME NOT NULL,
+  PRIMARY KEY (`name`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
+
+DROP TABLE IF EXISTS `sender_heartbeat`;
+CREATE TABLE `sender_heartbeat` (
+  `address` VARCHAR(255) NOT NULL,
+  `connection_id` BIGINT(20) UNSIGNED NOT NULL,
+  `updated` DATETIME(6) NOT NULL,
+  PRIMARY KEY (`address`),
+  KEY `ix_sender_heartbeat_connection_id` (`connection_id`)
+) ENGINE=InnoDB DEFAULT CHARSET=latin1;
 /*!40101 SET character_set_client = @saved_cs_client */;
 /*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
 
@@ -35,7 +35,7 @@ from . import ui
 from . import app_stats
 from .config import load_config
 from iris.vendors.iris_slack import iris_slack
-from iris.sender import auditlog
+from iris.sender import auditlog, wakeup
 from iris.sender.quota import (get_application_quotas_query, insert_application_quota_query,
                                required_quota_keys, quota_int_keys)
 
@@ -1734,6 +1734,7 @@ class Incidents(object):
                 else:
                     break
 
+        wakeup.notify_incident_created(incident_id)
         resp.status = HTTP_201
         resp.set_header('Location', '/incidents/%s' % incident_id)
         resp.body = ujson.dumps(incident_id)
@@ -2176,7 +2177,7 @@ class Notifications(object):
     allow_read_no_auth = False
     required_attrs = frozenset(['target', 'role', 'subject'])
 
-    def __init__(self, zk_hosts, default_sender_addr, timeout):
+    def __init__(self, zk_hosts, default_sender_addr, timeout, mysql_coordinator=None):
         self.default_sender_addr = default_sender_addr
         self.timeout = timeout
         if zk_hosts:
@@ -2185,6 +2186,16 @@ class Notifications(object):
                                            hostname=None,
                                            port=None,
                                            join_cluster=False)
+        elif mysql_coordinator:
+            from iris.coordinator.mysql import Coordinator
+            if not isinstance(mysql_coordinator, dict):
+                mysql_coordinator = {}
+            self.coordinator = Coordinator(db=db,
+                                           hostname=None,
+                                           port=None,
+                                           join_cluster=False,
+                                           lock_name=mysql_coordinator.get('lock_name', 'iris_sender_leader'),
+                                           failover_timeout=mysql_coordinator.get('failover_timeout_ms', 2000) / 1000.0)
         else:
             logger.info('Not using ZK to get senders. Using host %s for leader instead.', default_sender_addr)
             self.coordinator = None
@@ -4393,6 +4404,7 @@ class ResponseEmail(ResponseMixin):
                         incident_info).lastrowid
                     session.commit()
                     session.close()
+                    wakeup.notify_incident_created(incident_id)
                     resp.status = HTTP_204
                     # Pass the new incident id back through a header so we can test this
                     resp.set_header('X-IRIS-INCIDENT', str(incident_id))
@@ -5438,7 +5450,10 @@ def construct_falcon_api(debug, healthcheck_path, allowed_origins, iris_sender_a
     api.add_route('/v0/messages/{message_id}/auditlog', MessageAuditLog())
     api.add_route('/v0/messages', Messages())
 
-    api.add_route('/v0/notifications', Notifications(zk_hosts, default_sender_addr, config.get('zookeeper_timeout', 1)))
+    notifications = Notifications(zk_hosts, default_sender_addr, config.get('zookeeper_timeout', 1),
+                                  config['sender'].get('mysql_coordinator'))
+    api.add_route('/v0/notifications', notifications)
+    wakeup.init(config, notifications.coordinator)
 
     api.add_route('/v0/targets/{target_type}', Target())
     api.add_route('/v0/targets', Targets())
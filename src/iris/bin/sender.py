@@ -3,6 +3,7 @@
 
 from gevent import monkey, sleep, spawn, queue
 monkey.patch_all()  # NOQA
+from gevent.lock import Semaphore
 
 import logging
 import logging.handlers
@@ -15,7 +16,7 @@ import signal
 import setproctitle
 import copy
 
-from collections import defaultdict
+from collections import defaultdict, deque
 from iris.plugins import init_plugins
 from iris.vendors import IrisVendorManager, iris_smtp
 from iris.sender import auditlog
@@ -30,10 +31,21 @@ from iris.sender.message import update_message_mode
 from iris.sender.oneclick import oneclick_email_markup, generate_oneclick_url
 from iris import cache as api_cache
 from iris.sender.quota import ApplicationQuota
+from iris.sender.contacts import ContactIndex
+from iris.sender.scheduler import EscalationScheduler
+from iris.sender.writebehind import WriteBehindBuffer
+from iris.sender.checkpoint import AggregationCheckpoint
+from iris.sender.overload import OverloadController, SHED
+from iris.sender.retry import RetryScheduler
+from iris.sender.window import SlidingWindowCounter
+from iris.sender.queues import LaneQueue, SpillQueue, DEFAULT_PRIORITIES
+from iris.sender.workers import WORKER_INDEX_ENV
+from iris.sender.workers import WorkerProcessPool, WorkerChannel, WORKER_FD_ENV
+from iris.sender.ingest import IngestProcessPool, INGEST_FD_ENV, ingest_process_main
 from iris.role_lookup import IrisRoleLookupException
 from pymysql import DataError
 # queue for sending messages
-from iris.sender.shared import per_mode_send_queues, add_mode_stat
+from iris.sender.shared import per_mode_send_queues, add_mode_stat, mode_latency
 
 # sql
 
@@ -48,6 +60,8 @@ JOIN `application`
 ON `incident`.`application_id`=`application`.`id`
 WHERE `current_step`=0 AND `active`=1'''
 
+NEW_INCIDENTS_BY_ID = NEW_INCIDENTS + ''' AND `incident`.`id` IN %s'''
+
 INACTIVE_SQL = '''UPDATE
 `incident`
 SET `active`=0
@@ -79,7 +93,7 @@ FROM (
             JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
             JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
             JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
-            WHERE `incident`.`active` = 1
+            WHERE `incident`.`active` = 1%s
             AND `incident`.`current_step`=`plan`.`step_count`
             AND `step` = `incident`.`current_step`
             GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
@@ -117,7 +131,7 @@ FROM (
     JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
     JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
     JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
-    WHERE `incident`.`active` = 1
+    WHERE `incident`.`active` = 1%s
     GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
 ) as `inner`
 GROUP BY `incident_id`, `plan_notification_id`
@@ -125,6 +139,47 @@ HAVING `age` > `wait` AND (`count` < `max`
                            OR (`count` = `max` AND `step` = `current_step`
                                AND `step` < `step_count`))'''
 
+# Same aggregation as QUEUE_SQL without the HAVING clause, used to seed and check the
+# escalation scheduler. The %s slot takes an extra filter on the inner query.
+SCHEDULE_SQL = '''SELECT
+`incident_id`,
+`plan_id`,
+`plan_notification_id`,
+max(`count`) as `count`,
+`max`,
+min(`age`) as `age`,
+`wait`,
+`step`,
+`current_step`,
+`step_count`
+FROM (
+    SELECT
+        `message`.`incident_id` as `incident_id`,
+        `message`.`plan_notification_id` as `plan_notification_id`,
+        count(`message`.`id`) as `count`,
+        `plan_notification`.`repeat` + 1 as `max`,
+        TIMESTAMPDIFF(SECOND, max(`message`.`created`), NOW()) as `age`,
+        `plan_notification`.`wait` as `wait`,
+        `plan_notification`.`step` as `step`,
+        `incident`.`current_step`,
+        `plan`.`step_count`,
+        `message`.`plan_id`
+    FROM `message`
+    JOIN `incident` ON `message`.`incident_id` = `incident`.`id`
+    JOIN `plan_notification` ON `message`.`plan_notification_id` = `plan_notification`.`id`
+    JOIN `plan` ON `message`.`plan_id` = `plan`.`id`
+    WHERE `incident`.`active` = 1 %s
+    GROUP BY `incident`.`id`, `message`.`plan_notification_id`, `message`.`target_id`
+) as `inner`
+GROUP BY `incident_id`, `plan_notification_id`'''
+
+SCHEDULE_INCIDENTS_FILTER = 'AND `incident`.`id` IN %s'
+
+GET_INACTIVE_IDS_FOR_INCIDENTS_SQL = GET_INACTIVE_IDS_SQL.replace(
+    'WHERE `incident`.`active` = 1', 'WHERE `incident`.`active` = 1 AND `incident`.`id` IN %%s')
+
+ACTIVE_INCIDENT_IDS_SQL = '''SELECT `id` FROM `incident` WHERE `active` = 1 AND `id` IN %s'''
+
 UPDATE_INCIDENT_SQL = '''UPDATE `incident` SET `current_step`=%s WHERE `id`=%s'''
 
 INVALIDATE_INCIDENT = '''UPDATE `incident` SET `active`=0 WHERE `id`=%s'''
@@ -133,6 +188,14 @@ INSERT_MESSAGE_SQL = '''INSERT INTO `message`
     (`created`, `plan_id`, `plan_notification_id`, `incident_id`, `application_id`, `target_id`, `priority_id`, `body`)
 VALUES (NOW(), %s,%s,%s,%s,%s,%s,%s)'''
 
+INSERT_MESSAGE_BATCH_SQL = '''INSERT INTO `message`
+    (`created`, `plan_id`, `plan_notification_id`, `incident_id`, `application_id`, `target_id`, `priority_id`, `body`)
+VALUES %s'''
+
+INSERT_MESSAGE_BATCH_VALUES = '(NOW(), %s,%s,%s,%s,%s,%s,%s)'
+
+UPDATE_INCIDENT_BATCH_SQL = '''UPDATE `incident` SET `current_step` = CASE `id` %s END WHERE `id` IN %%s'''
+
 UNSENT_MESSAGES_SQL = '''SELECT
     `msg`.`body`,
     `msg`.`id` as `message_id`,
@@ -147,7 +210,7 @@ UNSENT_MESSAGES_SQL = '''SELECT
     `incident`.`created` as `incident_created`,
     `plan_notification`.`template` as `template`,
     `dynamic_target`.`name` as `dynamic_target`
-FROM (SELECT * FROM `message` FORCE INDEX (ix_message_active) WHERE `active`=1) AS msg
+FROM (SELECT * FROM `message` FORCE INDEX (ix_message_active) WHERE `active`=1%s) AS msg
 JOIN `application` ON `msg`.`application_id`=`application`.`id`
 JOIN `priority` ON `msg`.`priority_id`=`priority`.`id`
 LEFT OUTER JOIN `target` ON `msg`.`target_id`=`target`.`id`
@@ -158,6 +221,9 @@ LEFT OUTER JOIN `dynamic_plan_map` ON `incident`.`id` = `dynamic_plan_map`.`inci
   AND `plan_notification`.`dynamic_index` = `dynamic_plan_map`.`dynamic_index`
 LEFT OUTER JOIN `target` `dynamic_target` ON `dynamic_target`.`id` = `dynamic_plan_map`.`target_id`'''
 
+UNSENT_MESSAGES_SINCE_FILTER = ' AND `id` > %s'
+UNSENT_MESSAGES_SINCE_OR_IDS_FILTER = ' AND (`id` > %s OR `id` IN %s)'
+
 SENT_MESSAGE_BATCH_SQL = '''UPDATE `message`
 SET `destination`=%%s,
     `mode_id`=%%s,
@@ -186,6 +252,10 @@ PRUNE_OLD_AUDIT_LOGS_SQL = '''DELETE FROM `message_changelog` WHERE `date` < DAT
 MAX_MESSAGE_BODY_LENGTH = 40000
 MAX_MESSAGE_RETRIES = 2
 
+# Max number of rows written per statement+commit when creating messages and updating
+# incident steps in escalate(). Overridden by escalate_batch_size in the sender config.
+escalate_batch_size = 100
+
 # logging
 logger = logging.getLogger()
 formatter = logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s')
@@ -210,8 +280,8 @@ if pidfile:
         logger.exception('Failed writing pid to %s', pidfile)
 
 
-# rate limiting data structure message key -> minute -> count
-# used to calcuate if a new message exceeds the rate limit
+# rate limiting data structure message key -> SlidingWindowCounter over the plan's
+# threshold window, used to calcuate if a new message exceeds the rate limit
 # and needs to be queued
 plan_aggregate_windows = {}
 
@@ -233,12 +303,82 @@ sent = {}
 # this sets the ground work for not having to poll the DB for messages
 message_queue = queue.Queue()
 
+# poll() only fetches messages with ids above this watermark. None forces a full scan.
+poll_watermark = None
+# (time, highest message id seen) of recent polls. The watermark only moves up to ids
+# seen poll_watermark_lag seconds ago, so rows committed late with a lower id still get
+# picked up, however close together polls run.
+poll_marks = deque()
+poll_watermark_lag = 60
+# ids above the watermark that were already polled
+polled_message_ids = set()
+# active messages the sender gave up on, which poll() fetches again by id
+poll_recheck_ids = set()
+last_full_poll = 0
+poll_full_scan_interval = 600
+
 # Quota object used for rate limiting
 quota = None
 
 # Coordinator object for sender leader election
 coordinator = None
 
+# Buffers sent status/body/subject updates of messages when the write_behind
+# option is enabled
+write_behind = None
+
+# In-memory copy of user contact settings, used to resolve message modes and
+# destinations when the contact_index option is enabled
+contact_index = None
+
+# Due-time index of plan notifications, used instead of QUEUE_SQL when the
+# escalation_scheduler option is enabled
+escalation_scheduler = None
+
+# Saves aggregation state for whoever escalates after us, when the
+# aggregation_checkpoint option is enabled
+aggregation_checkpoint = None
+
+# Restore aggregation state from checkpoints before escalating next
+aggregation_restore_needed = True
+
+# message id -> aggregation key it was queued under by the sender we took over
+# escalation from. Those messages go straight back into their queue when polled.
+restored_queue_keys = {}
+
+# Settings of per priority lanes in send queues, when the send_queue_lanes option
+# is enabled
+send_queue_lanes = None
+
+# Settings of bounded send queues spilling to disk, when the send_queue_spill option
+# is enabled
+send_queue_spill = None
+
+# Holds failed messages until their retry is due, when the retry_backoff option is
+# enabled. Otherwise, they go right back in their send queue.
+retry_scheduler = None
+
+# Sheds load when the send queues back up, when the overload_control option is enabled
+overload_controller = None
+
+# Most messages held in memory for aggregation, if set. Past that, aggregated
+# messages stay in the DB until the next full poll.
+max_held_messages = None
+
+# Serializes escalation work between the main loop, the escalation timer and incident wakeups
+escalation_lock = Semaphore()
+
+# Ids of new incidents the API asked us to escalate right away
+incident_wakeup_queue = queue.Queue()
+
+# Serializes poll() between the main loop and the poll wakeup worker
+poll_lock = Semaphore()
+
+# Set when incident wakeups or the escalation timer create messages, so they're polled right away
+poll_wakeup = gevent.event.Event()
+# but no more than once every this many seconds
+poll_wakeup_interval = 1
+
 # Mode -> [{'greenlet': greenlet, 'kill_set': gevent.Event}]
 worker_tasks = defaultdict(list)
 
@@ -248,6 +388,21 @@ autoscale_email_worker_tasks = defaultdict(list)
 # support the 2nd control+c force exiting sender without waiting for tasks to finish
 shutdown_started = False
 
+# Number of partitions of incident ids escalated by different senders, if set
+partition_count = 0
+
+# Partitions this sender escalates. None unless partition_count is set.
+escalation_partitions = None
+
+# Pool of worker processes sending messages for us, if sender.worker_processes is set
+worker_pool = None
+
+# In worker processes, the channel to the parent sender
+worker_channel = None
+
+# Processes serving our RPC port, if sender.ingest_processes is set
+ingest_pool = None
+
 # Set of active message IDs currently being sent, to avoid re-sending messages that are currently
 # just blocked on a downstream such as smtp
 message_ids_being_sent = set()
@@ -270,8 +425,10 @@ default_sender_metrics = {
     'send_queue_email_size': 0, 'send_queue_im_size': 0, 'send_queue_slack_size': 0, 'send_queue_call_size': 0,
     'send_queue_sms_size': 0, 'send_queue_drop_size': 0, 'new_incidents_cnt': 0, 'workers_respawn_cnt': 0,
     'message_retry_cnt': 0, 'message_ids_being_sent_cnt': 0, 'notifications': 0, 'deactivation': 0,
-    'new_msg_count': 0, 'poll': 0, 'queue': 0, 'aggregations': 0, 'hipchat_cnt': 0, 'hipchat_fail': 0,
-    'hipchat_total': 0, 'hipchat_sent': 0, 'hipchat_max': 0, 'hipchat_min': 0
+    'new_msg_count': 0, 'poll': 0, 'queue': 0, 'aggregation_deferred_cnt': 0, 'aggregations': 0, 'hipchat_cnt': 0, 'hipchat_fail': 0,
+    'hipchat_total': 0, 'hipchat_sent': 0, 'hipchat_max': 0, 'hipchat_min': 0,
+    'escalate_batch_cnt': 0, 'escalate_batch_fallback_cnt': 0, 'incident_wakeup_cnt': 0,
+    'incident_wakeup_ignored_cnt': 0, 'incident_wakeup_escalated_cnt': 0, 'incident_wakeup_escalate_time': 0
 }
 
 # TODO: make this configurable
@@ -280,10 +437,88 @@ should_mock_gwatch_renewer = False
 config = None
 
 
+def insert_message(cursor, connection, row):
+    # retry to guard against deadlocks
+    retries = 0
+    max_retries = 5
+    while True:
+        retries += 1
+        try:
+            cursor.execute(INSERT_MESSAGE_SQL, row)
+            connection.commit()
+        except Exception:
+            logger.warning('Failed inserting message for incident %s. (Try %s/%s)', row[2], retries, max_retries)
+            if retries < max_retries:
+                sleep(.2)
+                continue
+            else:
+                raise Exception('Failed inserting message retries exceeded')
+        else:
+            return cursor.lastrowid
+
+
+def insert_incident_messages(cursor, connection, incident_id, rows):
+    # retry to guard against deadlocks
+    retries = 0
+    max_retries = 5
+    while True:
+        retries += 1
+        try:
+            cursor.execute(INSERT_MESSAGE_BATCH_SQL % ', '.join([INSERT_MESSAGE_BATCH_VALUES] * len(rows)),
+                           [value for row in rows for value in row])
+            connection.commit()
+        except Exception:
+            logger.warning('Failed inserting messages for incident %s. (Try %s/%s)', incident_id, retries, max_retries)
+            if retries < max_retries:
+                sleep(.2)
+                continue
+            else:
+                raise Exception('Failed inserting message retries exceeded')
+        else:
+            break
+
+
+def insert_message_batch(cursor, connection, pending_rows, incident_ids):
+    rows = [row for incident_id in incident_ids for row in pending_rows[incident_id]]
+    try:
+        cursor.execute(INSERT_MESSAGE_BATCH_SQL % ', '.join([INSERT_MESSAGE_BATCH_VALUES] * len(rows)),
+                       [value for row in rows for value in row])
+        connection.commit()
+        metrics.incr('escalate_batch_cnt')
+    except Exception:
+        # The whole chunk failed (usually a deadlock). Fall back to writing each incident on its own
+        # so one bad incident can't hold back the others.
+        logger.warning('Failed inserting batch of %s messages for %s incidents. Retrying per incident.',
+                       len(rows), len(incident_ids))
+        metrics.incr('escalate_batch_fallback_cnt')
+        for incident_id in incident_ids:
+            insert_incident_messages(cursor, connection, incident_id, pending_rows[incident_id])
+
+
+def insert_messages(cursor, connection, pending_rows):
+    # Group whole incidents into chunks of roughly escalate_batch_size rows, so a chunk that
+    # fails can be retried incident by incident.
+    incident_ids = []
+    row_count = 0
+    for incident_id, rows in pending_rows.items():
+        incident_ids.append(incident_id)
+        row_count += len(rows)
+        if row_count >= escalate_batch_size:
+            insert_message_batch(cursor, connection, pending_rows, incident_ids)
+            incident_ids = []
+            row_count = 0
+    if incident_ids:
+        insert_message_batch(cursor, connection, pending_rows, incident_ids)
+
+
 # msg_info takes the form [(incident_id, plan_notification_id), ...]
 def create_messages(msg_info):
     msg_count = 0
     error_incident_ids = set()
+    # incident_id -> [message row, ...] waiting to be written in batches
+    pending_rows = {}
+    # (incident_id, plan_notification_id) -> wait, for notifications that got new messages
+    created_notifications = {}
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
 
@@ -358,62 +593,197 @@ def create_messages(msg_info):
         for name in names:
             t = cache.target_names[name]
             if t:
-                target_id = t['id']
-                retries = 0
-                max_retries = 5
-                while True:
-                    retries += 1
+                row = (plan_notification['plan_id'], plan_notification_id, incident_id,
+                       application_id, t['id'], priority_id, body)
+                if redirect_to_plan_owner:
+                    # inserted on its own as the audit log needs the lastrowid, which
+                    # also has to exist in the DB to satisfy the constraint. A failure here
+                    # mustn't lose the rows already batched for other incidents.
                     try:
-                        cursor.execute(INSERT_MESSAGE_SQL,
-                                       (plan_notification['plan_id'], plan_notification_id, incident_id,
-                                        application_id, target_id, priority_id, body))
-                        connection.commit()
+                        message_id = insert_message(cursor, connection, row)
                     except Exception:
-                        logger.warning('Failed inserting message for incident %s. (Try %s/%s)', incident_id, retries, max_retries)
-                        if retries < max_retries:
-                            sleep(.2)
-                            continue
-                        else:
-                            raise Exception('Failed inserting message retries exceeded')
-                    else:
-                        if redirect_to_plan_owner:
-                            # needed for the lastrowid to exist in the DB to satisfy the constraint
-                            auditlog.message_change(
-                                cursor.lastrowid,
-                                auditlog.TARGET_CHANGE,
-                                role + '|' + target,
-                                name,
-                                lookup_fail_reason or 'Changing target to plan owner as we failed resolving original target')
-                        break
+                        logger.exception('Failed inserting message to plan owner %s for incident %s',
+                                         name, incident_id)
+                        error_incident_ids.add(incident_id)
+                        continue
+                    auditlog.message_change(
+                        message_id,
+                        auditlog.TARGET_CHANGE,
+                        role + '|' + target,
+                        name,
+                        lookup_fail_reason or 'Changing target to plan owner as we failed resolving original target')
+                else:
+                    pending_rows.setdefault(incident_id, []).append(row)
 
+                if escalation_scheduler is not None:
+                    created_notifications[(incident_id, plan_notification_id)] = plan_notification['wait']
                 msg_count += 1
             else:
                 metrics.incr('target_not_found')
                 logger.warning('Failed to notify plan creator; no active target found: %s', name)
+
+    if pending_rows:
+        insert_messages(cursor, connection, pending_rows)
+
+    if escalation_scheduler is not None:
+        # the next round is due once the message age exceeds wait, which
+        # QUEUE_SQL measures in whole seconds
+        now = time.time()
+        for (incident_id, plan_notification_id), wait in created_notifications.items():
+            escalation_scheduler.schedule(incident_id, plan_notification_id, now + wait + 1)
+
     cursor.close()
     connection.close()
     return msg_count, error_incident_ids
 
 
+def update_incident(cursor, connection, incident_id, step):
+    # step is None for incidents that can't escalate anywhere and need to be invalidated
+    retries = 0
+    max_retries = 5
+    while True:
+        retries += 1
+        try:
+            if step is None:
+                cursor.execute(INVALIDATE_INCIDENT, incident_id)
+            else:
+                cursor.execute(UPDATE_INCIDENT_SQL, (step, incident_id))
+            connection.commit()
+        except Exception:
+            logger.warning('Failed updating incident %s. (Try %s/%s)', incident_id, retries, max_retries)
+            if retries < max_retries:
+                sleep(.2)
+                continue
+            else:
+                raise Exception('Failed updating batch messages retries exceeded')
+        else:
+            break
+
+
+def update_incident_steps(cursor, connection, steps):
+    # steps: {incident_id: step}
+    incident_ids = list(steps)
+    for i in range(0, len(incident_ids), escalate_batch_size):
+        chunk = incident_ids[i:i + escalate_batch_size]
+        params = [value for incident_id in chunk for value in (incident_id, steps[incident_id])]
+        params.append(tuple(chunk))
+        try:
+            cursor.execute(UPDATE_INCIDENT_BATCH_SQL % ' '.join(['WHEN %s THEN %s'] * len(chunk)), params)
+            connection.commit()
+            metrics.incr('escalate_batch_cnt')
+        except Exception:
+            logger.warning('Failed updating steps for batch of %s incidents. Retrying per incident.', len(chunk))
+            metrics.incr('escalate_batch_fallback_cnt')
+            for incident_id in chunk:
+                update_incident(cursor, connection, incident_id, steps[incident_id])
+
+
+def current_partitions():
+    # Partitions we set up escalating which the coordinator still gives us. Read at each
+    # use, so we stop escalating a partition as soon as it goes elsewhere.
+    if escalation_partitions is None:
+        return None
+    return escalation_partitions & (coordinator.get_partitions() or frozenset())
+
+
+def partition_filter(column):
+    # SQL condition limiting column, an incident id, to the partitions we escalate
+    partitions = current_partitions()
+    if partitions is None:
+        return ''
+    return ' AND MOD(%s, %d) IN (%s)' % (column, partition_count,
+                                         ', '.join(str(partition) for partition in sorted(partitions)) or 'NULL')
+
+
+def owns_escalation():
+    if partition_count:
+        return bool(current_partitions())
+    return coordinator.am_i_leader()
+
+
+def owns_incident(incident_id):
+    if partition_count:
+        partitions = current_partitions()
+        return partitions is not None and incident_id % partition_count in partitions
+    return coordinator.am_i_leader()
+
+
+def update_escalation_partitions():
+    global escalation_partitions, aggregation_restore_needed
+    partitions = coordinator.get_partitions()
+    if partitions == escalation_partitions:
+        return
+    logger.info('Escalating incident partitions %s of %s', sorted(partitions or ()), partition_count)
+    escalation_partitions = partitions
+    if quota is not None:
+        quota.share = len(partitions or ()) / partition_count
+    aggregation_restore_needed = True
+
+    # Start over from the DB for the partitions we have now, and forget messages we were
+    # holding for aggregation from partitions that moved elsewhere
+    with escalation_lock:
+        if escalation_scheduler is not None:
+            escalation_scheduler.clear()
+        reset_poll()
+        for message_id, message in list(messages.items()):
+            if not owns_incident(message.get('incident_id') or 0):
+                del messages[message_id]
+                for queued_ids in queues.values():
+                    queued_ids.discard(message_id)
+
+
+def confirm_released_partitions():
+    # Once escalations that started before partitions moved elsewhere are done, let the
+    # coordinator hand those partitions over to their new owners
+    if not coordinator.releasing:
+        return
+    with escalation_lock:
+        coordinator.stopped_escalating(frozenset(range(partition_count)) - (current_partitions() or frozenset()))
+
+
+def partition_updater():
+    # Keep up with partition moves between main loop passes
+    while True:
+        try:
+            update_escalation_partitions()
+            confirm_released_partitions()
+        except Exception:
+            metrics.incr('task_failure')
+            logger.exception('Exception occured updating escalation partitions')
+        sleep(1)
+
+
 def deactivate():
     # deactivate incidents that have expired
     logger.info('[-] start deactivate task...')
     start_deactivation = time.time()
 
+    if escalation_scheduler is not None:
+        # only look at incidents the scheduler saw go through their last step
+        candidates = tuple(escalation_scheduler.exhausted)
+        if not candidates:
+            metrics.set('deactivation', time.time() - start_deactivation)
+            logger.info('[*] deactivate task finished')
+            return
+        query, params = GET_INACTIVE_IDS_FOR_INCIDENTS_SQL % partition_filter('`incident`.`id`'), (candidates,)
+    else:
+        query, params = GET_INACTIVE_IDS_SQL % partition_filter('`incident`.`id`'), None
+
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
 
     max_retries = 3
+    ids = ()
 
     # this deadlocks sometimes. try until it doesn't.
     for i in range(1, max_retries + 1):
         try:
-            cursor.execute(GET_INACTIVE_IDS_SQL)
+            cursor.execute(query, params)
             ids = tuple(r[0] for r in cursor)
             if ids:
                 cursor.execute(INACTIVE_SQL, (ids,))
                 connection.commit()
-                break
+            break
         except Exception:
             if i == max_retries:
                 logger.warning('Failed running deactivate query. (Try %s/%s)', i, max_retries)
@@ -421,6 +791,17 @@ def deactivate():
                 logger.warning('Deadlocked running deactivate query. (Try %s/%s)', i, max_retries)
             sleep(.2)
 
+    if escalation_scheduler is not None:
+        escalation_scheduler.exhausted.difference_update(ids)
+        # Keep waiting on the remaining candidates unless they've been claimed in the meantime
+        remaining = tuple(set(candidates) - set(ids))
+        if remaining:
+            try:
+                cursor.execute(ACTIVE_INCIDENT_IDS_SQL, (remaining,))
+                escalation_scheduler.exhausted.difference_update(set(remaining) - {r[0] for r in cursor})
+            except Exception:
+                logger.warning('Failed checking active status of %s incidents', len(remaining))
+
     cursor.close()
     connection.close()
 
@@ -437,8 +818,99 @@ def escalate():
 
     connection = db.engine.raw_connection()
     cursor = connection.cursor()
-    cursor.execute(NEW_INCIDENTS)
+    cursor.execute(NEW_INCIDENTS + partition_filter('`incident`.`id`'))
+    escalations, incident_per_plan_cnt = process_new_incidents(cursor)
+    cursor.close()
+
+    new_incidents_count = len(escalations)
+    metrics.set('new_incidents_cnt', new_incidents_count)
+    logger.info('[*] %s new incidents', new_incidents_count)
+
+    # log any plan that creates a high volume of incidents
+    for pln_id, cnt in incident_per_plan_cnt.items():
+        if cnt > 10:
+            logger.info("plan with id %d created %d incidents this loop iteration")
+
+    msg_count = escalate_notifications(connection, escalations)
+    connection.close()
+
+    logger.info('[*] %s new messages', msg_count)
+    logger.info('[*] escalate task finished')
+    metrics.set('notifications', time.time() - start_notifications)
+
+
+def escalate_new_incidents(incident_ids):
+    # run the first step for incidents the API told us about, without waiting for the main loop
+    start = time.time()
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    cursor.execute(NEW_INCIDENTS_BY_ID, (tuple(incident_ids),))
+    escalations = process_new_incidents(cursor)[0]
+    cursor.close()
+
+    msg_count = 0
+    if escalations:
+        cursor = connection.cursor(db.dict_cursor)
+        msg_count = create_escalation_messages(cursor, connection, escalations)
+        cursor.close()
+    connection.close()
+    if msg_count:
+        poll_wakeup.set()
+
+    metrics.incr('incident_wakeup_escalated_cnt', inc=len(escalations))
+    metrics.set('incident_wakeup_escalate_time', time.time() - start)
+    logger.info('[*] escalated %s new incidents on wakeup, %s new messages', len(escalations), msg_count)
+
+
+def escalate_new_incident(incident_id):
+    metrics.incr('incident_wakeup_cnt')
+    # the main loop picks it up anyway if leadership moved in the meantime
+    if not owns_incident(incident_id):
+        metrics.incr('incident_wakeup_ignored_cnt')
+        return
+    incident_wakeup_queue.put(incident_id)
+
+
+def incident_wakeup_worker():
+    while True:
+        incident_ids = {incident_wakeup_queue.get()}
+        # escalate everything that came in while we were busy in one go
+        while not incident_wakeup_queue.empty():
+            incident_ids.add(incident_wakeup_queue.get_nowait())
+        try:
+            with escalation_lock:
+                # ownership may have moved while these waited
+                incident_ids = {incident_id for incident_id in incident_ids if owns_incident(incident_id)}
+                if incident_ids:
+                    escalate_new_incidents(incident_ids)
+        except Exception:
+            metrics.incr('task_failure')
+            logger.exception('Exception occured escalating new incidents %s', incident_ids)
+
+
+def poll_wakeup_worker():
+    # Send messages created between main loop runs without waiting for its next poll.
+    # The poll watermark lags by time rather than by polls, so polling this often
+    # doesn't skip rows committed late.
+    last_poll = 0
+    while True:
+        poll_wakeup.wait()
+        # wakeups that come in meanwhile are handled by the same poll
+        sleep(max(last_poll + poll_wakeup_interval - time.time(), 0))
+        poll_wakeup.clear()
+        if not owns_escalation():
+            continue
+        last_poll = time.time()
+        try:
+            with poll_lock:
+                poll()
+        except Exception:
+            metrics.incr('task_failure')
+            logger.exception('Exception occured polling woken up messages.')
+
 
+def process_new_incidents(cursor):
+    # queue the first step of each new incident and send plan tracking messages
     escalations = {}
     incident_per_plan_cnt = {}
     for incident_id, created, plan_id, context, application in cursor:
@@ -507,29 +979,104 @@ def escalate():
                 tracking_message['body'] = body
 
             message_send_enqueue(tracking_message)
+
+    return escalations, incident_per_plan_cnt
+
+
+def fetch_due_notifications(cursor):
+    now = time.time()
+    # partitions that moved elsewhere are dropped before the scheduler is cleared
+    due_keys = [key for key in escalation_scheduler.pop_due(now) if owns_incident(key[0])]
+    if not due_keys:
+        return []
+
+    cursor.execute(SCHEDULE_SQL % SCHEDULE_INCIDENTS_FILTER,
+                   [tuple({incident_id for incident_id, _ in due_keys})])
+
+    # Apply QUEUE_SQL's HAVING clause here, so rows that aren't due can be put back
+    # in the scheduler. Notifications of incidents that were claimed don't come back
+    # from the query and simply drop out.
+    due = []
+    for n in cursor.fetchall():
+        if n['age'] > n['wait']:
+            if n['count'] < n['max'] or (n['step'] == n['current_step'] and n['step'] < n['step_count']):
+                due.append(n)
+                # re-check later in case no message gets created for it this round
+                escalation_scheduler.schedule(n['incident_id'], n['plan_notification_id'], now + n['wait'] + 1)
+            elif n['step'] == n['current_step'] == n['step_count']:
+                escalation_scheduler.exhausted.add(n['incident_id'])
+            # otherwise this notification belongs to a step the incident has already moved past
+        else:
+            escalation_scheduler.schedule(n['incident_id'], n['plan_notification_id'], now + n['wait'] + 1 - n['age'])
+    return due
+
+
+def seed_escalation_scheduler():
+    logger.info('[-] seeding escalation scheduler...')
+    now = time.time()
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor(db.dict_cursor)
+    cursor.execute(SCHEDULE_SQL % partition_filter('`incident`.`id`'))
+    escalation_scheduler.clear()
+    for n in cursor:
+        escalation_scheduler.schedule(n['incident_id'], n['plan_notification_id'], now + n['wait'] + 1 - n['age'])
+    escalation_scheduler.seeded = True
     cursor.close()
+    connection.close()
+    logger.info('[*] seeded escalation scheduler with %s notifications', len(escalation_scheduler))
 
-    new_incidents_count = len(escalations)
-    metrics.set('new_incidents_cnt', new_incidents_count)
-    logger.info('[*] %s new incidents', new_incidents_count)
 
-    # log any plan that creates a high volume of incidents
-    for pln_id, cnt in incident_per_plan_cnt.items():
-        if cnt > 10:
-            logger.info("plan with id %d created %d incidents this loop iteration")
+def escalate_due():
+    connection = db.engine.raw_connection()
+    msg_count = escalate_notifications(connection, {})
+    connection.close()
+    if msg_count:
+        logger.info('[*] %s new messages from due notifications', msg_count)
+        poll_wakeup.set()
+
 
+def escalation_timer(max_nap):
+    # Run escalations as soon as they are due rather than waiting for the next main loop
+    while True:
+        nap = max_nap
+        if escalation_scheduler.seeded and owns_escalation():
+            next_due = escalation_scheduler.next_due()
+            if next_due is not None:
+                nap = next_due - time.time()
+                if nap <= 0:
+                    try:
+                        with escalation_lock:
+                            escalate_due()
+                    except Exception:
+                        metrics.incr('task_failure')
+                        logger.exception('Exception occured in escalation timer.')
+                    nap = 1
+        sleep(min(max(nap, 1), max_nap))
+
+
+def escalate_notifications(connection, escalations):
     # then, fetch message count for current incidents
     msg_count = 0
     cursor = connection.cursor(db.dict_cursor)
-    cursor.execute(QUEUE_SQL)
+    if escalation_scheduler is not None:
+        rows = fetch_due_notifications(cursor)
+    else:
+        cursor.execute(QUEUE_SQL % partition_filter('`incident`.`id`'))
+        rows = cursor.fetchall()
     msg_info = []
-    for n in cursor.fetchall():
+    for n in rows:
         if n['count'] < n['max']:
             msg_info.append((n['incident_id'], n['plan_notification_id']))
         else:
             escalations[n['incident_id']] = (n['plan_id'], n['current_step'] + 1)
     msg_count += create_messages(msg_info)[0]
+    msg_count += create_escalation_messages(cursor, connection, escalations)
+    cursor.close()
+
+    return msg_count
 
+
+def create_escalation_messages(cursor, connection, escalations):
     # Create escalation messages
     msg_info = []
     for incident_id, (plan_id, step) in escalations.items():
@@ -537,44 +1084,24 @@ def escalate():
         steps = plan['steps'].get(step, [])
         for plan_notification_id in steps:
             msg_info.append((incident_id, plan_notification_id))
-    count, error_incident_ids = create_messages(msg_info)
-    msg_count += count
+    msg_count, error_incident_ids = create_messages(msg_info)
 
     # Update incident step value
+    steps = {}
     for incident_id, (plan_id, step) in escalations.items():
         plan = cache.plans[plan_id]
-        steps = plan['steps'].get(step, [])
-        retries = 0
-        max_retries = 5
-        while True:
-            retries += 1
-            try:
-                if steps:
-                    if step == 1 and incident_id in error_incident_ids:
-                        # no message created due to role look up failure, reset step to
-                        # 0 for retry
-                        step = 0
-                    cursor.execute(UPDATE_INCIDENT_SQL, (step, incident_id))
-                else:
-                    logger.error('plan id %d has no steps, incident id %d is invalid', plan_id, incident_id)
-                    cursor.execute(INVALIDATE_INCIDENT, incident_id)
+        if plan['steps'].get(step, []):
+            if step == 1 and incident_id in error_incident_ids:
+                # no message created due to role look up failure, reset step to
+                # 0 for retry
+                step = 0
+            steps[incident_id] = step
+        else:
+            logger.error('plan id %d has no steps, incident id %d is invalid', plan_id, incident_id)
+            update_incident(cursor, connection, incident_id, None)
+    update_incident_steps(cursor, connection, steps)
 
-                connection.commit()
-            except Exception:
-                logger.warning('Failed updating incident %s. (Try %s/%s)', incident_id, retries, max_retries)
-                if retries < max_retries:
-                    sleep(.2)
-                    continue
-                else:
-                    raise Exception('Failed updating batch messages retries exceeded')
-            else:
-                break
-    cursor.close()
-    connection.close()
-
-    logger.info('[*] %s new messages', msg_count)
-    logger.info('[*] escalate task finished')
-    metrics.set('notifications', time.time() - start_notifications)
+    return msg_count
 
 
 def aggregate(now):
@@ -623,29 +1150,118 @@ def aggregate(now):
     # remove inactive message from the queue
     for message_id in inactive_message_ids:
         messages.pop(message_id, None)
+    for message_id in restored_queue_keys.keys() - all_actives:
+        del restored_queue_keys[message_id]
+
+    # forget about windows of keys that went quiet
+    for key, window in list(plan_aggregate_windows.items()):
+        if not window.total(now) and key not in aggregation:
+            del plan_aggregate_windows[key]
 
     metrics.set('aggregations', time.time() - start_aggregations)
     logger.info('[*] aggregate task finished - queued: %s', len(messages))
 
 
+def checkpoint_names():
+    # one snapshot per partition we escalate, so they can be restored by their new owners
+    partitions = current_partitions()
+    if partitions is None:
+        return {'aggregation': None}
+    return {'aggregation_%s' % partition: partition for partition in partitions}
+
+
+def checkpoint_aggregation_state(now):
+    key_state = {'windows': [], 'aggregation': [[key, t] for key, t in aggregation.items()],
+                 'sent': [[key, t] for key, t in sent.items()]}
+    for key, window in plan_aggregate_windows.items():
+        buckets = window.buckets(now)
+        if buckets:
+            key_state['windows'].append([key, buckets])
+
+    names = checkpoint_names()
+    snapshots = {name: dict(key_state, queues=[]) for name in names}
+    for key, message_ids in queues.items():
+        by_name = defaultdict(list)
+        for message_id in message_ids:
+            if partition_count:
+                message = messages.get(message_id) or {}
+                name = 'aggregation_%s' % ((message.get('incident_id') or 0) % partition_count)
+            else:
+                name = 'aggregation'
+            by_name[name].append(message_id)
+        for name, queued_ids in by_name.items():
+            if name in snapshots:
+                snapshots[name]['queues'].append([key, queued_ids])
+    aggregation_checkpoint.save(snapshots)
+
+
+def restore_aggregation_state():
+    restored_queue_keys.clear()
+    snapshots = aggregation_checkpoint.load(checkpoint_names())
+    for snapshot in snapshots:
+        for key, buckets in snapshot.get('windows', []):
+            key = tuple(key)
+            window = plan_aggregate_windows.get(key)
+            if window is None:
+                try:
+                    window = plan_aggregate_windows[key] = SlidingWindowCounter(cache.plans[key[0]]['threshold_window'])
+                except Exception:
+                    continue
+            window.restore(buckets)
+        for key, t in snapshot.get('aggregation', []):
+            key = tuple(key)
+            aggregation[key] = max(aggregation.get(key, 0), t)
+        for key, t in snapshot.get('sent', []):
+            key = tuple(key)
+            sent[key] = max(sent.get(key, 0), t)
+        for key, message_ids in snapshot.get('queues', []):
+            key = tuple(key)
+            for message_id in message_ids:
+                if message_id not in messages:
+                    restored_queue_keys[message_id] = key
+    logger.info('Restored aggregation state from %s checkpoints, with %s queued messages',
+                len(snapshots), len(restored_queue_keys))
+
+
 def poll():
     # poll unsent messages
+    global polled_message_ids, last_full_poll
     logger.info('[-] start send task...')
     start_send = time.time()
 
+    # make sure messages we've already sent aren't still active in the DB
+    if write_behind is not None:
+        write_behind.flush()
+
+    full_scan = poll_watermark is None or start_send - last_full_poll >= poll_full_scan_interval
+    recheck_ids = tuple(poll_recheck_ids)
+    poll_recheck_ids.difference_update(recheck_ids)
+
     connection = db.engine.raw_connection()
     cursor = connection.cursor(db.dict_cursor)
-    if messages:
-        cursor.execute(UNSENT_MESSAGES_SQL + ' AND `msg`.`id` NOT IN %s', [tuple(messages)])
+    # messages without an incident are sent by whoever escalates partition 0
+    partition = partition_filter('IFNULL(`incident_id`, 0)')
+    if full_scan:
+        cursor.execute(UNSENT_MESSAGES_SQL % partition)
+    elif recheck_ids:
+        cursor.execute(UNSENT_MESSAGES_SQL % (UNSENT_MESSAGES_SINCE_OR_IDS_FILTER + partition), (poll_watermark, recheck_ids))
     else:
-        cursor.execute(UNSENT_MESSAGES_SQL)
+        cursor.execute(UNSENT_MESSAGES_SQL % (UNSENT_MESSAGES_SINCE_FILTER + partition), (poll_watermark,))
 
-    new_msg_count = cursor.rowcount
-    queued_msg_cnt = len(messages)
-    metrics.set('new_msg_count', new_msg_count)
-    logger.info('%d new messages waiting in database - queued: %d', new_msg_count, queued_msg_cnt)
+    recheck_ids = set(recheck_ids)
+    max_message_id = poll_marks[-1][1] if poll_marks else 0
+    new_msg_count = 0
 
     for m in cursor:
+        message_id = m['message_id']
+        max_message_id = max(max_message_id, message_id)
+        if message_id in messages or message_id in message_ids_being_sent:
+            continue
+        if message_id in polled_message_ids and not full_scan and message_id not in recheck_ids:
+            continue
+        polled_message_ids.add(message_id)
+        new_msg_count += 1
+
         # Set dynamic target as target if applicable
         if m.get('dynamic_target') and m.get('target') is None:
             m['target'] = m['dynamic_target']
@@ -658,6 +1274,16 @@ def poll():
             m['context'] = context
         message_queue.put(m)
 
+    if full_scan:
+        last_full_poll = start_send
+    advance_poll_watermark(start_send, max_message_id)
+    polled_message_ids = {message_id for message_id in polled_message_ids if message_id > poll_watermark}
+
+    queued_msg_cnt = len(messages)
+    metrics.set('new_msg_count', new_msg_count)
+    logger.info('%d new messages waiting in database - queued: %d (%s scan)',
+                new_msg_count, queued_msg_cnt, 'full' if full_scan else 'incremental')
+
     metrics.set('poll', time.time() - start_send)
     metrics.set('queue', len(messages))
     logger.info('[*] send task finished')
@@ -665,6 +1291,40 @@ def poll():
     connection.close()
 
 
+def advance_poll_watermark(now, max_message_id):
+    global poll_watermark
+    poll_marks.append((now, max_message_id))
+    while len(poll_marks) > 1 and now - poll_marks[1][0] >= poll_watermark_lag:
+        poll_marks.popleft()
+    if now - poll_marks[0][0] >= poll_watermark_lag:
+        poll_watermark = poll_marks[0][1]
+    elif poll_watermark is None:
+        # until then, polls after the first full scan go through every active message,
+        # skipping the ones already queued
+        poll_watermark = 0
+
+
+def reset_poll():
+    # make the next poll() a full scan
+    global poll_watermark, polled_message_ids
+    poll_watermark = None
+    poll_marks.clear()
+    polled_message_ids = set()
+    poll_recheck_ids.clear()
+
+
+def hold_message(key, m):
+    message_id = m['message_id']
+    if max_held_messages is not None and len(messages) >= max_held_messages and queues.get(key):
+        # The key already has a message to send its batch with, so leave this one in
+        # the DB. The next full poll picks it up again.
+        polled_message_ids.discard(message_id)
+        metrics.incr('aggregation_deferred_cnt')
+        return
+    queues.setdefault(key, set()).add(message_id)
+    messages[message_id] = m
+
+
 def fetch_and_prepare_message():
     now = time.time()
     m = message_queue.get()
@@ -679,6 +1339,11 @@ def fetch_and_prepare_message():
     # queue key
     key = (m['plan_id'], m['application'], m['priority'], m['target'])
 
+    if restored_queue_keys.pop(message_id, None) == key:
+        # held for aggregation by the sender escalating before us
+        hold_message(key, m)
+        return
+
     # should this message be aggregated?
     aggregate = False
     last_aggregation = aggregation.get(key)
@@ -699,19 +1364,16 @@ def fetch_and_prepare_message():
 
     if aggregate:
         # we are still in a previous aggregation mode
-        queues.setdefault(key, set()).add(message_id)
-        messages[message_id] = m
+        hold_message(key, m)
     else:
         # does this message trigger aggregation?
-        window = plan_aggregate_windows.setdefault(key, defaultdict(int))
-
-        for bucket in list(window.keys()):
-            if now - bucket > plan['threshold_window']:
-                del window[bucket]
-
-        window[now] += 1
+        window = plan_aggregate_windows.get(key)
+        if window is None:
+            window = plan_aggregate_windows[key] = SlidingWindowCounter(plan['threshold_window'])
+        elif window.duration != plan['threshold_window']:
+            window = plan_aggregate_windows[key] = window.resized(plan['threshold_window'], now=now)
 
-        if sum(window.values()) > plan['threshold_count']:
+        if window.add(now=now) > plan['threshold_count']:
             # too many messages for the aggregation key - enqueue
 
             # add message id to aggregation queue
@@ -739,17 +1401,24 @@ def send():
 
 def set_target_fallback_mode(message):
     try:
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor()
-        cursor.execute('''SELECT `destination`, `mode`.`name`, `mode`.`id`
-                          FROM `target`
-                          JOIN `target_contact` ON `target_contact`.`target_id` = `target`.`id`
-                          JOIN `mode` ON `mode`.`id` = `target_contact`.`mode_id`
-                          WHERE `target`.`name` = %s AND `mode`.`name` = %s''',
-                       (message['target'], target_fallback_mode))
-        [(destination, mode, mode_id)] = cursor
-        cursor.close()
-        connection.close()
+        destination = None
+        if contact_index is not None:
+            destination = contact_index.lookup_destination(message['target'], mode=target_fallback_mode)
+        if destination is not None:
+            mode = target_fallback_mode
+            mode_id = contact_index.index['mode_ids'][mode]
+        else:
+            connection = db.engine.raw_connection()
+            cursor = connection.cursor()
+            cursor.execute('''SELECT `destination`, `mode`.`name`, `mode`.`id`
+                              FROM `target`
+                              JOIN `target_contact` ON `target_contact`.`target_id` = `target`.`id`
+                              JOIN `mode` ON `mode`.`id` = `target_contact`.`mode_id`
+                              WHERE `target`.`name` = %s AND `mode`.`name` = %s''',
+                           (message['target'], target_fallback_mode))
+            [(destination, mode, mode_id)] = cursor
+            cursor.close()
+            connection.close()
 
         old_mode = message.get('mode', '')
         message['destination'] = destination
@@ -770,6 +1439,26 @@ def set_target_fallback_mode(message):
 
 
 def set_target_contact_by_priority(message):
+    result = None
+    if contact_index is not None:
+        result = contact_index.lookup_priority(message['target'], message['application'], message['priority_id'])
+    if result is not None:
+        destination, mode, mode_id = result
+    else:
+        destination, mode, mode_id = query_target_contact_by_priority(message)
+
+    if not destination and mode != 'drop':
+        logger.error('Did not find destination for message %s and mode is not drop', message)
+        return False
+
+    message['destination'] = destination
+    message['mode'] = mode
+    message['mode_id'] = mode_id
+
+    return True
+
+
+def query_target_contact_by_priority(message):
     session = db.Session()
     result = session.execute('''
               SELECT `target_contact`.`destination` AS dest, `mode`.`name` AS mode_name, `mode`.`id` AS mode_id
@@ -825,15 +1514,7 @@ def set_target_contact_by_priority(message):
     finally:
         session.close()
 
-    if not destination and mode != 'drop':
-        logger.error('Did not find destination for message %s and mode is not drop', message)
-        return False
-
-    message['destination'] = destination
-    message['mode'] = mode
-    message['mode_id'] = mode_id
-
-    return True
+    return destination, mode, mode_id
 
 
 def set_target_contact(message):
@@ -873,54 +1554,65 @@ def set_target_contact(message):
         if 'mode' in message or 'mode_id' in message:
             # for out of band notification, we already have the mode *OR*
             # mode_id set by API
-            connection = db.engine.raw_connection()
-            cursor = connection.cursor()
-            cursor.execute(destination_query, {'target': message['target'], 'mode_id': message.get('mode_id'), 'mode': message.get('mode')})
-            message['destination'] = cursor.fetchone()[0]
-            cursor.close()
-            connection.close()
+            destination = None
+            if contact_index is not None:
+                destination = contact_index.lookup_destination(message['target'], message.get('mode_id'), message.get('mode'))
+            if destination is None:
+                connection = db.engine.raw_connection()
+                cursor = connection.cursor()
+                cursor.execute(destination_query, {'target': message['target'], 'mode_id': message.get('mode_id'), 'mode': message.get('mode')})
+                destination = cursor.fetchone()[0]
+                cursor.close()
+                connection.close()
+            message['destination'] = destination
             result = True
         elif 'category' in message:
-            connection = db.engine.raw_connection()
-            cursor = connection.cursor()
-            # get user category overrides if they exist
-            cursor.execute('''
-                SELECT `mode`.`id`, `mode`.`name` FROM `category_override`
-                JOIN `target` ON `target`.`id` = `category_override`.`user_id`
-                JOIN `mode` ON `mode`.`id` = `category_override`.`mode_id`
-                WHERE `target`.`name` = %(target)s AND `category_override`.`category_id` = %(category_id)s
-                ''', {'target': message['target'], 'category_id': message['category_id']})
-            override_mode = cursor.fetchone()
-            if override_mode:
-                message['mode_id'] = override_mode[0]
-                message['mode'] = override_mode[1]
+            category_contact = None
+            if contact_index is not None:
+                category_contact = contact_index.lookup_category(message['target'], message['category_id'])
+            if category_contact is not None:
+                message['destination'], message['mode'], message['mode_id'] = category_contact
             else:
-                # use app default for category
+                connection = db.engine.raw_connection()
+                cursor = connection.cursor()
+                # get user category overrides if they exist
                 cursor.execute('''
-                SELECT `mode`.`id`, `mode`.`name` FROM `notification_category`
-                JOIN `mode` ON `mode`.`id` = `notification_category`.`mode_id`
-                WHERE `notification_category`.`id` = %(category_id)s
-                ''', {'category_id': message['category_id']})
+                    SELECT `mode`.`id`, `mode`.`name` FROM `category_override`
+                    JOIN `target` ON `target`.`id` = `category_override`.`user_id`
+                    JOIN `mode` ON `mode`.`id` = `category_override`.`mode_id`
+                    WHERE `target`.`name` = %(target)s AND `category_override`.`category_id` = %(category_id)s
+                    ''', {'target': message['target'], 'category_id': message['category_id']})
                 override_mode = cursor.fetchone()
-
                 if override_mode:
                     message['mode_id'] = override_mode[0]
                     message['mode'] = override_mode[1]
                 else:
-                    message['mode_id'] = message['category_mode_id']
-                    message['mode'] = message['category_mode']
-            cursor.execute('''
-                SELECT `destination` FROM `target_contact`
-                JOIN `target` ON `target`.`id` = `target_contact`.`target_id`
-                JOIN `target_type` on `target_type`.`id` = `target`.`type_id`
-                WHERE `target`.`name` = %(target)s
-                AND `target_type`.`name` = 'user'
-                AND `target_contact`.`mode_id` = %(mode_id)s
-                LIMIT 1
-                ''', {'target': message['target'], 'mode_id': message['mode_id']})
-            message['destination'] = cursor.fetchone()[0]
-            cursor.close()
-            connection.close()
+                    # use app default for category
+                    cursor.execute('''
+                    SELECT `mode`.`id`, `mode`.`name` FROM `notification_category`
+                    JOIN `mode` ON `mode`.`id` = `notification_category`.`mode_id`
+                    WHERE `notification_category`.`id` = %(category_id)s
+                    ''', {'category_id': message['category_id']})
+                    override_mode = cursor.fetchone()
+
+                    if override_mode:
+                        message['mode_id'] = override_mode[0]
+                        message['mode'] = override_mode[1]
+                    else:
+                        message['mode_id'] = message['category_mode_id']
+                        message['mode'] = message['category_mode']
+                cursor.execute('''
+                    SELECT `destination` FROM `target_contact`
+                    JOIN `target` ON `target`.`id` = `target_contact`.`target_id`
+                    JOIN `target_type` on `target_type`.`id` = `target`.`type_id`
+                    WHERE `target`.`name` = %(target)s
+                    AND `target_type`.`name` = 'user'
+                    AND `target_contact`.`mode_id` = %(mode_id)s
+                    LIMIT 1
+                    ''', {'target': message['target'], 'mode_id': message['mode_id']})
+                message['destination'] = cursor.fetchone()[0]
+                cursor.close()
+                connection.close()
             result = True
         else:
             # message triggered by incident will only have priority
@@ -936,6 +1628,12 @@ def set_target_contact(message):
         return set_target_fallback_mode(message)
 
 
+def render_template_part(message, template, mode_template, mode, part):
+    if cache.render_cache is not None:
+        return cache.render_cache.render(message, template, mode_template, mode, part)
+    return mode_template[part].render(**message['context'])
+
+
 def render(message):
     if not message.get('template'):
         if message.get('message_id'):
@@ -967,13 +1665,14 @@ def render(message):
                 application_template = template[message['application']]
                 try:
                     # When we want to "render" a dropped message, treat it as if it's an email
-                    mode_template = application_template['email' if message['mode'] == 'drop' else message['mode']]
+                    mode = 'email' if message['mode'] == 'drop' else message['mode']
+                    mode_template = application_template[mode]
                     try:
-                        message['subject'] = mode_template['subject'].render(**message['context'])
+                        message['subject'] = render_template_part(message, template, mode_template, mode, 'subject')
                     except Exception as e:
                         error = 'template %(template)s - %(application)s - %(mode)s - subject failed to render: ' + str(e)
                     try:
-                        message['body'] += mode_template['body'].render(**message['context'])
+                        message['body'] += render_template_part(message, template, mode_template, mode, 'body')
                     except Exception as e:
                         error = 'template %(template)s - %(application)s - %(mode)s - body failed to render: ' + str(e)
                     message['template_id'] = template['id']
@@ -1009,6 +1708,10 @@ def render(message):
 
 
 def mark_message_as_sent(message):
+    if write_behind is not None:
+        buffer_message_as_sent(message)
+        return
+
     connection = db.engine.raw_connection()
 
     params = [
@@ -1089,6 +1792,34 @@ def mark_message_as_sent(message):
     connection.close()
 
 
+def buffer_message_as_sent(message):
+    if not message['subject']:
+        message['subject'] = ''
+        logger.warning('Message id %s has blank subject', message.get('message_id', '?'))
+
+    if len(message['subject']) > 255:
+        message['subject'] = message['subject'][:255]
+
+    if len(message['body']) > MAX_MESSAGE_BODY_LENGTH:
+        logger.warning('Message id %s has a ridiculously long body (%s chars). Truncating it.',
+                       message.get('message_id', '?'), len(message['body']))
+        message['body'] = message['body'][:MAX_MESSAGE_BODY_LENGTH]
+
+    if 'aggregated_ids' in message:
+        message_ids = message['aggregated_ids']
+        batch_id = message['batch_id']
+    else:
+        message_ids = [message['message_id']]
+        batch_id = None
+
+    write_behind.mark_sent(message_ids, message['destination'], message['mode_id'], message.get('template_id'),
+                           batch_id, message['body'], message['subject'])
+
+    # Clean messages cache
+    for message_id in message_ids:
+        messages.pop(message_id, None)
+
+
 def update_message_sent_status(message, status):
     message_id = message.get('message_id')
     if not message_id:
@@ -1104,6 +1835,10 @@ def update_message_sent_status(message, status):
     if mode in ('sms', 'call'):
         return
 
+    if write_behind is not None:
+        write_behind.set_status(message_id, status)
+        return
+
     session = db.Session()
     retries = 0
     max_retries = 3
@@ -1160,13 +1895,39 @@ def mark_message_has_no_contact(message):
         'Ignore message as we failed to resolve target contact')
 
 
+def follower_candidates(message):
+    # The least loaded follower first, if we know, then the rest round robin
+    balanced = None
+    if rpc.follower_balancer is not None:
+        balanced = rpc.follower_balancer.choose(coordinator.follower_list, message.get('mode'))
+        if balanced is not None:
+            yield balanced
+    for address in coordinator.followers:
+        if address != balanced:
+            yield address
+
+
+def get_send_load():
+    load = {
+        'queues': {mode: len(send_queue) for mode, send_queue in per_mode_send_queues.items()},
+        'latency': mode_latency,
+    }
+    if worker_pool is not None:
+        # messages wait for their turn, and get sent and timed, in the worker processes
+        worker_load = worker_pool.load()
+        for mode, depth in worker_load['queues'].items():
+            load['queues'][mode] = load['queues'].get(mode, 0) + depth
+        load['latency'] = worker_load['latency']
+    return load
+
+
 def distributed_send_message(message, vendor_manager):
     # If I am the leader and this message isn't for a follower, attempt
     # sending my messages through my followers.
     if not message.get('to_follower') and coordinator.am_i_leader():
         try:
             if coordinator.follower_count and coordinator.followers:
-                for i, address in enumerate(coordinator.followers):
+                for i, address in enumerate(follower_candidates(message)):
                     if i >= coordinator.follower_count:
                         logger.error('Failed using all configured followers; resorting to local send_message')
                         break
@@ -1201,11 +1962,58 @@ def fetch_and_send_message(send_queue, vendor_manager):
 
     metrics.incr('send_queue_gets_cnt')
 
+    if overload_controller is not None and shed_overload(message):
+        return
+
+    done = send_queued_message(message, vendor_manager)
+
+    # In worker processes, let the parent sender know it can forget about this message
+    if done and worker_channel is not None:
+        message_id = message.get('message_id')
+        recheck = message_id in poll_recheck_ids
+        poll_recheck_ids.discard(message_id)
+        worker_channel.message_done(message, recheck)
+
+
+def drop_message_over_quota(message):
+    logger.warning('Hard message quota exceeded; Dropping this message on floor: %s', message)
+    drop_message(message, auditlog.MODE_CHANGE, 'Dropping due to hard quota violation.')
+
+
+def drop_message(message, change_type, description):
+    if message['message_id']:
+        spawn(auditlog.message_change,
+              message['message_id'], change_type, message.get('mode', '?'), 'drop', description)
+
+        # If we know the ID for the mode drop, reflect that for the message
+        drop_mode_id = api_cache.modes.get('drop')
+        if drop_mode_id:
+            message['mode'] = 'drop'
+            message['mode_id'] = drop_mode_id
+        else:
+            logger.error('Can\'t mark message %s as dropped as we don\'t know the mode ID for %s',
+                         message, 'drop')
+
+        # Render, so we're able to populate the message table with the
+        # proper subject/etc as well as information that it was dropped.
+        render(message)
+        mark_message_as_sent(message)
+
+
+def send_queued_message(message, vendor_manager):
+    '''
+    Returns False if the message was queued again to be retried, True if we're done with it.
+    '''
     retry_count = message.get('retry_count')
     is_retry = retry_count is not None
     if is_retry and retry_count >= MAX_MESSAGE_RETRIES:
         logger.warning('Maximum retry count for app: %s target:%s breached', message.get('application', '?'), message.get('target', '?'))
-        return
+        # the message is still active, so have the leader's next poll pick it up again
+        if message.get('message_id'):
+            message_ids_being_sent.discard(message['message_id'])
+            if not message.get('to_follower'):
+                poll_recheck_ids.add(message['message_id'])
+        return True
 
     if not is_retry:
         sanitize_unicode_dict(message)
@@ -1217,27 +2025,11 @@ def fetch_and_send_message(send_queue, vendor_manager):
 
     drop_mode_id = api_cache.modes.get('drop')
 
-    # If this app breaches hard quota, drop message on floor, and update in UI if it has an ID
-    if not is_retry and not message_to_follower and not quota.allow_send(message):
-        logger.warning('Hard message quota exceeded; Dropping this message on floor: %s', message)
-        if message['message_id']:
-            spawn(auditlog.message_change,
-                  message['message_id'], auditlog.MODE_CHANGE, message.get('mode', '?'), 'drop',
-                  'Dropping due to hard quota violation.')
-
-            # If we know the ID for the mode drop, reflect that for the message
-            if drop_mode_id:
-                message['mode'] = 'drop'
-                message['mode_id'] = drop_mode_id
-            else:
-                logger.error('Can\'t mark message %s as dropped as we don\'t know the mode ID for %s',
-                             message, 'drop')
-
-            # Render, so we're able to populate the message table with the
-            # proper subject/etc as well as information that it was dropped.
-            render(message)
-            mark_message_as_sent(message)
-        return
+    # If this app breaches hard quota, drop message on floor, and update in UI if it has an ID.
+    # Worker processes don't have a quota; their parent checks it before handing messages over.
+    if not is_retry and not message_to_follower and quota is not None and not quota.allow_send(message):
+        drop_message_over_quota(message)
+        return True
 
     # If we're set to drop this message, no-op this before message gets sent to a vendor
     if message.get('mode') == 'drop':
@@ -1250,7 +2042,7 @@ def fetch_and_send_message(send_queue, vendor_manager):
         metrics.add_new_metrics({metrics_key: 0})
         metrics.incr(metrics_key)
 
-        return
+        return True
 
     # Only render this message and validate its body/etc if it's not a retry, in which case this
     # step would have been done before
@@ -1282,10 +2074,11 @@ def fetch_and_send_message(send_queue, vendor_manager):
                 message['mode_id'] = drop_mode_id
 
             mark_message_as_sent(message)
-            return
+            return True
 
     success = False
     sent_locally = False
+    gave_up = False
     try:
         success, sent_locally = distributed_send_message(message, vendor_manager)
     except Exception:
@@ -1306,8 +2099,9 @@ def fetch_and_send_message(send_queue, vendor_manager):
                     logger.error('unable to send %s', message)
                     sent_locally = True
 
-    # Take it out of our list of active queued messages if it's there
-    if message['message_id']:
+    # Take it out of our list of active queued messages if it's there, unless it's
+    # waiting for its retry, so polls don't queue it again meanwhile
+    if message['message_id'] and (success or retry_scheduler is None):
         message_ids_being_sent.discard(message['message_id'])
 
     if success:
@@ -1321,9 +2115,20 @@ def fetch_and_send_message(send_queue, vendor_manager):
     else:
         # If we're not successful, try retrying it
         message['retry_count'] = message.get('retry_count', 0) + 1
-        message_send_enqueue(message)
-        metrics.incr('message_retry_cnt')
-        logger.info('Message %s failed. Re-queuing for retry (%s/%s).', message, message['retry_count'], MAX_MESSAGE_RETRIES)
+        if retry_scheduler is None:
+            message_send_enqueue(message)
+        elif not retry_scheduler.schedule(message):
+            logger.warning('Giving up retrying message %s, which first failed %s seconds ago',
+                           message['message_id'], retry_scheduler.max_age)
+            # the message is still active, so have the leader's next poll pick it up again
+            if message['message_id']:
+                message_ids_being_sent.discard(message['message_id'])
+                if not message_to_follower:
+                    poll_recheck_ids.add(message['message_id'])
+            gave_up = True
+        if not gave_up:
+            metrics.incr('message_retry_cnt')
+            logger.info('Message %s failed. Re-queuing for retry (%s/%s).', message, message['retry_count'], MAX_MESSAGE_RETRIES)
 
         if message_to_follower:
             metrics.incr('follower_message_send_fail_cnt')
@@ -1331,6 +2136,8 @@ def fetch_and_send_message(send_queue, vendor_manager):
     if message['message_id'] and sent_locally:
         update_message_sent_status(message, success)
 
+    return success or gave_up
+
 
 def worker(send_queue, worker_config, kill_set):
     vendor_manager = IrisVendorManager(worker_config.get('vendors', []), worker_config.get('applications', []))
@@ -1342,6 +2149,123 @@ def worker(send_queue, worker_config, kill_set):
             return
 
 
+def dispatch_to_workers(send_queue):
+    while True:
+        message = send_queue.get()
+
+        if overload_controller is not None and shed_overload(message):
+            continue
+
+        # Quota is checked here rather than in the worker processes so it applies to all
+        # of them together
+        if not message.get('retry_count') and not message.get('to_follower') and not quota.allow_send(message):
+            message.setdefault('message_id', None)
+            drop_message_over_quota(message)
+            message_ids_being_sent.discard(message['message_id'])
+            continue
+
+        worker_pool.submit(message)
+
+
+def new_send_queue(mode):
+    if send_queue_lanes is None:
+        send_queue = queue.Queue()
+    else:
+        # setting application weights implies queuing per application
+        per_application = bool(send_queue_lanes.get('per_application') or send_queue_lanes.get('application_weights'))
+        send_queue = LaneQueue(mode,
+                               send_queue_lanes.get('priorities', DEFAULT_PRIORITIES),
+                               send_queue_lanes.get('policy', 'strict'),
+                               send_queue_lanes.get('weights'),
+                               per_application,
+                               send_queue_lanes.get('application_weights'),
+                               send_queue_lanes.get('default_application_weight', 1))
+    if send_queue_spill is None:
+        return send_queue
+    # worker processes each spill to files of their own
+    prefix = 'worker%s_' % os.environ.get(WORKER_INDEX_ENV, '') if worker_channel is not None else ''
+    path = os.path.join(send_queue_spill.get('dir', '/tmp'), '%ssend_queue_%s.spill' % (prefix, mode))
+    return SpillQueue(send_queue, mode, path, send_queue_spill.get('max_size', 10000))
+
+
+def worker_message_done(message, recheck):
+    message_id = message.get('message_id')
+    if message_id:
+        message_ids_being_sent.discard(message_id)
+        if recheck:
+            poll_recheck_ids.add(message_id)
+
+
+def worker_message_lost(message):
+    # The worker process died before it was done with this message. If it has an ID, the
+    # next poll sends it again unless it was marked as sent. Otherwise, send it again now.
+    message_id = message.get('message_id')
+    if message_id:
+        message_ids_being_sent.discard(message_id)
+        poll_recheck_ids.add(message_id)
+    else:
+        per_mode_send_queues[message['mode']].put(message)
+
+
+def worker_enqueue(message):
+    # Messages from the parent sender already have their contact info set
+    message_id = message.get('message_id')
+    if message_id is not None:
+        message_ids_being_sent.add(message_id)
+    per_mode_send_queues[message['mode']].put(message)
+
+
+def worker_flush():
+    # Acks let the parent poll messages again, so make sure they're marked as sent first
+    if write_behind is not None:
+        write_behind.flush()
+
+
+def worker_process_main(config, worker_fd):
+    global worker_channel
+
+    # Worker processes only send messages. The parent sender does everything else.
+    config['sender'].update({
+        'zookeeper_cluster': False,
+        'is_leader': False,
+        'followers': [],
+        'contact_index': None,
+        'escalation_scheduler': False,
+        'overload_control': None,
+    })
+    worker_channel = WorkerChannel(worker_fd, worker_enqueue, worker_flush, get_load=get_send_load)
+
+    logger.info('[-] bootstraping sender worker process...')
+    init_sender(config)
+    spawn(update_api_cache_worker)
+    init_plugins(config.get('plugins', {}))
+
+    for mode in api_cache.modes:
+        per_mode_send_queues[mode] = new_send_queue(mode)
+
+    channel_task = spawn(worker_channel.run)
+    spawn(worker_channel.run_acks)
+    spawn(worker_channel.run_reports)
+    if write_behind is not None:
+        spawn(write_behind.run)
+    if auditlog.change_queue is not None:
+        spawn(auditlog.writer)
+    if retry_scheduler is not None:
+        spawn(retry_scheduler.run)
+
+    maintain_workers(config)
+
+    logger.info('[*] sender worker process bootstrapped')
+    while True:
+        worker_channel.closed.wait(60)
+        if worker_channel.closed.is_set():
+            logger.info('Parent sender went away (%s)', channel_task.exception)
+            sender_shutdown()
+        cache.refresh()
+        cache.purge()
+        maintain_workers(config)
+
+
 def maintain_workers(config):
     # We mangle this config dict a bit and pass it around. Avoid latering the main one
     config = copy.deepcopy(config)
@@ -1558,6 +2482,14 @@ def sender_shutdown():
     # Stop sender RPC server
     rpc.shutdown()
 
+    if ingest_pool is not None:
+        logger.info('Waiting for sender ingest processes to shut down')
+        ingest_pool.stop()
+
+    if worker_pool is not None:
+        logger.info('Waiting for sender worker processes to shut down')
+        worker_pool.stop()
+
     for tasks in worker_tasks.values():
         for task in tasks:
             task['kill_set'].set()
@@ -1576,6 +2508,24 @@ def sender_shutdown():
         for task in tasks:
             task['greenlet'].join()
 
+    if write_behind is not None:
+        logger.info('Flushing %s buffered message updates', len(write_behind))
+        try:
+            write_behind.flush()
+        except Exception:
+            logger.exception('Failed flushing buffered message updates')
+
+    if auditlog.change_queue is not None:
+        logger.info('Flushing %s buffered audit log changes', auditlog.change_queue.qsize())
+        try:
+            auditlog.flush()
+        except Exception:
+            logger.exception('Failed flushing buffered audit log changes')
+
+    # Worker processes leave the cache snapshot to the main sender
+    if cache.snapshot_path and worker_channel is None:
+        cache.save_snapshot()
+
     # Force quit. Avoid sender process existing longer than it needs to
     os._exit(0)
 
@@ -1602,15 +2552,18 @@ def modify_restricted_sms(message):
         destination = message['destination']
         message_id = message['message_id']
         mode_id = message['mode_id']
-        connection = db.engine.raw_connection()
-        cursor = connection.cursor()
         # only replace messages for users that have opted in
-        cursor.execute('''SELECT count(`mode_template_override`.`target_id`)
-            FROM `mode_template_override` JOIN `target_contact`
-            ON `mode_template_override`.`target_id` = `target_contact`.`target_id`
-            WHERE `target_contact`.`destination` = %s and `target_contact`.`mode_id` = %s''', (destination, mode_id))
-        result = cursor.fetchone()[0]
-        connection.close()
+        if contact_index is not None and contact_index.index:
+            result = contact_index.has_sms_override(destination, mode_id)
+        else:
+            connection = db.engine.raw_connection()
+            cursor = connection.cursor()
+            cursor.execute('''SELECT count(`mode_template_override`.`target_id`)
+                FROM `mode_template_override` JOIN `target_contact`
+                ON `mode_template_override`.`target_id` = `target_contact`.`target_id`
+                WHERE `target_contact`.`destination` = %s and `target_contact`.`mode_id` = %s''', (destination, mode_id))
+            result = cursor.fetchone()[0]
+            connection.close()
         if result:
             body_template = config.get('sms_override_template')
             message['body'] = body_template % message.get('incident_id')
@@ -1646,6 +2599,11 @@ def message_send_enqueue(message):
         if message['mode'] == 'sms':
             modify_restricted_sms(message)
 
+        if overload_controller is not None:
+            if shed_overload(message):
+                return
+            message.setdefault('queued', time.time())
+
         if message_id is not None:
             message_ids_being_sent.add(message_id)
         per_mode_send_queues[message_mode].put(message)
@@ -1655,6 +2613,26 @@ def message_send_enqueue(message):
         metrics.incr('send_queue_puts_fail_cnt')
 
 
+def shed_overload(message):
+    '''
+    Drops or defers message if the sender is overloaded. Returns whether it did.
+    '''
+    action = overload_controller.action(message)
+    if action is None:
+        return False
+    message.setdefault('message_id', None)
+    message_id = message['message_id']
+    message_ids_being_sent.discard(message_id)
+    if action == SHED:
+        logger.warning('Sender overloaded; Dropping message %s of %s priority', message_id, message.get('priority'))
+        drop_message(message, auditlog.OVERLOAD_CHANGE, 'Dropping while the sender is overloaded')
+    elif overload_controller.defer(message_id):
+        # left active in the DB until the sender recovers
+        spawn(auditlog.message_change, message_id, auditlog.OVERLOAD_CHANGE, message.get('mode', '?'), 'deferred',
+              'Deferring while the sender is overloaded')
+    return True
+
+
 def update_api_cache_worker():
     while True:
         logger.debug('Reinitializing cache')
@@ -1706,11 +2684,142 @@ def init_sender(config):
             'name': 'iris dummy vendor'
         }]
 
-    global quota
-    quota = ApplicationQuota(db, cache.targets_for_role, message_send_enqueue, config['sender'].get('sender_app'), config['sender'].get('default_rate_def', {}))
+    global escalate_batch_size
+    try:
+        escalate_batch_size = max(1, int(config['sender'].get('escalate_batch_size', escalate_batch_size)))
+    except ValueError:
+        logger.exception('Failed parsing escalate_batch_size in config')
+
+    global write_behind
+    write_behind_config = config['sender'].get('write_behind')
+    if write_behind_config:
+        if not isinstance(write_behind_config, dict):
+            write_behind_config = {}
+        write_behind = WriteBehindBuffer(db,
+                                         write_behind_config.get('flush_interval_ms', 500) / 1000.0,
+                                         write_behind_config.get('max_rows', 500),
+                                         write_behind_config.get('max_pending', 20000))
+        logger.info('Buffering message sent updates (flush every %ss or %s rows)',
+                    write_behind.flush_interval, write_behind.max_rows)
+
+    auditlog_buffer_config = config['sender'].get('auditlog_buffer')
+    if auditlog_buffer_config:
+        if not isinstance(auditlog_buffer_config, dict):
+            auditlog_buffer_config = {}
+        auditlog.init_buffer(auditlog_buffer_config.get('max_queue_size', 10000),
+                             auditlog_buffer_config.get('batch_size', 500),
+                             auditlog_buffer_config.get('put_timeout', 1))
+        logger.info('Buffering audit log writes')
+
+    global contact_index
+    contact_index_config = config['sender'].get('contact_index')
+    if contact_index_config:
+        if not isinstance(contact_index_config, dict):
+            contact_index_config = {}
+        contact_index = ContactIndex(db, contact_index_config.get('refresh_interval', 60))
+        try:
+            contact_index.refresh()
+        except Exception:
+            # lookups fall back to the DB until the next refresh works
+            logger.exception('Failed loading contact index')
+
+    global poll_full_scan_interval, poll_watermark_lag
+    try:
+        poll_full_scan_interval = int(config['sender'].get('poll_full_scan_interval', poll_full_scan_interval))
+    except ValueError:
+        logger.exception('Failed parsing poll_full_scan_interval in config')
+    try:
+        poll_watermark_lag = float(config['sender'].get('poll_watermark_lag', poll_watermark_lag))
+    except ValueError:
+        logger.exception('Failed parsing poll_watermark_lag in config')
+
+    global poll_wakeup_interval
+    try:
+        poll_wakeup_interval = float(config['sender'].get('poll_wakeup_interval', poll_wakeup_interval))
+    except ValueError:
+        logger.exception('Failed parsing poll_wakeup_interval in config')
+
+    global send_queue_lanes
+    send_queue_lanes = config['sender'].get('send_queue_lanes')
+    if send_queue_lanes:
+        if not isinstance(send_queue_lanes, dict):
+            send_queue_lanes = {}
+        logger.info('Using %s priority lanes in send queues', send_queue_lanes.get('policy', 'strict'))
+    else:
+        send_queue_lanes = None
+
+    global send_queue_spill
+    send_queue_spill = config['sender'].get('send_queue_spill')
+    if send_queue_spill:
+        if not isinstance(send_queue_spill, dict):
+            send_queue_spill = {}
+        logger.info('Spilling send queues over %s messages to disk', send_queue_spill.get('max_size', 10000))
+    else:
+        send_queue_spill = None
+
+    global max_held_messages
+    max_held_messages = config['sender'].get('max_held_messages')
+
+    global retry_scheduler
+    retry_config = config['sender'].get('retry_backoff')
+    if retry_config:
+        if not isinstance(retry_config, dict):
+            retry_config = {}
+        retry_scheduler = RetryScheduler(message_send_enqueue,
+                                         retry_config.get('base_delay', 1),
+                                         retry_config.get('max_delay', 60),
+                                         retry_config.get('multiplier', 2),
+                                         retry_config.get('jitter', 0.2),
+                                         retry_config.get('max_age', 600),
+                                         retry_config.get('modes'))
+        logger.info('Backing off retries of failed messages')
+
+    global overload_controller
+    overload_config = config['sender'].get('overload_control')
+    if overload_config:
+        if not isinstance(overload_config, dict):
+            overload_config = {}
+        overload_controller = OverloadController(per_mode_send_queues, poll_recheck_ids.update,
+                                                 overload_config.get('enter_depth', 5000),
+                                                 overload_config.get('exit_depth'),
+                                                 overload_config.get('enter_age', 300),
+                                                 overload_config.get('exit_age'),
+                                                 overload_config.get('rules'),
+                                                 overload_config.get('check_interval', 1))
+        logger.info('Shedding load past %s queued messages', overload_controller.enter_depth)
+
+    global aggregation_checkpoint
+    checkpoint_config = config['sender'].get('aggregation_checkpoint')
+    if checkpoint_config:
+        if not isinstance(checkpoint_config, dict):
+            checkpoint_config = {}
+        aggregation_checkpoint = AggregationCheckpoint(db if checkpoint_config.get('db', True) else None,
+                                                       checkpoint_config.get('path'),
+                                                       checkpoint_config.get('max_age', 600))
+        logger.info('Checkpointing aggregation state')
+
+    global escalation_scheduler
+    if config['sender'].get('escalation_scheduler'):
+        logger.info('Using in-memory escalation scheduler')
+        escalation_scheduler = EscalationScheduler()
 
-    global coordinator
+    global quota
+    if worker_channel is None:
+        quota = ApplicationQuota(db, cache.targets_for_role, message_send_enqueue, config['sender'].get('sender_app'), config['sender'].get('default_rate_def', {}))
+
+    global worker_pool
+    worker_processes = config['sender'].get('worker_processes')
+    if worker_processes and worker_channel is None:
+        worker_pool = WorkerProcessPool(int(worker_processes),
+                                        int(config['sender'].get('worker_process_max_outstanding', 1000)),
+                                        worker_message_done, worker_message_lost)
+        logger.info('Sending messages through %s worker processes', worker_processes)
+
+    global coordinator, partition_count
     zk_hosts = config['sender'].get('zookeeper_cluster', False)
+    partition_count = int(config['sender'].get('partitions') or 0)
+    if partition_count:
+        logger.info('Escalating incidents in %s partitions', partition_count)
 
     if zk_hosts:
         logger.info('Initializing coordinator with ZK: %s', zk_hosts)
@@ -1718,19 +2827,46 @@ def init_sender(config):
         coordinator = Coordinator(zk_hosts=zk_hosts,
                                   hostname=socket.gethostname(),
                                   port=config['sender'].get('port', 2321),
-                                  join_cluster=True)
+                                  join_cluster=True,
+                                  partitions=partition_count)
+    elif config['sender'].get('mysql_coordinator'):
+        logger.info('Initializing coordinator with MySQL locks')
+        from iris.coordinator.mysql import Coordinator
+        mysql_config = config['sender']['mysql_coordinator']
+        if not isinstance(mysql_config, dict):
+            mysql_config = {}
+        coordinator = Coordinator(db=db,
+                                  hostname=socket.gethostname(),
+                                  port=config['sender'].get('port', 2321),
+                                  join_cluster=True,
+                                  lock_name=mysql_config.get('lock_name', 'iris_sender_leader'),
+                                  heartbeat_interval=mysql_config.get('heartbeat_interval_ms', 500) / 1000.0,
+                                  failover_timeout=mysql_config.get('failover_timeout_ms', 2000) / 1000.0,
+                                  partitions=partition_count)
     else:
         logger.info('ZK cluster info not specified. Using leader status from config')
         from iris.coordinator.noncluster import Coordinator
         coordinator = Coordinator(is_leader=config['sender'].get('is_leader', True),
-                                  followers=config['sender'].get('followers', []))
+                                  followers=config['sender'].get('followers', []),
+                                  partitions=partition_count,
+                                  owned_partitions=config['sender'].get('owned_partitions'))
 
 
 def main():
     global config
     global shutdown_started
+    global aggregation_restore_needed
     config = load_config()
 
+    if os.environ.get(INGEST_FD_ENV):
+        ingest_process_main(config)
+        return
+
+    worker_fd = os.environ.get(WORKER_FD_ENV)
+    if worker_fd:
+        worker_process_main(config, int(worker_fd))
+        return
+
     start_time = time.time()
 
     logger.info('[-] bootstraping sender...')
@@ -1738,27 +2874,64 @@ def main():
     spawn(update_api_cache_worker)
     init_plugins(config.get('plugins', {}))
 
-    if not rpc.run(config['sender']):
+    global ingest_pool
+    ingest_processes = config['sender'].get('ingest_processes')
+    if ingest_processes:
+        # Bind the RPC port here and leave serving it to the ingest processes
+        listener = rpc.listen(config['sender'])
+        if not listener:
+            sender_shutdown()
+        ingest_pool = IngestProcessPool(int(ingest_processes), listener, message_send_enqueue, escalate_new_incident)
+    elif not rpc.run(config['sender']):
         sender_shutdown()
 
     for mode in api_cache.modes:
-        per_mode_send_queues[mode] = queue.Queue()
+        per_mode_send_queues[mode] = new_send_queue(mode)
 
     rpc.init(config['sender'], dict(
-        message_send_enqueue=message_send_enqueue
+        message_send_enqueue=message_send_enqueue,
+        escalate_new_incident=escalate_new_incident,
+        get_load=get_send_load
     ))
+    if ingest_pool is not None:
+        logger.info('Serving RPC from %s ingest processes', ingest_processes)
+        ingest_pool.start()
+        spawn(ingest_pool.run_load_reports, get_send_load)
 
     spawn(coordinator.update_forever)
     spawn(log_sender_leader)
     send_task = spawn(send)
-
-    maintain_workers(config)
+    incident_wakeup_task = spawn(incident_wakeup_worker)
+    poll_wakeup_task = spawn(poll_wakeup_worker)
+    if write_behind is not None:
+        write_behind_task = spawn(write_behind.run)
+    if auditlog.change_queue is not None:
+        auditlog_task = spawn(auditlog.writer)
+    if contact_index is not None:
+        spawn(contact_index.run)
+    if overload_controller is not None:
+        spawn(overload_controller.run)
+    if retry_scheduler is not None:
+        spawn(retry_scheduler.run)
+
+    if worker_pool is not None:
+        worker_pool.start()
+        dispatch_tasks = {mode: spawn(dispatch_to_workers, send_queue) for mode, send_queue in per_mode_send_queues.items()}
+    else:
+        maintain_workers(config)
 
     disable_gwatch_renewer = config['sender'].get('disable_gwatch_renewer', False)
     gwatch_renewer_task = None
     prune_audit_logs_task = None
 
     interval = 60
+
+    if escalation_scheduler is not None:
+        spawn(escalation_timer, interval)
+
+    if partition_count:
+        spawn(partition_updater)
+
     logger.info('[*] sender bootstrapped')
     while True:
 
@@ -1775,6 +2948,7 @@ def main():
 
         cache.refresh()
         cache.purge()
+        cache.maybe_save_snapshot()
 
         # If we're currently a leader, ensure our leader-greenlets are running
         # and we're doing the leader duties
@@ -1788,15 +2962,6 @@ def main():
             if not bool(prune_audit_logs_task):
                 prune_audit_logs_task = spawn(prune_old_audit_logs_worker)
 
-            try:
-                escalate()
-                deactivate()
-                poll()
-                aggregate(runtime)
-            except Exception:
-                metrics.incr('task_failure')
-                logger.exception("Exception occured in main loop.")
-
         # If we're not leader, don't do the leader tasks and make sure those other
         # greenlets are stopped if they're running
         else:
@@ -1813,18 +2978,90 @@ def main():
                 logger.info('I am not leader anymore so stopping the audit logs worker')
                 prune_audit_logs_task.kill()
 
+        # Let go of connections to followers that left, or all of them if we aren't leader
+        rpc.prune_followers(coordinator.follower_list if coordinator.am_i_leader() else [])
+
+        # With partitions, every sender escalates the incidents in the partitions it
+        # owns; otherwise the leader escalates all of them
+        if partition_count:
+            update_escalation_partitions()
+
+        if owns_escalation():
+            try:
+                with escalation_lock:
+                    if escalation_scheduler is not None and not escalation_scheduler.seeded:
+                        seed_escalation_scheduler()
+                    escalate()
+                deactivate()
+                if aggregation_checkpoint is not None and aggregation_restore_needed:
+                    restore_aggregation_state()
+                    aggregation_restore_needed = False
+                with poll_lock:
+                    poll()
+                aggregate(runtime)
+                if aggregation_checkpoint is not None:
+                    checkpoint_aggregation_state(time.time())
+            except Exception:
+                metrics.incr('task_failure')
+                logger.exception("Exception occured in main loop.")
+        else:
+            # Pick up where the sender escalating meanwhile left off
+            aggregation_restore_needed = True
+
+            # Seed again from the DB if we escalate incidents later on
+            if escalation_scheduler is not None and escalation_scheduler.seeded:
+                escalation_scheduler.clear()
+
+            # Start from a full scan of active messages if we escalate incidents later on
+            if poll_watermark is not None:
+                with poll_lock:
+                    reset_poll()
+
         # check status for all background greenlets and respawn if necessary
         if not bool(send_task):
             logger.error("send task failed, %s", send_task.exception)
             metrics.incr('task_failure')
             send_task = spawn(send)
 
+        if not bool(incident_wakeup_task):
+            logger.error("incident wakeup task failed, %s", incident_wakeup_task.exception)
+            metrics.incr('task_failure')
+            incident_wakeup_task = spawn(incident_wakeup_worker)
+
+        if not bool(poll_wakeup_task):
+            logger.error("poll wakeup task failed, %s", poll_wakeup_task.exception)
+            metrics.incr('task_failure')
+            poll_wakeup_task = spawn(poll_wakeup_worker)
+
+        if write_behind is not None and not bool(write_behind_task):
+            logger.error("write behind task failed, %s", write_behind_task.exception)
+            metrics.incr('task_failure')
+            write_behind_task = spawn(write_behind.run)
+
+        if auditlog.change_queue is not None and not bool(auditlog_task):
+            logger.error("auditlog writer task failed, %s", auditlog_task.exception)
+            metrics.incr('task_failure')
+            auditlog_task = spawn(auditlog.writer)
+
         for mode, send_queue in per_mode_send_queues.items():
 
             # Set metric for size of worker queue
             metrics.set('send_queue_%s_size' % mode, len(send_queue))
+            if send_queue_lanes is not None or send_queue_spill is not None:
+                send_queue.update_metrics()
 
-        maintain_workers(config)
+        if worker_pool is not None:
+            for mode, task in dispatch_tasks.items():
+                if not bool(task):
+                    logger.error("dispatch task for mode %s failed, %s", mode, task.exception)
+                    metrics.incr('task_failure')
+                    dispatch_tasks[mode] = spawn(dispatch_to_workers, per_mode_send_queues[mode])
+            worker_pool.maintain()
+        else:
+            maintain_workers(config)
+
+        if ingest_pool is not None:
+            ingest_pool.maintain()
 
         now = time.time()
         metrics.set('sender_uptime', int(now - start_time))
@@ -0,0 +1,10 @@
+def assign_partitions(members, me, partition_count):
+    '''
+    Partitions of the incident id space member me should escalate, spreading
+    partition_count partitions evenly over the sorted member list.
+    '''
+    members = sorted(members)
+    if me not in members:
+        return frozenset()
+    index = members.index(me)
+    return frozenset(partition for partition in range(partition_count) if partition % len(members) == index)
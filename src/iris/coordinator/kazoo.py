@@ -7,22 +7,55 @@ from kazoo.recipe.party import Party
 import kazoo.exceptions
 import logging
 from iris import metrics
-from gevent import sleep
+from gevent.event import Event
 from itertools import cycle
+from . import assign_partitions
 
 logger = logging.getLogger(__name__)
 
+# How often we check in while things are unsettled, eg ZK being down or partitions
+# waiting for their previous owner to let go of them
 UPDATE_FREQUENCY = 3
 
+# Otherwise watches on the leader lock and the party wake us up when they change,
+# and this is only how often we check in regardless
+RESYNC_INTERVAL = 60
+
+LEADER_PATH = '/iris/sender_leader'
+NODES_PATH = '/iris/sender_nodes'
+
+# Ephemeral nodes here say which sender escalates which partition of incident ids
+PARTITIONS_PATH = '/iris/sender_partitions'
+
 
 class Coordinator(object):
-    def __init__(self, zk_hosts, hostname, port, join_cluster):
+    def __init__(self, zk_hosts, hostname, port, join_cluster, partitions=0):
         self.me = '%s:%s' % (hostname, port)
         self.is_leader = None
+        self.partition_count = partitions
+        self.partitions = frozenset()
+        self.assigned_partitions = frozenset()
+        # Partitions that aren't ours anymore, which we keep holding until the sender
+        # says it stopped escalating them, so their new owner doesn't start too early
+        self.releasing = frozenset()
+        self.stopped = set()
         self.followers = cycle([])
+        self.follower_list = []
         self.follower_count = 0
+        self.follower_members = None
+        self.partition_members = None
         self.started_shutdown = False
 
+        # Children of the leader lock and party nodes, set by watches when they
+        # change, and the data of those children, read once per child as it shows up.
+        # None if we're not watching them.
+        self.lock_children = None
+        self.member_children = None
+        self.lock_nodes = {}
+        self.members = {}
+        self.watching = False
+        self.changed = Event()
+
         if join_cluster:
             read_only = False
         else:
@@ -32,22 +65,74 @@ class Coordinator(object):
         event = self.zk.start_async()
         event.wait(timeout=5)
 
-        self.lock = self.zk.Lock(path='/iris/sender_leader', identifier=self.me)
+        self.lock = self.zk.Lock(path=LEADER_PATH, identifier=self.me)
 
         # Used to keep track of followers / senders present in cluster
-        self.party = Party(client=self.zk, path='/iris/sender_nodes', identifier=self.me)
+        self.party = self.zk.Party(NODES_PATH, self.me)
 
+        self.join_cluster = join_cluster
         if join_cluster:
             self.zk.add_listener(self.event_listener)
             self.party.join()
+        self.watch_children()
 
     def am_i_leader(self):
         return self.is_leader
 
+    def watch_children(self):
+        try:
+            if self.join_cluster:
+                self.zk.ensure_path(LEADER_PATH)
+                self.zk.ensure_path(NODES_PATH)
+            self.zk.ChildrenWatch(LEADER_PATH, self.on_lock_children)
+            self.zk.ChildrenWatch(NODES_PATH, self.on_member_children)
+        except kazoo.exceptions.KazooException:
+            logger.exception('Failed watching sender membership. Reading it from ZK instead')
+            return
+        self.watching = True
+
+    def on_lock_children(self, children):
+        self.lock_children = children
+        self.changed.set()
+
+    def on_member_children(self, children):
+        self.member_children = [child for child in children if Party._NODE_NAME in child]
+        self.changed.set()
+
+    def read_nodes(self, path, children, cached):
+        '''
+        Data of path's children, reusing what we've read before. Lock and party nodes
+        get unique names and are never updated, so a child's data never changes.
+        '''
+        nodes = {}
+        for child in children:
+            if child in cached:
+                nodes[child] = cached[child]
+                continue
+            try:
+                data, _ = self.zk.get('%s/%s' % (path, child))
+            except kazoo.exceptions.NoNodeError:
+                continue
+            nodes[child] = data.decode('utf-8')
+        return nodes
+
+    def get_contenders(self):
+        if self.lock_children is None:
+            return self.lock.contenders()
+        self.lock_nodes = self.read_nodes(LEADER_PATH, self.lock_children, self.lock_nodes)
+        # in lock order, by the sequence number lock nodes end with
+        return [self.lock_nodes[child] for child in sorted(self.lock_nodes, key=lambda child: child[-10:])]
+
+    def get_members(self):
+        if self.member_children is None:
+            return sorted(self.party)
+        self.members = self.read_nodes(NODES_PATH, self.member_children, self.members)
+        return sorted(self.members.values())
+
     # Used for API to get the current leader
     def get_current_leader(self):
         try:
-            contenders = self.lock.contenders()
+            contenders = self.get_contenders()
         except kazoo.exceptions.KazooException:
             logger.exception('Failed getting contenders')
             return None
@@ -59,7 +144,90 @@ class Coordinator(object):
 
     # Used for API to get the current followers if leader can't be reached
     def get_current_followers(self):
-        return [self.address_to_tuple(host) for host in self.party]
+        return [self.address_to_tuple(host) for host in self.get_members()]
+
+    def get_partitions(self):
+        return self.partitions if self.partition_count else None
+
+    def stopped_escalating(self, partitions):
+        '''
+        Called by the sender with the partitions it isn't escalating anymore, for us to
+        release the ones we're holding on to.
+        '''
+        stopped = self.releasing & frozenset(partitions)
+        if stopped - self.stopped:
+            self.stopped.update(stopped)
+            self.changed.set()
+
+    # Used for API to tell the sender escalating an incident about it
+    def get_partition_owner(self, partition):
+        try:
+            owner, _ = self.zk.get('%s/%s' % (PARTITIONS_PATH, partition))
+        except kazoo.exceptions.NoNodeError:
+            return None
+        except kazoo.exceptions.KazooException:
+            logger.exception('Failed getting owner of partition %s', partition)
+            return None
+        return self.address_to_tuple(owner.decode('utf-8'))
+
+    def update_partitions(self):
+        '''
+        Claim the partitions assigned to us given the current party, and release the
+        ones that aren't anymore so their new owner can claim them, once the sender
+        stopped escalating them.
+        '''
+        if self.zk.state != KazooState.CONNECTED:
+            self.partitions = self.releasing = frozenset()
+            return
+
+        try:
+            members = self.get_members()
+        except kazoo.exceptions.KazooException:
+            logger.exception('ZK problem while getting party members')
+            self.partitions = self.releasing = frozenset()
+            return
+
+        assigned = assign_partitions(members, self.me, self.partition_count)
+        self.assigned_partitions = assigned
+        if members == self.partition_members and assigned == self.partitions and not self.releasing:
+            return
+        self.partition_members = members
+
+        owned = set()
+        releasing = set()
+        for partition in range(self.partition_count):
+            path = '%s/%s' % (PARTITIONS_PATH, partition)
+            try:
+                if partition in assigned:
+                    try:
+                        self.zk.create(path, self.me.encode('utf-8'), ephemeral=True, makepath=True)
+                        owned.add(partition)
+                    except kazoo.exceptions.NodeExistsError:
+                        # still held by its previous owner, or by us already
+                        owner, _ = self.zk.get(path)
+                        if owner.decode('utf-8') == self.me:
+                            owned.add(partition)
+                elif partition in self.stopped:
+                    self.release_partition(path)
+                elif partition in self.partitions or partition in self.releasing:
+                    releasing.add(partition)
+            except kazoo.exceptions.NoNodeError:
+                pass
+            except kazoo.exceptions.KazooException:
+                logger.exception('ZK problem while claiming partition %s', partition)
+                if partition in self.releasing:
+                    releasing.add(partition)
+
+        if owned != self.partitions:
+            logger.info('Escalating partitions %s of %s', sorted(owned), self.partition_count)
+        self.partitions = frozenset(owned)
+        self.releasing = frozenset(releasing)
+        self.stopped &= releasing
+
+    def release_partition(self, path):
+        owner, stat = self.zk.get(path)
+        if owner.decode('utf-8') == self.me:
+            self.zk.delete(path, version=stat.version)
 
     def address_to_tuple(self, address):
         try:
@@ -74,11 +242,19 @@ class Coordinator(object):
             return
 
         if self.zk.state == KazooState.CONNECTED:
+            if not self.watching:
+                self.watch_children()
+
             if self.lock.is_acquired:
                 self.is_leader = True
             else:
                 try:
-                    self.is_leader = self.lock.acquire(blocking=False, timeout=2)
+                    # Only go for the lock when nobody holds it. The watch on it tells
+                    # us when that happens.
+                    if self.get_contenders():
+                        self.is_leader = False
+                    else:
+                        self.is_leader = self.lock.acquire(blocking=False, timeout=2)
 
                 # This one is expected when we're recovering from ZK being down
                 except kazoo.exceptions.CancelledError:
@@ -98,12 +274,23 @@ class Coordinator(object):
         if self.zk.state == KazooState.CONNECTED:
 
             if self.is_leader:
-                followers = [self.address_to_tuple(host) for host in self.party if host != self.me]
-                self.follower_count = len(followers)
-                self.followers = cycle(followers)
+                try:
+                    members = self.get_members()
+                except kazoo.exceptions.KazooException:
+                    logger.exception('ZK problem while getting party members')
+                    members = self.follower_members or []
+                # keep going round robin where we were unless the followers changed
+                if members != self.follower_members:
+                    followers = [self.address_to_tuple(host) for host in members if host != self.me]
+                    self.follower_count = len(followers)
+                    self.follower_list = followers
+                    self.followers = cycle(followers)
+                    self.follower_members = members
             else:
                 self.followers = cycle([])
+                self.follower_list = []
                 self.follower_count = 0
+                self.follower_members = None
 
             # Keep us as part of the party, so the current leader sees us as a follower
             if not self.party.participating:
@@ -113,7 +300,17 @@ class Coordinator(object):
                     logger.exception('ZK problem while trying to join party')
         else:
             self.followers = cycle([])
+            self.follower_list = []
             self.follower_count = 0
+            self.follower_members = None
+
+        if self.partition_count:
+            self.update_partitions()
+
+    def settled(self):
+        if self.zk.state != KazooState.CONNECTED or self.is_leader is None or not self.party.participating:
+            return False
+        return not self.partition_count or (self.partitions == self.assigned_partitions and not self.releasing)
 
     def update_forever(self):
         while True:
@@ -121,6 +318,7 @@ class Coordinator(object):
                 return
 
             old_status = self.is_leader
+            self.changed.clear()
             self.update_status()
             new_status = self.is_leader
 
@@ -136,11 +334,14 @@ class Coordinator(object):
 
             metrics.set('follower_instance_count', self.follower_count)
             metrics.set('is_leader_sender', int(self.is_leader is True))
+            if self.partition_count:
+                metrics.set('sender_partition_cnt', len(self.partitions))
 
-            sleep(UPDATE_FREQUENCY)
+            self.changed.wait(RESYNC_INTERVAL if self.settled() else UPDATE_FREQUENCY)
 
     def leave_cluster(self):
         self.started_shutdown = True
+        self.changed.set()
 
         # cancel any attempts to acquire leader lock which could make us hang
         self.lock.cancel()
@@ -152,6 +353,12 @@ class Coordinator(object):
             if self.lock and self.lock.is_acquired:
                 logger.info('Releasing lock')
                 self.lock.release()
+            for partition in self.partitions | self.releasing:
+                try:
+                    self.release_partition('%s/%s' % (PARTITIONS_PATH, partition))
+                except kazoo.exceptions.KazooException:
+                    logger.exception('Failed releasing partition %s', partition)
+        self.partitions = self.releasing = frozenset()
 
         # Make us not the leader
         self.is_leader = False
@@ -160,6 +367,9 @@ class Coordinator(object):
         metrics.set('is_leader_sender', 0)
 
     def event_listener(self, state):
+        # update right away, eg to go for the lock again once we're back
+        self.changed.set()
+
         if state == KazooState.LOST or state == KazooState.SUSPENDED:
             logger.info('ZK state transitioned to %s. Resetting leader status.', state)
 
@@ -175,5 +385,7 @@ class Coordinator(object):
             if self.party.participating:
                 self.party.participating = False
 
-            # in the meantime we're not leader
+            # in the meantime we're not leader, and don't own any partitions
             self.is_leader = None
+            self.partitions = self.releasing = frozenset()
+            self.partition_members = None
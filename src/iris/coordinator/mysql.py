@@ -0,0 +1,309 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Leader election through MySQL named locks, for deployments without ZooKeeper.
+# The leader holds GET_LOCK() on a connection of its own. Every sender heartbeats
+# into the sender_heartbeat table along with the id of that connection, so the
+# others can tell who holds the lock and whether it's still alive. A leader whose
+# heartbeat goes stale gets its connection killed, which releases the lock.
+
+import logging
+from iris import metrics
+from gevent import sleep
+from itertools import cycle
+from time import time
+from . import assign_partitions
+
+logger = logging.getLogger(__name__)
+
+HEARTBEAT_SQL = '''INSERT INTO `sender_heartbeat` (`address`, `connection_id`, `updated`)
+VALUES (%s, CONNECTION_ID(), NOW(6))
+ON DUPLICATE KEY UPDATE `connection_id` = CONNECTION_ID(), `updated` = NOW(6)'''
+
+LIVE_SENDERS_SQL = '''SELECT `address`, `connection_id` FROM `sender_heartbeat`
+WHERE `updated` > NOW(6) - INTERVAL %s MICROSECOND'''
+
+HOLDER_SQL = '''SELECT `address`, TIMESTAMPDIFF(MICROSECOND, `updated`, NOW(6)) / 1000000
+FROM `sender_heartbeat` WHERE `connection_id` = IS_USED_LOCK(%s)'''
+
+PRUNE_HEARTBEATS_SQL = '''DELETE FROM `sender_heartbeat` WHERE `updated` < NOW() - INTERVAL 1 DAY'''
+
+
+class Coordinator(object):
+    '''
+    Same interface as the kazoo coordinator. Each update takes a few queries, every
+    heartbeat_interval seconds; a leader that stops heartbeating is replaced after
+    failover_timeout seconds.
+
+    All senders and the API need to talk to the same MySQL server, as connection ids
+    are only unique within one, with the same user, so they can kill each other's
+    connections.
+    '''
+
+    def __init__(self, db, hostname, port, join_cluster, lock_name='iris_sender_leader',
+                 heartbeat_interval=0.5, failover_timeout=2, partitions=0):
+        self.db = db
+        self.me = '%s:%s' % (hostname, port)
+        self.join_cluster = join_cluster
+        self.lock_name = lock_name
+        self.heartbeat_interval = heartbeat_interval
+        self.failover_timeout = failover_timeout
+        self.is_leader = None
+        self.partition_count = partitions
+        self.partitions = frozenset()
+        # Partitions that aren't ours anymore, which we keep holding until the sender
+        # says it stopped escalating them, so their new owner doesn't start too early
+        self.releasing = frozenset()
+        self.stopped = set()
+        self.followers = cycle([])
+        self.follower_list = []
+        self.follower_members = None
+        self.follower_count = 0
+        self.started_shutdown = False
+        self.last_prune = 0
+        # Named locks belong to the session that took them, so we keep this one
+        # connection around for as long as we hold them
+        self.connection = None
+
+    def am_i_leader(self):
+        return self.is_leader
+
+    def partition_lock(self, partition):
+        return '%s_partition_%s' % (self.lock_name, partition)
+
+    def query(self, sql, args=None):
+        connection = self.db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(sql, args)
+            rows = cursor.fetchall()
+            cursor.close()
+            return rows
+        finally:
+            connection.close()
+
+    def holder(self, lock_name):
+        '''
+        Address of the sender holding lock_name, and how many seconds ago it last
+        heartbeated. (None, None) if nobody does.
+        '''
+        rows = self.query(HOLDER_SQL, (lock_name, ))
+        if not rows:
+            return None, None
+        address, age = rows[0]
+        return address, float(age)
+
+    # Used for API to get the current leader
+    def get_current_leader(self):
+        try:
+            address, age = self.holder(self.lock_name)
+        except Exception:
+            logger.exception('Failed getting current leader')
+            return None
+        # about to be replaced, so leave it to the caller's fallback
+        if address is None or age > self.failover_timeout:
+            return None
+        return self.address_to_tuple(address)
+
+    # Used for API to get the current followers if leader can't be reached
+    def get_current_followers(self):
+        return [self.address_to_tuple(address) for address in self.get_members()]
+
+    def get_members(self):
+        return sorted(address for address, _ in self.query(LIVE_SENDERS_SQL, (int(self.failover_timeout * 1000000), )))
+
+    def get_partitions(self):
+        return self.partitions if self.partition_count else None
+
+    def stopped_escalating(self, partitions):
+        '''
+        Called by the sender with the partitions it isn't escalating anymore, for us to
+        release the ones we're holding on to on our next update.
+        '''
+        self.stopped.update(self.releasing & frozenset(partitions))
+
+    # Used for API to tell the sender escalating an incident about it
+    def get_partition_owner(self, partition):
+        try:
+            address, _ = self.holder(self.partition_lock(partition))
+        except Exception:
+            logger.exception('Failed getting owner of partition %s', partition)
+            return None
+        return self.address_to_tuple(address) if address else None
+
+    def address_to_tuple(self, address):
+        try:
+            host, port = address.split(':')
+            return host, int(port)
+        except (IndexError, ValueError):
+            logger.error('Failed getting address tuple from %s', address)
+            return None
+
+    def connect(self):
+        # Out of the pool, so closing it really ends the session and drops our locks,
+        # and no other query ever runs on a connection peers may kill
+        connection = self.db.engine.raw_connection()
+        connection.detach()
+        connection.autocommit(True)
+        return connection
+
+    def execute(self, sql, args=None):
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(sql, args)
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+
+    def take_lock(self, lock_name):
+        '''
+        Try for lock_name on our connection, without waiting. If it's held by a sender
+        that stopped heartbeating, kill its connection so we get it next time.
+        '''
+        [(acquired, )] = self.execute('SELECT GET_LOCK(%s, 0)', (lock_name, ))
+        if acquired == 1:
+            return True
+        [(holder_id, )] = self.execute('SELECT IS_USED_LOCK(%s)', (lock_name, ))
+        if holder_id is None:
+            return False
+        rows = self.execute('SELECT TIMESTAMPDIFF(MICROSECOND, `updated`, NOW(6)) / 1000000 '
+                            'FROM `sender_heartbeat` WHERE `connection_id` = %s', (holder_id, ))
+        age = float(rows[0][0]) if rows else None
+        if age is None or age > self.failover_timeout:
+            logger.warning('Holder of %s (connection %s) last heartbeated %s seconds ago. Killing its connection',
+                           lock_name, holder_id, age)
+            try:
+                self.execute('KILL %s' % int(holder_id))
+            except Exception:
+                logger.exception('Failed killing connection %s', holder_id)
+        return False
+
+    def update_status(self):
+        if self.started_shutdown:
+            return
+
+        try:
+            if self.connection is None:
+                self.connection = self.connect()
+                # held locks are gone with the connection we had before
+                self.is_leader = False
+                self.partitions = self.releasing = frozenset()
+            self.execute(HEARTBEAT_SQL, (self.me, ))
+
+            if self.is_leader:
+                [(holder_id, connection_id)] = self.execute('SELECT IS_USED_LOCK(%s), CONNECTION_ID()', (self.lock_name, ))
+                self.is_leader = holder_id == connection_id
+            else:
+                self.is_leader = self.take_lock(self.lock_name)
+
+            members = self.get_members()
+            if self.partition_count:
+                self.update_partitions(members)
+        except Exception:
+            logger.exception('Failed updating sender status through MySQL')
+            self.reset_connection()
+            members = []
+
+        if self.is_leader:
+            if members != self.follower_members:
+                followers = [self.address_to_tuple(address) for address in members if address != self.me]
+                self.follower_count = len(followers)
+                self.follower_list = followers
+                self.followers = cycle(followers)
+                self.follower_members = members
+        else:
+            self.followers = cycle([])
+            self.follower_list = []
+            self.follower_count = 0
+            self.follower_members = None
+
+    def update_partitions(self, members):
+        assigned = assign_partitions(members, self.me, self.partition_count)
+        owned = set()
+        releasing = set()
+        for partition in range(self.partition_count):
+            lock_name = self.partition_lock(partition)
+            held = partition in self.partitions or partition in self.releasing
+            if partition in assigned:
+                if held or self.take_lock(lock_name):
+                    owned.add(partition)
+            elif held:
+                if partition in self.stopped:
+                    self.execute('SELECT RELEASE_LOCK(%s)', (lock_name, ))
+                else:
+                    releasing.add(partition)
+        if owned != self.partitions:
+            logger.info('Escalating partitions %s of %s', sorted(owned), self.partition_count)
+        self.partitions = frozenset(owned)
+        self.releasing = frozenset(releasing)
+        self.stopped &= releasing
+
+    def reset_connection(self):
+        # The server drops our locks along with the connection
+        self.is_leader = False
+        self.partitions = self.releasing = frozenset()
+        if self.connection is not None:
+            try:
+                self.connection.close()
+            except Exception:
+                logger.exception('Failed closing lock connection')
+            self.connection = None
+
+    def prune_heartbeats(self):
+        connection = self.db.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            cursor.execute(PRUNE_HEARTBEATS_SQL)
+            connection.commit()
+            cursor.close()
+        except Exception:
+            logger.exception('Failed pruning old sender heartbeats')
+        finally:
+            connection.close()
+
+    def update_forever(self):
+        while True:
+            if self.started_shutdown:
+                return
+
+            old_status = self.is_leader
+            self.update_status()
+            new_status = self.is_leader
+
+            if old_status != new_status:
+                log = logger.info
+            else:
+                log = logger.debug
+
+            if self.is_leader:
+                log('I am the leader sender')
+                if time() - self.last_prune > 3600:
+                    self.prune_heartbeats()
+                    self.last_prune = time()
+            else:
+                log('I am a follower sender')
+
+            metrics.set('follower_instance_count', self.follower_count)
+            metrics.set('is_leader_sender', int(self.is_leader is True))
+            if self.partition_count:
+                metrics.set('sender_partition_cnt', len(self.partitions))
+
+            sleep(self.heartbeat_interval)
+
+    def leave_cluster(self):
+        self.started_shutdown = True
+
+        if self.connection is not None:
+            try:
+                logger.info('Releasing locks')
+                self.execute('SELECT RELEASE_ALL_LOCKS()')
+                self.execute('DELETE FROM `sender_heartbeat` WHERE `address` = %s', (self.me, ))
+            except Exception:
+                logger.exception('Failed releasing locks')
+            self.reset_connection()
+
+        # Make us not the leader
+        self.is_leader = False
+
+        # Avoid sending metrics that we are still the leader when we're not
+        metrics.set('is_leader_sender', 0)
@@ -7,16 +7,22 @@ logger = logging.getLogger(__name__)
 
 
 class Coordinator():
-    def __init__(self, is_leader, followers=[]):
+    def __init__(self, is_leader, followers=[], partitions=0, owned_partitions=None):
         self.is_leader = is_leader
         if is_leader:
             logger.info('I am the leader sender')
         else:
             logger.info('I am a follower sender')
 
-        self.followers = cycle((follower['host'], follower['port']) for follower in followers)
+        self.follower_list = [(follower['host'], follower['port']) for follower in followers]
+        self.followers = cycle(self.follower_list)
         self.follower_count = len(followers)
 
+        # Without ZK, we escalate the configured partitions, or all of them
+        self.partition_count = partitions
+        self.partitions = frozenset(range(partitions) if owned_partitions is None else owned_partitions)
+        self.releasing = frozenset()
+
     def update_forever(self):
         pass
 
@@ -28,3 +34,12 @@ class Coordinator():
 
     def get_current_leader(self):
         return None
+
+    def get_partitions(self):
+        return self.partitions if self.partition_count else None
+
+    def get_partition_owner(self, partition):
+        return None
+
+    def stopped_escalating(self, partitions):
+        pass
@@ -8,6 +8,8 @@ logger = logging.getLogger(__name__)
 
 stats_reset = {}
 stats = {}
+# keys ever given with set(), as opposed to counted up with incr()
+gauges = set()
 
 metrics_provider = None
 
@@ -52,4 +54,5 @@ def incr(key, inc=1):
 
 
 def set(key, value):
+    gauges.add(key)
     stats[key] = value
@@ -2,7 +2,9 @@
 # See LICENSE in the project root for license information.
 
 from .. import db
-from gevent import sleep
+from .. import metrics
+from gevent import sleep, queue
+import time
 import logging
 logger = logging.getLogger(__name__)
 
@@ -10,6 +12,27 @@ MODE_CHANGE = 'mode-change'
 TARGET_CHANGE = 'target-change'
 SENT_CHANGE = 'sent-change'
 CONTENT_CHANGE = 'content-change'
+OVERLOAD_CHANGE = 'overload-change'
+
+INSERT_CHANGES_SQL = '''INSERT INTO `message_changelog` (`message_id`, `change_type`, `old`, `new`, `description`, `date`)
+VALUES %s'''
+INSERT_CHANGES_VALUES = '(%s, %s, %s, %s, %s, NOW())'
+
+# When set up with init_buffer(), changes are queued here and written in bulk by
+# a single writer greenlet (see writer()), in the order they were logged
+change_queue = None
+batch_size = 500
+put_timeout = 1
+
+
+def init_buffer(max_queue_size=10000, max_batch_size=500, max_put_wait=1):
+    global change_queue, batch_size, put_timeout
+    change_queue = queue.Queue(max_queue_size)
+    batch_size = max_batch_size
+    put_timeout = max_put_wait
+    metrics.add_new_metrics({'auditlog_queue_size': 0, 'auditlog_overflow_cnt': 0, 'auditlog_drop_cnt': 0,
+                             'auditlog_write_cnt': 0, 'auditlog_write_rows': 0, 'auditlog_write_time': 0,
+                             'auditlog_write_fail_cnt': 0})
 
 
 def message_change(message_id, change_type, old, new, description):
@@ -21,6 +44,10 @@ def message_change(message_id, change_type, old, new, description):
     new = new[0:250]
     description = description[0:250]
 
+    if change_queue is not None:
+        queue_change((message_id, change_type, old, new, description))
+        return
+
     # retry to guard against deadlocks
     retries = 0
     max_retries = 5
@@ -44,3 +71,78 @@ def message_change(message_id, change_type, old, new, description):
             else:
                 logger.info('Logged change information for message (ID %s)', message_id)
                 break
+
+
+def queue_change(row):
+    try:
+        change_queue.put_nowait(row)
+        return
+    except queue.Full:
+        metrics.incr('auditlog_overflow_cnt')
+
+    # The writer is falling behind; make the caller wait for room before giving up
+    try:
+        change_queue.put(row, timeout=put_timeout)
+    except queue.Full:
+        metrics.incr('auditlog_drop_cnt')
+        logger.warning('Audit log queue full. Dropping %s for message (ID %s)', row[1], row[0])
+
+
+def insert_changes(rows):
+    connection = db.engine.raw_connection()
+    cursor = connection.cursor()
+    try:
+        # retry to guard against deadlocks
+        max_retries = 5
+        for retries in range(1, max_retries + 1):
+            try:
+                cursor.execute(INSERT_CHANGES_SQL % ', '.join([INSERT_CHANGES_VALUES] * len(rows)),
+                               [value for row in rows for value in row])
+                connection.commit()
+                return True
+            except Exception:
+                connection.rollback()
+                logger.warning('Failed inserting %s changes into auditlog. (Try %s/%s)', len(rows), retries, max_retries)
+                if retries < max_retries:
+                    sleep(.2)
+        return False
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def write_changes(rows):
+    start = time.time()
+    if not insert_changes(rows):
+        metrics.incr('auditlog_write_fail_cnt')
+        # Write rows one at a time, in order, so one bad row (eg a deleted message) doesn't
+        # lose the rest of the batch
+        for row in rows:
+            if not insert_changes([row]):
+                metrics.incr('auditlog_drop_cnt')
+                logger.error('Dropping %s for message (ID %s) from auditlog', row[1], row[0])
+    metrics.incr('auditlog_write_cnt')
+    metrics.set('auditlog_write_rows', len(rows))
+    metrics.set('auditlog_write_time', time.time() - start)
+
+
+def writer():
+    while True:
+        rows = [change_queue.get()]
+        while len(rows) < batch_size and not change_queue.empty():
+            rows.append(change_queue.get_nowait())
+        metrics.set('auditlog_queue_size', change_queue.qsize())
+        try:
+            write_changes(rows)
+        except Exception:
+            metrics.incr('auditlog_drop_cnt', inc=len(rows))
+            logger.exception('Failed writing %s changes to auditlog', len(rows))
+
+
+def flush():
+    # write out whatever is still queued, eg on shutdown
+    while change_queue is not None and not change_queue.empty():
+        rows = []
+        while len(rows) < batch_size and not change_queue.empty():
+            rows.append(change_queue.get_nowait())
+        write_changes(rows)
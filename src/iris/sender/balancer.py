@@ -0,0 +1,57 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+import random
+from time import time
+from iris import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Floor for reported send latency, so followers with empty queues still compare by depth
+MIN_LATENCY = 0.001
+
+
+class FollowerBalancer(object):
+    '''
+    Picks the follower to pass a message to from the load followers report in their
+    replies: per mode send queue depth and recent send latency. Of two followers picked
+    at random, the one expected to get through its queue sooner wins.
+
+    If either of the two hasn't reported in stale_after seconds, choose() returns None
+    and callers go round robin instead, which also gets us fresh reports from them.
+    '''
+
+    def __init__(self, stale_after=30):
+        self.stale_after = stale_after
+        self.loads = {}  # address -> (report time, load)
+        metrics.add_new_metrics({'follower_balance_choice_cnt': 0, 'follower_balance_fallback_cnt': 0})
+
+    def update(self, address, load):
+        if isinstance(load, dict):
+            self.loads[address] = (time(), load)
+
+    def prune(self, addresses):
+        for address in set(self.loads) - set(addresses):
+            del self.loads[address]
+
+    def cost(self, address, mode, now):
+        reported, load = self.loads.get(address, (0, None))
+        if load is None or now - reported > self.stale_after:
+            return None
+        depth = load.get('queues', {}).get(mode, 0)
+        latency = load.get('latency', {}).get(mode) or 0
+        return (depth + 1) * max(latency, MIN_LATENCY)
+
+    def choose(self, followers, mode):
+        if len(followers) < 2:
+            return None
+        now = time()
+        first, second = random.sample(followers, 2)
+        first_cost = self.cost(first, mode, now)
+        second_cost = self.cost(second, mode, now)
+        if first_cost is None or second_cost is None:
+            metrics.incr('follower_balance_fallback_cnt')
+            return None
+        metrics.incr('follower_balance_choice_cnt')
+        return first if first_cost <= second_cost else second
@@ -1,17 +1,26 @@
 # Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
 # See LICENSE in the project root for license information.
 
-from collections import deque
+from collections import OrderedDict
+from decimal import Decimal
+import hashlib
+import os
+import time
 import jinja2
+from jinja2 import nodes
 from jinja2.sandbox import SandboxedEnvironment
 from gevent import spawn, sleep
-from gevent.pool import Pool
+from gevent.event import AsyncResult
 from .message import update_message_mode
+from .ipc import pack_default, unpack_ext_hook
 from .. import db
+from .. import metrics
 from ..role_lookup import get_role_lookups
 from . import auditlog
+from .window import SlidingWindowCounter
 
 import logging
+import msgpack
 import ujson
 logger = logging.getLogger(__name__)
 
@@ -26,6 +35,104 @@ target_reprioritization = None
 target_names = None
 targets_for_role = None
 dynamic_plan_map = None
+render_cache = None
+template_bytecode_cache = None
+snapshot_path = None
+snapshot_interval = 300
+last_snapshot = 0
+
+# Number of templates or plans loaded per query when refreshing
+BULK_LOAD_SIZE = 500
+
+# Bumped whenever what save_snapshot() writes changes, so older snapshots are ignored
+SNAPSHOT_VERSION = 2
+
+TEMPLATES_SQL = '''SELECT `template_active`.`name`, `template`.`id`, `application`.`name`, `mode`.`name`,
+       `template_content`.`subject`, `template_content`.`body`
+FROM `template_active`
+JOIN `template` ON `template`.`id` = `template_active`.`template_id`
+JOIN `template_content` ON `template_content`.`template_id` = `template_active`.`template_id`
+JOIN `application` ON `template_content`.`application_id` = `application`.`id`
+JOIN `mode` ON `template_content`.`mode_id` = `mode`.`id`
+WHERE `template_active`.`name` IN %s'''
+
+PLANS_SQL = '''SELECT DISTINCT `plan`.`id` as `id`, `plan`.`name` as `name`,
+    `plan`.`threshold_window` as `threshold_window`, `plan`.`threshold_count` as `threshold_count`,
+    `plan`.`aggregation_window` as `aggregation_window`, `plan`.`aggregation_reset` as `aggregation_reset`,
+    `plan`.`description` as `description`, UNIX_TIMESTAMP(`plan`.`created`) as `created`,
+    `target`.`name` as `creator`, IF(`plan_active`.`plan_id` IS NULL, FALSE, TRUE) as `active`,
+    `plan`.`tracking_type` as `tracking_type`, `plan`.`tracking_key` as `tracking_key`,
+    `plan`.`tracking_template` as `tracking_template`
+FROM `plan` JOIN `target` ON `plan`.`user_id` = `target`.`id`
+LEFT OUTER JOIN `plan_active` ON `plan`.`id` = `plan_active`.`plan_id`
+WHERE `plan`.`id` IN %s'''
+
+PLAN_STEPS_SQL = '''SELECT `plan_notification`.`id` as `id`,
+    `plan_notification`.`plan_id` as `plan_id`,
+    `plan_notification`.`step` as `step`,
+    `plan_notification`.`repeat` as `repeat`,
+    `plan_notification`.`wait` as `wait`,
+    `plan_notification`.`optional` as `optional`,
+    `target_role`.`name` as `role`,
+    `target`.`name` as `target`,
+    `plan_notification`.`template` as `template`,
+    `priority`.`name` as `priority`,
+    `plan_notification`.`dynamic_index` AS `dynamic_index`
+FROM `plan_notification`
+LEFT OUTER JOIN `target` ON `plan_notification`.`target_id` = `target`.`id`
+LEFT OUTER JOIN `target_role` ON `plan_notification`.`role_id` = `target_role`.`id`
+JOIN `priority` ON `plan_notification`.`priority_id` = `priority`.`id`
+WHERE `plan_notification`.`plan_id` IN %s
+ORDER BY `plan_notification`.`plan_id`, `plan_notification`.`step`'''
+
+
+def compile_template(env, name, source):
+    '''
+    env.from_string(source), reusing the compiled code from the bytecode cache if the
+    template_bytecode_cache_dir option is set. Entries are checked against the source, so
+    name only needs to be stable for a given template, eg template id/application/mode.
+    '''
+    if template_bytecode_cache is None:
+        return env.from_string(source)
+    bucket = template_bytecode_cache.get_bucket(env, name, None, source)
+    if bucket.code is None:
+        bucket.code = env.compile(source, name)
+        template_bytecode_cache.set_bucket(bucket)
+    return env.template_class.from_code(env, bucket.code, env.make_globals(None))
+
+
+class SingleFlight(object):
+    '''
+    Runs one load per key at a time. Callers asking for a key that's already being
+    loaded wait for that load and get its result, or its exception. Nothing is kept
+    once the load is done; that's up to the caller.
+    '''
+
+    def __init__(self):
+        self.calls = {}
+        metrics.add_new_metrics({'cache_coalesced_cnt': 0})
+
+    def __call__(self, key, load, *args):
+        call = self.calls.get(key)
+        if call is not None:
+            metrics.incr('cache_coalesced_cnt')
+            return call.get()
+        call = self.calls[key] = AsyncResult()
+        try:
+            ret = load(*args)
+        except Exception as e:
+            call.set_exception(e)
+            raise
+        except BaseException:
+            # The loading greenlet was killed. Fail the waiters with a plain error rather
+            # than passing the kill on to them, so they don't hang or quietly exit.
+            call.set_exception(Exception('Loading %r was interrupted' % (key,)))
+            raise
+        else:
+            call.set(ret)
+            return ret
+        finally:
+            del self.calls[key]
 
 
 class Cache():
@@ -34,18 +141,24 @@ class Cache():
         self.sql = sql
         self.active = active
         self.data = {}
+        self.single_flight = SingleFlight()
 
     def __getitem__(self, key):
         try:
             return self.data[key]
         except KeyError:
-            connection = self.engine.raw_connection()
+            return self.single_flight(key, self.load, key)
+
+    def load(self, key):
+        connection = self.engine.raw_connection()
+        try:
             cursor = connection.cursor(db.dict_cursor)
             cursor.execute(self.sql, key)
             ret = self.data[key] = cursor.fetchone()
             cursor.close()
+        finally:
             connection.close()
-            return ret
+        return ret
 
     def purge(self):
         if self.data and self.active:
@@ -61,17 +174,16 @@ class Cache():
 
 
 class DynamicPlanMap(Cache):
-    def __getitem__(self, key):
+    def load(self, key):
+        connection = self.engine.raw_connection()
         try:
-            return self.data[key]
-        except KeyError:
-            connection = self.engine.raw_connection()
             cursor = connection.cursor(db.dict_cursor)
             cursor.execute(self.sql, key)
             ret = self.data[key] = {row['dynamic_index']: row for row in cursor}
             cursor.close()
+        finally:
             connection.close()
-            return ret
+        return ret
 
 
 class Templates():
@@ -84,51 +196,75 @@ class Templates():
         self.engine = engine
         self.active = {}
         self.data = {}
+        # template name -> its rows from TEMPLATES_SQL, kept for cache snapshots
+        self.rows = {}
 
     def __getitem__(self, key):
         try:
             return self.data[key]
         except KeyError:
-            template = {}
-            connection = self.engine.raw_connection()
-            cursor = connection.cursor()
-            cursor.execute('''
-                SELECT `template`.`id`, `application`.`name`, `mode`.`name`,
-                       `template_content`.`subject`, `template_content`.`body`
-                FROM `template_active`
-                JOIN `template` ON `template`.`id` = `template_active`.`template_id`
-                JOIN `template_content` ON `template_content`.`template_id` = `template_active`.`template_id`
-                JOIN `application` ON `template_content`.`application_id` = `application`.`id`
-                JOIN `mode` ON `template_content`.`mode_id` = `mode`.`id`
-                WHERE `template_active`.`name` = %s''', key)
-
-            for template_id, application, mode, subject, body in cursor:
-                logger.debug('[+] adding template: %s %s %s %s', key, template_id, application, mode)
-                try:
-                    # make sure message_id is delivered to the user
-                    if self.has_message_id(subject) or self.has_message_id(body):
-                        subject = self.env.from_string(subject)
-                    else:
-                        if subject:
-                            subject = self.env.from_string('{{ iris.message_id }} ' + subject)
-                        else:
-                            subject = self.env.from_string('{{ iris.message_id }}')
-                    body = self.env.from_string(body)
-                except jinja2.exceptions.TemplateSyntaxError:
-                    logger.info('[-] error parsing template: %s %s %s %s', key, template_id, application, mode)
-                    continue
-                template['id'] = template_id
-                template.setdefault(application, {})[mode] = {
-                    'subject': subject,
-                    'body': body
-                }
+            if key in self.rows:
+                template = self.data[key] = self.build(key, self.rows[key])
+                return template
+            return self.load([key])[key]
 
-            self.data[key] = template
-            cursor.close()
-            connection.close()
-            return template
+    def load(self, names):
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor()
+        cursor.execute(TEMPLATES_SQL, [tuple(names)])
+        rows = {name: [] for name in names}
+        for row in cursor:
+            rows[row[0]].append(row[1:])
+        cursor.close()
+        connection.close()
+
+        templates = {}
+        for key, template_rows in rows.items():
+            self.rows[key] = template_rows
+            templates[key] = self.data[key] = self.build(key, template_rows)
+        return templates
+
+    def build(self, key, template_rows):
+        template = {}
+        for template_id, application, mode, subject, body in template_rows:
+            logger.debug('[+] adding template: %s %s %s %s', key, template_id, application, mode)
+            name = '%s/%s/%s' % (template_id, application, mode)
+            try:
+                # make sure message_id is delivered to the user
+                message_id_prefix = not (self.has_message_id(subject) or self.has_message_id(body))
+                subject_source = subject
+                if message_id_prefix:
+                    if subject:
+                        subject = compile_template(self.env, name + '/subject', '{{ iris.message_id }} ' + subject)
+                    else:
+                        subject = compile_template(self.env, name + '/subject', '{{ iris.message_id }}')
+                else:
+                    subject = compile_template(self.env, name + '/subject', subject)
+                body_source = body
+                body = compile_template(self.env, name + '/body', body)
+            except jinja2.exceptions.TemplateSyntaxError:
+                logger.info('[-] error parsing template: %s %s %s %s', key, template_id, application, mode)
+                continue
+            template['id'] = template_id
+            mode_template = template.setdefault(application, {})[mode] = {
+                'subject': subject,
+                'body': body,
+                # what render caching needs to know: the iris attributes each part
+                # uses (None if it can't tell), and the subject without the
+                # message_id prefix added above, which is cached on its own
+                'message_id_prefix': message_id_prefix,
+                'subject_iris_attributes': self.iris_attributes(subject_source),
+                'body_iris_attributes': self.iris_attributes(body_source),
+            }
+            if message_id_prefix and subject_source:
+                mode_template['subject_source'] = compile_template(self.env, name + '/subject_source', subject_source)
+
+        return template
 
     def has_message_id(self, source):
+        # skip parsing templates that can't possibly have it
+        if not source or 'message_id' not in source:
+            return False
         valid = False
         ast = self.env.parse(source)
         for node in ast.body:
@@ -154,6 +290,30 @@ class Templates():
 
         return valid
 
+    def iris_attributes(self, source):
+        '''
+        Names of the iris.* attributes a template uses, or None if it uses iris in some
+        other way (eg looping over it or passing it to a filter).
+        '''
+        if not source or 'iris' not in source:
+            return frozenset()
+        ast = self.env.parse(source)
+        attributes = set()
+        lookups = set()
+        for node in ast.find_all((nodes.Getattr, nodes.Getitem)):
+            if isinstance(node.node, nodes.Name) and node.node.name == 'iris':
+                if isinstance(node, nodes.Getattr):
+                    attributes.add(node.attr)
+                elif isinstance(node.arg, nodes.Const):
+                    attributes.add(node.arg.value)
+                else:
+                    continue
+                lookups.add(id(node.node))
+        for node in ast.find_all(nodes.Name):
+            if node.name == 'iris' and id(node) not in lookups:
+                return None
+        return frozenset(attributes)
+
     def refresh(self):
         logger.info('refreshing templates')
 
@@ -173,21 +333,105 @@ class Templates():
         new_ids = new_active_ids - old_active_ids
 
         for template_id in old_ids:
+            # templates restored from a snapshot are only built once used
+            self.rows.pop(self.active[template_id], None)
+            self.data.pop(self.active[template_id], None)
+
+        new_names = [active[id] for id in new_ids]
+        for i in range(0, len(new_names), BULK_LOAD_SIZE):
+            self.load(new_names[i:i + BULK_LOAD_SIZE])
+
+        self.active = active
+
+
+class RenderCache(object):
+    '''
+    Bounded LRU of rendered template parts, so messages to each member of a team for
+    the same incident only render their subject and body once.
+
+    Keys combine the template, application and mode with the incident (or a digest of the
+    context for messages without one) and the values of the iris attributes the template
+    uses, as those are different for every message.
+    '''
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.data = OrderedDict()
+        metrics.add_new_metrics({'render_cache_hit_cnt': 0, 'render_cache_miss_cnt': 0,
+                                 'render_cache_eviction_cnt': 0, 'render_cache_uncacheable_cnt': 0,
+                                 'render_cache_size': 0})
+
+    def key(self, message, template, mode, part, iris_attributes):
+        if iris_attributes is None:
+            return None
+        context = message['context']
+        iris = context.get('iris') or {}
+        if message.get('incident_id'):
+            context_key = message['incident_id']
+        else:
+            try:
+                context_key = hashlib.sha1(ujson.dumps({k: v for k, v in context.items() if k != 'iris'},
+                                                       sort_keys=True).encode('utf-8')).hexdigest()
+            except Exception:
+                return None
+        key = (message['template'], template['id'], message['application'], mode, part, context_key,
+               tuple((attribute, iris.get(attribute)) for attribute in sorted(iris_attributes)))
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def render(self, message, template, mode_template, mode, part):
+        '''
+        Render part ('subject' or 'body') of mode_template, template's content for the
+        message's application and mode. Exceptions from rendering are raised, and nothing
+        is cached for them.
+        '''
+        jinja_template = mode_template[part]
+        prefix = None
+        if part == 'subject' and mode_template['message_id_prefix']:
+            # The message_id we add to the subject is different for every message, so
+            # cache what comes after it and add it back afterwards
+            prefix = str(message['context'].get('iris', {}).get('message_id', ''))
+            jinja_template = mode_template.get('subject_source')
+            if jinja_template is None:
+                return prefix
+
+        key = self.key(message, template, mode, part, mode_template[part + '_iris_attributes'])
+        if key is None:
+            metrics.incr('render_cache_uncacheable_cnt')
+            rendered = jinja_template.render(**message['context'])
+        else:
             try:
-                del self.data[self.active[template_id]]
+                rendered = self.data[key]
+                self.data.move_to_end(key)
+                metrics.incr('render_cache_hit_cnt')
             except KeyError:
-                logger.exception('Failed pruning old template_id %s', template_id)
+                metrics.incr('render_cache_miss_cnt')
+                rendered = self.data[key] = jinja_template.render(**message['context'])
+                while len(self.data) > self.max_size:
+                    self.data.popitem(last=False)
+                    metrics.incr('render_cache_eviction_cnt')
+                metrics.set('render_cache_size', len(self.data))
 
-        Pool(30).map(self.__getitem__, (active[id] for id in new_ids))
+        if prefix is not None:
+            return prefix + ' ' + rendered
+        return rendered
 
-        self.active = active
+    def clear(self):
+        self.data.clear()
 
 
 class Plans():
     def __init__(self, engine):
         self.engine = engine
         self.active = {}
+        # name -> id of active plans
+        self.active_ids = {}
         self.data = {}
+        # plan id -> its row from PLANS_SQL and its steps, kept for cache snapshots
+        self.rows = {}
         # Autoescape turned off since HTML characters can exist in plan tracking template.
         # See details in Templates()
         self.template_env = SandboxedEnvironment(autoescape=False)
@@ -196,100 +440,97 @@ class Plans():
         try:
             return self.data[key]
         except KeyError:
-
-            connection = self.engine.raw_connection()
-            cursor = connection.cursor(db.dict_cursor)
-
             if isinstance(key, int):
                 plan_id = key
+            elif key in self.active_ids:
+                plan_id = self.active_ids[key]
             else:
+                connection = self.engine.raw_connection()
+                cursor = connection.cursor(db.dict_cursor)
                 cursor.execute('''SELECT `plan`.`id` FROM `plan` INNER JOIN `plan_active` ON `plan`.`id` = `plan_active`.`plan_id` WHERE `plan`.`name` = %s''', key)
                 plan_id = cursor.fetchone()['id']
+                cursor.close()
+                connection.close()
+            if plan_id in self.rows:
+                plan = self.build(*self.rows[plan_id])
+            else:
+                plan = self.load([plan_id])[plan_id]
+            self.data[key] = plan
+            return plan
 
-            single_plan_query = '''SELECT DISTINCT `plan`.`id` as `id`, `plan`.`name` as `name`,
-                `plan`.`threshold_window` as `threshold_window`, `plan`.`threshold_count` as `threshold_count`,
-                `plan`.`aggregation_window` as `aggregation_window`, `plan`.`aggregation_reset` as `aggregation_reset`,
-                `plan`.`description` as `description`, UNIX_TIMESTAMP(`plan`.`created`) as `created`,
-                `target`.`name` as `creator`, IF(`plan_active`.`plan_id` IS NULL, FALSE, TRUE) as `active`,
-                `plan`.`tracking_type` as `tracking_type`, `plan`.`tracking_key` as `tracking_key`,
-                `plan`.`tracking_template` as `tracking_template`
-            FROM `plan` JOIN `target` ON `plan`.`user_id` = `target`.`id`
-            LEFT OUTER JOIN `plan_active` ON `plan`.`id` = `plan_active`.`plan_id`
-            WHERE `plan`.`id` = %s'''
-
-            cursor.execute(single_plan_query, plan_id)
-            plan = cursor.fetchone()
-
-            single_plan_query_steps = '''SELECT `plan_notification`.`id` as `id`,
-                `plan_notification`.`step` as `step`,
-                `plan_notification`.`repeat` as `repeat`,
-                `plan_notification`.`wait` as `wait`,
-                `plan_notification`.`optional` as `optional`,
-                `target_role`.`name` as `role`,
-                `target`.`name` as `target`,
-                `plan_notification`.`template` as `template`,
-                `priority`.`name` as `priority`,
-                `plan_notification`.`dynamic_index` AS `dynamic_index`
-            FROM `plan_notification`
-            LEFT OUTER JOIN `target` ON `plan_notification`.`target_id` = `target`.`id`
-            LEFT OUTER JOIN `target_role` ON `plan_notification`.`role_id` = `target_role`.`id`
-            JOIN `priority` ON `plan_notification`.`priority_id` = `priority`.`id`
-            WHERE `plan_notification`.`plan_id` = %s
-            ORDER BY `plan_notification`.`step`'''
-
-            step = 0
-            steps = []
-            cursor.execute(single_plan_query_steps, plan_id)
-            for notification in cursor:
-                s = notification['step']
-                if s != step:
-                    l = [notification]
-                    steps.append(l)
-                    step = s
-                else:
-                    l.append(notification)
-            plan['steps'] = steps
-            if plan['tracking_template']:
-                plan['tracking_template'] = ujson.loads(plan['tracking_template'])
-
-            cursor.close()
-            connection.close()
+    def load(self, plan_ids):
+        '''
+        Loads plans with their steps in two queries. Plans are cached under their id, and
+        active plans under their name as well.
+        '''
+        connection = self.engine.raw_connection()
+        cursor = connection.cursor(db.dict_cursor)
 
-            logger.debug('[+] adding plan: %s', key)
+        cursor.execute(PLANS_SQL, [tuple(plan_ids)])
+        plans = {plan['id']: plan for plan in cursor}
 
-            steps = {}
-            for idx, notifications in enumerate(plan['steps']):
-                steps[idx + 1] = [n['id'] for n in notifications]
-            plan['steps'] = steps
+        step_notifications = {plan_id: [] for plan_id in plans}
+        if plans:
+            cursor.execute(PLAN_STEPS_SQL, [tuple(plans)])
+            for notification in cursor:
+                step_notifications[notification.pop('plan_id')].append(notification)
 
-            if plan['tracking_template']:
-                tracking_template = plan['tracking_template']
-                if plan['tracking_type'] == 'email':
-                    for application, application_templates in tracking_template.items():
-                        try:
-                            tracking_template[application] = {
-                                'email_subject': self.template_env.from_string(application_templates['email_subject']),
-                                'email_text': self.template_env.from_string(application_templates['email_text']),
-                            }
-                            html_template = application_templates.get('email_html')
-                            if html_template:
-                                tracking_template[application]['email_html'] = self.template_env.from_string(html_template)
-                        except jinja2.exceptions.TemplateSyntaxError:
-                            logger.exception('[-] error parsing Plan template for %s: %s', key, application)
-                            continue
-                else:
-                    for application, application_templates in tracking_template.items():
-                        try:
-                            tracking_template[application] = {
-                                'body': self.template_env.from_string(application_templates['body']),
-                            }
-                        except jinja2.exceptions.TemplateSyntaxError:
-                            logger.exception('[-] error parsing Plan template for %s: %s', key, application)
-                            continue
-                plan['tracking_template'] = tracking_template
+        cursor.close()
+        connection.close()
 
-            self.data[key] = plan
-            return plan
+        for plan_id, plan in plans.items():
+            self.rows[plan_id] = (dict(plan), step_notifications[plan_id])
+            plans[plan_id] = self.build(plan, step_notifications[plan_id])
+
+        return plans
+
+    def build(self, plan, notifications):
+        plan = dict(plan)
+        plan_id = plan['id']
+        logger.debug('[+] adding plan: %s', plan_id)
+
+        steps = {}
+        for notification in notifications:
+            steps.setdefault(notification['step'], []).append(notification['id'])
+        # steps are numbered from 1 in order, regardless of the step column's values
+        plan['steps'] = {idx + 1: steps[step] for idx, step in enumerate(sorted(steps))}
+
+        if plan['tracking_template']:
+            tracking_template = ujson.loads(plan['tracking_template'])
+            name = 'plan/%s/' % plan_id
+            if plan['tracking_type'] == 'email':
+                for application, application_templates in tracking_template.items():
+                    try:
+                        tracking_template[application] = {
+                            'email_subject': compile_template(self.template_env, name + application + '/email_subject',
+                                                              application_templates['email_subject']),
+                            'email_text': compile_template(self.template_env, name + application + '/email_text',
+                                                           application_templates['email_text']),
+                        }
+                        html_template = application_templates.get('email_html')
+                        if html_template:
+                            tracking_template[application]['email_html'] = compile_template(
+                                self.template_env, name + application + '/email_html', html_template)
+                    except jinja2.exceptions.TemplateSyntaxError:
+                        logger.exception('[-] error parsing Plan template for %s: %s', plan_id, application)
+                        continue
+            else:
+                for application, application_templates in tracking_template.items():
+                    try:
+                        tracking_template[application] = {
+                            'body': compile_template(self.template_env, name + application + '/body',
+                                                     application_templates['body']),
+                        }
+                    except jinja2.exceptions.TemplateSyntaxError:
+                        logger.exception('[-] error parsing Plan template for %s: %s', plan_id, application)
+                        continue
+            plan['tracking_template'] = tracking_template
+
+        self.data[plan_id] = plan
+        if plan['active']:
+            self.data[plan['name']] = plan
+
+        return plan
 
     def refresh(self):
         logger.info('refreshing plans')
@@ -310,21 +551,23 @@ class Plans():
         new_ids = new_active_ids - old_active_ids
 
         for plan_id in old_ids:
-            if self.data.get(plan_id):
-                try:
-                    del self.data[plan_id]
-                except KeyError:
-                    logger.debug('Failed pruning old plan_id %s', plan_id)
+            self.rows.pop(plan_id, None)
+            plan = self.data.pop(plan_id, None)
+            if plan and self.data.get(plan['name']) is plan:
+                del self.data[plan['name']]
 
-        Pool(30).map(self.__getitem__, (active[id] for id in new_ids))
+        new_ids = list(new_ids)
+        for i in range(0, len(new_ids), BULK_LOAD_SIZE):
+            self.load(new_ids[i:i + BULK_LOAD_SIZE])
 
         self.active = active
+        self.active_ids = {name: plan_id for plan_id, name in active.items()}
 
 
 class TargetReprioritization(object):
     def __init__(self, engine):
         self.engine = engine
-        # (target, src_mode): (dst_mode, destination, count, deque)
+        # (target, src_mode): (dst_mode, destination, count, SlidingWindowCounter of minute buckets)
         self.rates = {}
 
     def refresh(self):
@@ -351,7 +594,7 @@ class TargetReprioritization(object):
                     logger.info('invalid target reprioritization rule (%s, %s): (%s, %s, %d, %d)',
                                 target, src_mode, dst_mode, destination, count, duration)
                     continue
-                rates[(target, src_mode)] = (dst_mode, destination, count, duration / 60)
+                rates[(target, src_mode)] = (dst_mode, destination, count, duration)
 
             cursor.close()
             connection.close()
@@ -367,22 +610,21 @@ class TargetReprioritization(object):
             # new rate entries:
             for key in current - old:
                 logger.debug('creating target reprioritization rule for %r: %r', key, rates[key])
-                dst_mode, destination, count, duration_min = rates[key]
-                self.rates[key] = (dst_mode, destination, count, deque([0] * duration_min, maxlen=duration_min))
+                dst_mode, destination, count, duration = rates[key]
+                self.rates[key] = (dst_mode, destination, count, SlidingWindowCounter(duration, duration // 60))
 
             # loop through existing entries
             # if the settings have changed, gracefully alter them
-            # either way, push in a new bucket
             for key in current & old:
-                current_dst_mode, current_destination, current_count, current_duration_min = rates[key]
+                current_dst_mode, current_destination, current_count, current_duration = rates[key]
                 old_dst_mode, old_destination, old_count, old_buckets = self.rates[key]
-                if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or len(old_buckets) != current_duration_min:  # noqa FIXME: refactor this line
+                if old_dst_mode != current_dst_mode or old_destination != current_destination or old_count != current_count or old_buckets.duration != current_duration:  # noqa FIXME: refactor this line
                     logger.debug('updating target reprioritization rule for %r: %r | %r', key, self.rates[key], rates[key])
-                    # create a new bucket truncating if it's smaller and growing if it is larger, while preserving the counts
-                    current_buckets = deque(old_buckets, maxlen=current_duration_min)
+                    # truncate the window if it's shorter and grow it if it is longer, while preserving the counts
+                    current_buckets = old_buckets
+                    if old_buckets.duration != current_duration:
+                        current_buckets = old_buckets.resized(current_duration, current_duration // 60)
                     self.rates[key] = (current_dst_mode, current_destination, current_count, current_buckets)
-                # add the new interval bucket to each
-                self.rates[key][-1].append(0)
 
             logger.info('refreshed target reprioritization rules: %d', len(self.rates))
             logger.debug(self.rates)
@@ -407,9 +649,8 @@ class TargetReprioritization(object):
             dst_mode, destination, count, buckets = self.rates[(message['target'], original_mode)]
             logger.debug('reprioritization (%s, %s): (%s, %s, %d, %r)',
                          message['target'], original_mode, dst_mode, destination, count, buckets)
-            # increment the bucket for this minute
-            buckets[-1] += 1
-            if sum(buckets) > count:
+            # count this message, and check the total for the duration
+            if buckets.add() > count:
                 logger.debug('target reprioritization rule triggered (%s, %s): (%s, %s, %d, %r)',
                              message['target'], original_mode, dst_mode, destination, count, buckets)
                 # sum of all counts for duration exceeds count
@@ -428,34 +669,42 @@ class TargetReprioritization(object):
 
 
 class RoleTargets():
-    def __init__(self, role_lookups, engine):
+    def __init__(self, role_lookups, engine, active_targets=None):
         self.data = {}
+        self.single_flight = SingleFlight()
         self.role_lookups = role_lookups
         self.engine = engine
-        self.active_targets = set()
-        self.initialize_active_targets()
+        if active_targets is None:
+            self.active_targets = set()
+            self.initialize_active_targets()
+        else:
+            # restored from a snapshot, revalidate in the background
+            self.active_targets = set(active_targets)
+            spawn(self.initialize_active_targets)
 
     def __call__(self, role, target):
         try:
             return self.data[(role, target)]
         except KeyError:
+            return self.single_flight((role, target), self.lookup, role, target)
 
-            names = None
+    def lookup(self, role, target):
+        names = None
 
-            # Iterate through our role lookup modules until we find one that works.
-            for role_lookup in self.role_lookups:
-                names = role_lookup.get(role, target)
-                if names is not None:
-                    break
+        # Iterate through our role lookup modules until we find one that works.
+        for role_lookup in self.role_lookups:
+            names = role_lookup.get(role, target)
+            if names is not None:
+                break
 
-            if names is None:
-                logger.info('All role lookups modules failed to lookup %s:%s', role, target)
-                self.data[(role, target)] = None
-                return None
+        if names is None:
+            logger.info('All role lookups modules failed to lookup %s:%s', role, target)
+            self.data[(role, target)] = None
+            return None
 
-            names = self.prune_inactive_targets(names)
-            self.data[(role, target)] = names
-            return names
+        names = self.prune_inactive_targets(names)
+        self.data[(role, target)] = names
+        return names
 
     def purge(self):
         self.data = {}
@@ -475,6 +724,86 @@ class RoleTargets():
         connection.close()
 
 
+def snapshot_default(obj):
+    # eg UNIX_TIMESTAMP() of columns with fractional seconds
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return pack_default(obj)
+
+
+def save_snapshot(path=None):
+    '''
+    Write what the sender caches to path (the cache_snapshot option's by default), for
+    the next sender start to load before revalidating it against the DB.
+    '''
+    global last_snapshot
+    path = path or snapshot_path
+    snapshot = {
+        'version': SNAPSHOT_VERSION,
+        'created': time.time(),
+        'templates': {'active': templates.active, 'rows': templates.rows},
+        'plans': {'active': plans.active, 'rows': plans.rows},
+        'active_targets': targets_for_role.active_targets,
+        'target_reprioritization': [
+            [target, src_mode, dst_mode, destination, count, buckets.duration, buckets.buckets()]
+            for (target, src_mode), (dst_mode, destination, count, buckets) in target_reprioritization.rates.items()
+        ],
+    }
+    try:
+        payload = msgpack.packb(snapshot, default=snapshot_default, use_bin_type=True)
+        tmp_path = '%s.%s.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+        os.rename(tmp_path, path)
+    except Exception:
+        logger.exception('Failed writing cache snapshot to %s', path)
+        return False
+    last_snapshot = time.time()
+    logger.info('Wrote cache snapshot of %s templates and %s plans to %s (%s bytes)',
+                len(templates.rows), len(plans.rows), path, len(payload))
+    return True
+
+
+def maybe_save_snapshot():
+    if snapshot_path and time.time() - last_snapshot >= snapshot_interval:
+        save_snapshot()
+
+
+def read_snapshot(path):
+    try:
+        with open(path, 'rb') as f:
+            snapshot = msgpack.unpackb(f.read(), raw=False, ext_hook=unpack_ext_hook, strict_map_key=False)
+    except FileNotFoundError:
+        return None
+    except Exception:
+        logger.exception('Failed reading cache snapshot from %s', path)
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('version') != SNAPSHOT_VERSION:
+        logger.warning('Ignoring cache snapshot %s from another version', path)
+        return None
+    return snapshot
+
+
+def restore_snapshot(snapshot):
+    '''
+    Load caches from a snapshot. Templates and plans are only built once used, and
+    refresh() loads whatever changed since the snapshot was written.
+    '''
+    global last_snapshot
+    templates.active = snapshot['templates']['active']
+    templates.rows = snapshot['templates']['rows']
+    plans.active = snapshot['plans']['active']
+    plans.active_ids = {name: plan_id for plan_id, name in plans.active.items()}
+    plans.rows = {plan_id: tuple(rows) for plan_id, rows in snapshot['plans']['rows'].items()}
+    for target, src_mode, dst_mode, destination, count, duration, buckets in snapshot['target_reprioritization']:
+        buckets = SlidingWindowCounter(duration, duration // 60).restore(buckets)
+        target_reprioritization.rates[(target, src_mode)] = (dst_mode, destination, count, buckets)
+    logger.info('Restored cache snapshot of %s templates, %s plans and %s active targets from %s seconds ago',
+                len(templates.rows), len(plans.rows), len(targets_for_role.active_targets),
+                int(time.time() - snapshot['created']))
+    last_snapshot = snapshot['created']
+
+
 def refresh():
     plans.refresh()
     templates.refresh()
@@ -491,10 +820,24 @@ def purge():
 
 def init(config):
     global targets_for_role, target_names, target_reprioritization, plan_notifications, targets
-    global roles, incidents, templates, plans, dynamic_plan_map
-
+    global roles, incidents, templates, plans, dynamic_plan_map, render_cache
+    global template_bytecode_cache, snapshot_path, snapshot_interval
+
+    snapshot_config = config.get('sender', {}).get('cache_snapshot') or {}
+    snapshot_path = snapshot_config.get('path')
+    snapshot_interval = snapshot_config.get('interval', 300)
+    snapshot = read_snapshot(snapshot_path) if snapshot_path else None
+
+    bytecode_cache_dir = config.get('sender', {}).get('template_bytecode_cache_dir')
+    if bytecode_cache_dir:
+        os.makedirs(bytecode_cache_dir, exist_ok=True)
+        template_bytecode_cache = jinja2.FileSystemBytecodeCache(bytecode_cache_dir)
+    else:
+        template_bytecode_cache = None
     plans = Plans(db.engine)
     templates = Templates(db.engine)
+    render_cache_size = config.get('sender', {}).get('render_cache_size', 1000)
+    render_cache = RenderCache(render_cache_size) if render_cache_size else None
     incidents = Cache(db.engine,
                       'SELECT * FROM `incident` WHERE `id`=%s',
                       'SELECT `id` from `incident` WHERE `active`=True AND `id` IN %s')
@@ -508,11 +851,13 @@ def init(config):
     target_reprioritization = TargetReprioritization(db.engine)
     target_names = Cache(db.engine, 'SELECT * FROM `target` WHERE `name`=%s AND `active` = TRUE', None)
     role_lookups = get_role_lookups(config)
-    targets_for_role = RoleTargets(role_lookups, db.engine)
+    targets_for_role = RoleTargets(role_lookups, db.engine, snapshot['active_targets'] if snapshot else None)
     dynamic_plan_map = DynamicPlanMap(db.engine,
                                       'SELECT * FROM `dynamic_plan_map` WHERE `incident_id` = %s',
                                       '''SELECT dynamic_plan_map.* FROM `dynamic_plan_map`
                                          JOIN `incident` ON `incident`.`id` = `dynamic_plan_map`.`incident_id`
                                          WHERE `incident`.`active` = TRUE AND `incident_id` IN %s''')
+    if snapshot:
+        restore_snapshot(snapshot)
 
     spawn(target_reprioritization.refresh)
@@ -0,0 +1,106 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Checkpoints of the sender's aggregation state, so a sender taking over escalation
+# after a failover keeps aggregating storms the previous one was already batching,
+# instead of paging each message out individually.
+
+from time import time
+from iris import metrics
+import ujson
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+SAVE_CHECKPOINT_SQL = '''INSERT INTO `sender_checkpoint` (`name`, `state`, `updated`)
+VALUES (%s, %s, NOW())
+ON DUPLICATE KEY UPDATE `state` = VALUES(`state`), `updated` = NOW()'''
+
+GET_CHECKPOINTS_SQL = '''SELECT `state` FROM `sender_checkpoint`
+WHERE `name` IN %s AND `updated` > NOW() - INTERVAL %s SECOND'''
+
+
+class AggregationCheckpoint(object):
+    '''
+    Saves named aggregation state snapshots to the sender_checkpoint table, unless db
+    is None, and/or a local file at path. Snapshots older than max_age seconds aren't
+    restored.
+
+    A snapshot is a dict of lists, as aggregation keys are tuples:
+    windows: [key, [[bucket, count], ...]], aggregation/sent: [key, time] and
+    queues: [key, [message_id, ...]].
+    '''
+
+    def __init__(self, db, path=None, max_age=600):
+        self.db = db
+        self.path = path
+        self.max_age = max_age
+        metrics.add_new_metrics({'aggregation_checkpoint_cnt': 0, 'aggregation_checkpoint_fail_cnt': 0,
+                                 'aggregation_restore_cnt': 0, 'aggregation_checkpoint_size': 0})
+
+    def save(self, snapshots):
+        try:
+            payloads = {name: ujson.dumps(snapshot) for name, snapshot in snapshots.items()}
+            if self.db is not None:
+                connection = self.db.engine.raw_connection()
+                try:
+                    cursor = connection.cursor()
+                    cursor.executemany(SAVE_CHECKPOINT_SQL, list(payloads.items()))
+                    connection.commit()
+                    cursor.close()
+                finally:
+                    connection.close()
+            if self.path:
+                existing = self.read_file()
+                existing.update({name: {'updated': time(), 'state': payload} for name, payload in payloads.items()})
+                tmp_path = self.path + '.tmp'
+                with open(tmp_path, 'w') as f:
+                    f.write(ujson.dumps(existing))
+                os.rename(tmp_path, self.path)
+        except Exception:
+            metrics.incr('aggregation_checkpoint_fail_cnt')
+            logger.exception('Failed checkpointing aggregation state')
+            return False
+        metrics.incr('aggregation_checkpoint_cnt')
+        metrics.set('aggregation_checkpoint_size', sum(len(payload) for payload in payloads.values()))
+        return True
+
+    def read_file(self):
+        try:
+            with open(self.path) as f:
+                return ujson.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def load(self, names):
+        '''
+        All recent enough snapshots saved under names, from both the DB and the file.
+        '''
+        names = list(names)
+        payloads = []
+        try:
+            if self.db is not None and names:
+                connection = self.db.engine.raw_connection()
+                try:
+                    cursor = connection.cursor()
+                    cursor.execute(GET_CHECKPOINTS_SQL, (names, self.max_age))
+                    payloads.extend(row[0] for row in cursor)
+                    cursor.close()
+                finally:
+                    connection.close()
+            if self.path:
+                cutoff = time() - self.max_age
+                payloads.extend(entry['state'] for name, entry in self.read_file().items()
+                                if name in names and entry.get('updated', 0) > cutoff)
+        except Exception:
+            logger.exception('Failed loading aggregation checkpoints')
+            return []
+        snapshots = []
+        for payload in payloads:
+            try:
+                snapshots.append(ujson.loads(payload))
+            except ValueError:
+                logger.error('Ignoring corrupt aggregation checkpoint')
+        metrics.incr('aggregation_restore_cnt', inc=len(snapshots))
+        return snapshots
@@ -0,0 +1,178 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from time import time
+from gevent import sleep
+from iris import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+USERS_SQL = '''SELECT `target`.`id`, `target`.`name` FROM `target`
+JOIN `target_type` ON `target_type`.`name` = 'user' AND `target_type`.`id` = `target`.`type_id`'''
+
+TARGET_CONTACTS_SQL = '''SELECT `target_contact`.`target_id`, `target_contact`.`mode_id`, `target_contact`.`destination`
+FROM `target_contact`
+JOIN `target` ON `target`.`id` = `target_contact`.`target_id`
+JOIN `target_type` ON `target_type`.`name` = 'user' AND `target_type`.`id` = `target`.`type_id`'''
+
+TARGET_APPLICATION_MODES_SQL = '''SELECT `target_id`, `application_id`, `priority_id`, `mode_id`
+FROM `target_application_mode`'''
+
+DEFAULT_APPLICATION_MODES_SQL = '''SELECT `application_id`, `priority_id`, `mode_id`
+FROM `default_application_mode`'''
+
+TARGET_MODES_SQL = '''SELECT `target_id`, `priority_id`, `mode_id` FROM `target_mode`'''
+
+PRIORITY_MODES_SQL = '''SELECT `id`, `mode_id` FROM `priority`'''
+
+APPLICATION_MODES_SQL = '''SELECT `application_id`, `mode_id` FROM `application_mode`'''
+
+APPLICATIONS_SQL = '''SELECT `id`, `name` FROM `application`'''
+
+MODES_SQL = '''SELECT `id`, `name` FROM `mode`'''
+
+CATEGORY_OVERRIDES_SQL = '''SELECT `user_id`, `category_id`, `mode_id` FROM `category_override`'''
+
+CATEGORY_MODES_SQL = '''SELECT `id`, `mode_id` FROM `notification_category`'''
+
+SMS_OVERRIDES_SQL = '''SELECT `target_contact`.`destination`, `target_contact`.`mode_id`
+FROM `mode_template_override`
+JOIN `target_contact` ON `mode_template_override`.`target_id` = `target_contact`.`target_id`'''
+
+
+class ContactIndex(object):
+    '''
+    In-memory copy of the user contact and notification settings tables, so the sender
+    can pick a message's mode and destination without querying the DB for each message.
+
+    Everything is reloaded in bulk every refresh_interval seconds. Lookups for targets
+    or applications that aren't in the index return None, and callers fall back to the
+    DB. For targets that are indexed, the index is authoritative; like the DB queries
+    they replace, lookups raise ValueError if no mode or contact can be found.
+    '''
+
+    def __init__(self, db, refresh_interval):
+        self.db = db
+        self.refresh_interval = refresh_interval
+        self.index = None
+        metrics.add_new_metrics({'contact_index_hit_cnt': 0, 'contact_index_miss_cnt': 0,
+                                 'contact_index_refresh_time': 0, 'contact_index_refresh_fail_cnt': 0,
+                                 'contact_index_users': 0})
+
+    def refresh(self):
+        start = time()
+        connection = self.db.engine.raw_connection()
+        cursor = connection.cursor()
+        try:
+            index = {}
+            cursor.execute(USERS_SQL)
+            index['users'] = {name: target_id for target_id, name in cursor}
+            cursor.execute(APPLICATIONS_SQL)
+            index['applications'] = {name: application_id for application_id, name in cursor}
+            cursor.execute(MODES_SQL)
+            index['mode_names'] = dict(cursor)
+            index['mode_ids'] = {name: mode_id for mode_id, name in index['mode_names'].items()}
+            cursor.execute(TARGET_CONTACTS_SQL)
+            index['contacts'] = {(target_id, mode_id): destination for target_id, mode_id, destination in cursor}
+            cursor.execute(TARGET_APPLICATION_MODES_SQL)
+            index['target_application_modes'] = {row[:3]: row[3] for row in cursor}
+            cursor.execute(DEFAULT_APPLICATION_MODES_SQL)
+            index['default_application_modes'] = {row[:2]: row[2] for row in cursor}
+            cursor.execute(TARGET_MODES_SQL)
+            index['target_modes'] = {row[:2]: row[2] for row in cursor}
+            cursor.execute(PRIORITY_MODES_SQL)
+            index['priority_modes'] = dict(cursor)
+            cursor.execute(APPLICATION_MODES_SQL)
+            index['application_modes'] = {tuple(row) for row in cursor}
+            cursor.execute(CATEGORY_OVERRIDES_SQL)
+            index['category_overrides'] = {row[:2]: row[2] for row in cursor}
+            cursor.execute(CATEGORY_MODES_SQL)
+            index['category_modes'] = dict(cursor)
+            cursor.execute(SMS_OVERRIDES_SQL)
+            index['sms_overrides'] = {tuple(row) for row in cursor}
+        finally:
+            cursor.close()
+            connection.close()
+
+        # Swap the whole index in at once so lookups never see a partial reload
+        self.index = index
+        metrics.set('contact_index_users', len(index['users']))
+        metrics.set('contact_index_refresh_time', time() - start)
+        logger.info('Loaded contact index for %s users in %.2fs', len(index['users']), time() - start)
+
+    def run(self):
+        while True:
+            sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception:
+                metrics.incr('contact_index_refresh_fail_cnt')
+                logger.exception('Failed refreshing contact index')
+
+    def get_target_id(self, target):
+        target_id = self.index['users'].get(target) if self.index else None
+        metrics.incr('contact_index_miss_cnt' if target_id is None else 'contact_index_hit_cnt')
+        return target_id
+
+    def get_destination(self, target_id, mode_id):
+        destination = self.index['contacts'].get((target_id, mode_id))
+        if destination is None:
+            raise ValueError('target %s has no contact for mode %s' % (target_id, mode_id))
+        return destination
+
+    def lookup_priority(self, target, application, priority_id):
+        '''
+        Returns (destination, mode, mode_id) for incident messages, with the same precedence
+        as set_target_contact_by_priority: the target's setting for the application, the
+        application's default, the target's default and finally the priority's default.
+        destination is None for modes without contact info, eg drop.
+        '''
+        target_id = self.get_target_id(target)
+        if target_id is None:
+            return None
+        index = self.index
+        application_id = index['applications'].get(application)
+        if application_id is None or priority_id not in index['priority_modes']:
+            return None
+
+        mode_id = index['target_application_modes'].get((target_id, application_id, priority_id))
+        if mode_id is None:
+            mode_id = index['default_application_modes'].get((application_id, priority_id))
+        if mode_id is None:
+            mode_id = index['target_modes'].get((target_id, priority_id))
+        if mode_id is None:
+            mode_id = index['priority_modes'][priority_id]
+
+        # Make sure this mode is allowed for this application. Eg important apps can't drop.
+        if (application_id, mode_id) not in index['application_modes']:
+            raise ValueError('mode %s not allowed for application %s' % (mode_id, application))
+
+        return index['contacts'].get((target_id, mode_id)), index['mode_names'][mode_id], mode_id
+
+    def lookup_destination(self, target, mode_id=None, mode=None):
+        target_id = self.get_target_id(target)
+        if target_id is None:
+            return None
+        if mode_id is None:
+            mode_id = self.index['mode_ids'].get(mode)
+        return self.get_destination(target_id, mode_id)
+
+    def lookup_category(self, target, category_id):
+        '''
+        Returns (destination, mode, mode_id) for the target's override of a notification
+        category, or the category's default mode. None if either isn't known.
+        '''
+        target_id = self.get_target_id(target)
+        if target_id is None:
+            return None
+        index = self.index
+        mode_id = index['category_overrides'].get((target_id, category_id))
+        if mode_id is None:
+            mode_id = index['category_modes'].get(category_id)
+        if mode_id is None:
+            return None
+        return self.get_destination(target_id, mode_id), index['mode_names'][mode_id], mode_id
+
+    def has_sms_override(self, destination, mode_id):
+        return (destination, mode_id) in self.index['sms_overrides']
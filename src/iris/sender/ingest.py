@@ -0,0 +1,218 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Optional multi-process RPC ingest. Ingest processes share the sender's RPC
+# listening socket, and validate requests and expand roles there, off the hub
+# that runs escalation and sending. They forward the expanded messages to the
+# sender in batches.
+
+from gevent import sleep, socket, spawn
+from gevent.event import Event
+from time import time
+import gevent
+import os
+import signal
+from . import rpc, cache
+from .ipc import Channel
+from .workers import WorkerProcess, WORKER_INDEX_ENV, merge_stats, sender_argv, stats_report, stop_processes
+from iris import db, metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Set in the environment of ingest processes, to the fd of their end of the channel
+INGEST_FD_ENV = 'SENDER_INGEST_FD'
+# and to the fd of the RPC listening socket
+INGEST_LISTENER_FD_ENV = 'SENDER_INGEST_LISTENER_FD'
+
+# Ingest processes stop reporting the parent's load to the leader once it's this old
+LOAD_STALE_AFTER = 10
+
+
+class IngestProcessPool(object):
+    '''
+    Runs process_count ingest processes serving RPC requests on listener. Messages they
+    forward are passed to message_send_enqueue, and incident wakeups to
+    escalate_new_incident.
+    '''
+
+    def __init__(self, process_count, listener, message_send_enqueue, escalate_new_incident, argv=None):
+        fd = listener.fileno()
+        self.listener = listener
+        self.processes = [WorkerProcess(index, argv or sender_argv(), INGEST_FD_ENV,
+                                        {INGEST_LISTENER_FD_ENV: str(fd)}, (fd, ))
+                          for index in range(process_count)]
+        self.message_send_enqueue = message_send_enqueue
+        self.escalate_new_incident = escalate_new_incident
+        metrics.add_new_metrics({'ingest_process_cnt': 0, 'ingest_process_respawn_cnt': 0,
+                                 'ingest_forwarded_cnt': 0, 'ingest_forward_fail_cnt': 0})
+
+    def start(self):
+        for process in self.processes:
+            process.start(self.handle_frame)
+        metrics.set('ingest_process_cnt', len(self.processes))
+
+    def handle_frame(self, process, frame):
+        for message in frame.get('messages', []):
+            try:
+                self.message_send_enqueue(message)
+                metrics.incr('ingest_forwarded_cnt')
+            except Exception:
+                metrics.incr('ingest_forward_fail_cnt')
+                logger.exception('Failed queueing message from ingest process %s', process.index)
+        for incident_id in frame.get('incidents', []):
+            self.escalate_new_incident(incident_id)
+        ingest_stats = frame.get('stats')
+        if ingest_stats:
+            merge_stats(ingest_stats, frame.get('gauges', ()))
+
+    def maintain(self):
+        for process in self.processes:
+            if not process.is_alive():
+                logger.error('Sender ingest process %s exited with %s. Respawning', process.index, process.process.poll())
+                metrics.incr('ingest_process_respawn_cnt')
+                process.stop()
+                process.close()
+                process.start(self.handle_frame)
+
+    def run_load_reports(self, get_load, interval=1):
+        # ingest processes answer the leader's RPC, so they report our load to it
+        while True:
+            sleep(interval)
+            try:
+                load = get_load()
+            except Exception:
+                logger.exception('Failed getting send load')
+                continue
+            for process in self.processes:
+                if not process.is_alive():
+                    continue
+                try:
+                    process.channel.send({'load': load})
+                except Exception:
+                    logger.exception('Failed sending load to ingest process %s', process.index)
+
+    def stop(self, timeout=30):
+        stop_processes(self.processes, timeout)
+
+
+class IngestForwarder(object):
+    '''
+    Stands in for the sender's send_funcs in ingest processes, batching what would have
+    been queued to the parent sender. Batches go out every flush_interval seconds, or
+    as soon as batch_size messages are waiting.
+    '''
+
+    def __init__(self, channel, index, batch_size=100, flush_interval=0.01):
+        self.channel = channel
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.messages = []
+        self.incidents = []
+        self.flush_needed = Event()
+        self.parent_load = None
+        self.parent_load_time = 0
+        self.forward_key = 'ingest_%s_forward_cnt' % index
+        self.queue_key = 'ingest_%s_queue_size' % index
+        metrics.add_new_metrics({self.forward_key: 0, self.queue_key: 0})
+
+    def message_send_enqueue(self, message):
+        self.messages.append(message)
+        if len(self.messages) >= self.batch_size:
+            self.flush_needed.set()
+
+    def escalate_new_incident(self, incident_id):
+        self.incidents.append(incident_id)
+        self.flush_needed.set()
+
+    def update_load(self, load):
+        self.parent_load = load
+        self.parent_load_time = time()
+
+    def get_load(self):
+        # None leaves the leader going round robin if the parent stopped reporting
+        if time() - self.parent_load_time > LOAD_STALE_AFTER:
+            return None
+        return self.parent_load
+
+    def flush(self):
+        metrics.set(self.queue_key, len(self.messages))
+        if not self.messages and not self.incidents:
+            return
+        messages, self.messages = self.messages, []
+        incidents, self.incidents = self.incidents, []
+        self.channel.send({'messages': messages, 'incidents': incidents})
+        metrics.incr(self.forward_key, inc=len(messages))
+
+    def run(self):
+        while True:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed forwarding messages to parent sender')
+
+    def run_reports(self, interval=5):
+        while True:
+            sleep(interval)
+            try:
+                self.channel.send(stats_report())
+            except Exception:
+                logger.exception('Failed sending metrics to parent sender')
+
+
+def wait_for_parent(channel, forwarder):
+    # The parent sender only writes its send load to us; the channel closes when it goes away
+    for frame in channel:
+        if 'load' in frame:
+            forwarder.update_load(frame['load'])
+
+
+def ingest_process_main(config):
+    index = int(os.environ[WORKER_INDEX_ENV])
+    channel = Channel(socket.socket(fileno=int(os.environ[INGEST_FD_ENV])))
+    listener = socket.socket(fileno=int(os.environ[INGEST_LISTENER_FD_ENV]))
+    forwarder = IngestForwarder(channel, index,
+                                config['sender'].get('ingest_batch_size', 100),
+                                config['sender'].get('ingest_flush_interval_ms', 10) / 1000.0)
+
+    def shutdown():
+        rpc.shutdown()
+        try:
+            forwarder.flush()
+        except Exception:
+            logger.exception('Failed forwarding messages to parent sender')
+        os._exit(0)
+
+    for signum in (signal.SIGINT, signal.SIGTERM, signal.SIGQUIT):
+        gevent.signal_handler(signum, shutdown)
+
+    # role lookups need the sender's caches
+    db.init(config)
+    cache.init(config)
+    metrics.init(config, 'iris-sender', {'api_request_cnt': 0, 'api_request_timeout_cnt': 0, 'notification_cnt': 0})
+    accept_key = 'ingest_%s_accept_cnt' % index
+    metrics.add_new_metrics({accept_key: 0})
+
+    def handle(sock, address):
+        metrics.incr(accept_key)
+        rpc.handle_api_request(sock, address)
+
+    rpc.init(config['sender'], dict(
+        message_send_enqueue=forwarder.message_send_enqueue,
+        escalate_new_incident=forwarder.escalate_new_incident,
+        get_load=forwarder.get_load
+    ))
+    spawn(forwarder.run)
+    spawn(forwarder.run_reports)
+    if not rpc.run(config['sender'], listener, handle):
+        shutdown()
+    logger.info('[*] sender ingest process %s serving RPC', index)
+
+    parent_task = spawn(wait_for_parent, channel, forwarder)
+    while not parent_task.ready():
+        parent_task.join(60)
+        cache.purge()
+    logger.info('Parent sender went away')
+    shutdown()
@@ -0,0 +1,59 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# msgpack framed messages between the sender and its worker processes, over a
+# local stream socket. msgpack is self delimiting, so there's no length prefix.
+
+from datetime import datetime
+from gevent.lock import Semaphore
+import msgpack
+import logging
+
+logger = logging.getLogger(__name__)
+
+DATETIME_EXT_TYPE = 1
+
+
+def pack_default(obj):
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    # eg incident_created, which templates can use through the iris context
+    if isinstance(obj, datetime):
+        return msgpack.ExtType(DATETIME_EXT_TYPE, obj.isoformat().encode('utf-8'))
+    raise TypeError('Cannot serialize %r' % (obj, ))
+
+
+def unpack_ext_hook(code, data):
+    if code == DATETIME_EXT_TYPE:
+        return datetime.fromisoformat(data.decode('utf-8'))
+    return msgpack.ExtType(code, data)
+
+
+class Channel(object):
+    def __init__(self, sock):
+        self.sock = sock
+        self.unpacker = msgpack.Unpacker(raw=False, ext_hook=unpack_ext_hook)
+        self.send_lock = Semaphore()
+
+    def send(self, obj):
+        payload = msgpack.packb(obj, default=pack_default, use_bin_type=True)
+        with self.send_lock:
+            self.sock.sendall(payload)
+
+    def __iter__(self):
+        '''
+        Yields messages as they arrive, until the other end closes the socket.
+        '''
+        while True:
+            for obj in self.unpacker:
+                yield obj
+            data = self.sock.recv(65536)
+            if not data:
+                return
+            self.unpacker.feed(data)
+
+    def close(self):
+        try:
+            self.sock.close()
+        except Exception:
+            logger.exception('Failed closing worker channel')
@@ -2,6 +2,7 @@
 # See LICENSE in the project root for license information.
 
 from .. import db
+from .. import cache as api_cache
 import logging
 
 logger = logging.getLogger(__name__)
@@ -13,7 +14,9 @@ def update_message_mode(message):
         return
 
     session = db.Session()
-    mode_id = session.execute('SELECT `id` FROM `mode` WHERE `name` = :mode', message).scalar()
+    mode_id = api_cache.modes.get(message['mode'])
+    if not mode_id:
+        mode_id = session.execute('SELECT `id` FROM `mode` WHERE `name` = :mode', message).scalar()
 
     # Need to update mode_id in the dictionary as its gets set in DB in other parts of the sender
     if mode_id:
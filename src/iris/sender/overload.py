@@ -0,0 +1,120 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Load shedding for when messages come in faster than vendors take them. While the
+# sender is overloaded, less important messages are dropped or left in the DB for
+# later, so pages for urgent incidents don't wait behind them.
+
+from gevent import sleep
+from time import time
+from iris import metrics
+from .queues import oldest_queued
+import logging
+
+logger = logging.getLogger(__name__)
+
+SHED = 'shed'
+DEFER = 'defer'
+
+DEFAULT_RULES = [{'priority': 'low', 'action': DEFER}]
+
+
+class OverloadController(object):
+    '''
+    Checks the send queues every check_interval seconds. The sender becomes overloaded
+    once they hold enter_depth messages in all, or one has had a message waiting
+    enter_age seconds, and stays so until both are back down to exit_depth and exit_age
+    (by default, half of those).
+
+    While overloaded, action() gives what to do with a message: the action of the first
+    of rules whose priority, mode and application (each a name or a list of them, any
+    if missing) all match. Shed messages are dropped; deferred ones stay in the DB and
+    are passed to recheck() once the sender recovers. Retries, messages forwarded to
+    followers and aggregated batches are always sent.
+    '''
+
+    def __init__(self, send_queues, recheck, enter_depth=5000, exit_depth=None, enter_age=300, exit_age=None,
+                 rules=None, check_interval=1):
+        self.send_queues = send_queues
+        self.recheck = recheck
+        self.enter_depth = enter_depth
+        self.exit_depth = enter_depth // 2 if exit_depth is None else exit_depth
+        self.enter_age = enter_age
+        self.exit_age = enter_age / 2 if exit_age is None else exit_age
+        self.rules = [self.parse_rule(rule) for rule in (DEFAULT_RULES if rules is None else rules)]
+        self.check_interval = check_interval
+        self.overloaded = False
+        self.deferred = set()
+        metrics.add_new_metrics({'overload_active': 0, 'overload_enter_cnt': 0, 'overload_shed_cnt': 0,
+                                 'overload_defer_cnt': 0, 'send_queue_total_size': 0, 'send_queue_oldest_age': 0})
+
+    @staticmethod
+    def parse_rule(rule):
+        action = rule.get('action', DEFER)
+        if action not in (SHED, DEFER):
+            raise ValueError('Invalid overload action %s' % action)
+        parsed = {'action': action}
+        for field in ('priority', 'mode', 'application'):
+            value = rule.get(field)
+            if value is not None:
+                parsed[field] = {value} if isinstance(value, str) else set(value)
+        return parsed
+
+    def measure(self):
+        now = time()
+        depth = 0
+        age = 0
+        for send_queue in list(self.send_queues.values()):
+            depth += len(send_queue)
+            queued = oldest_queued(send_queue)
+            if queued is not None:
+                age = max(age, now - queued)
+        return depth, age
+
+    def check(self):
+        depth, age = self.measure()
+        metrics.set('send_queue_total_size', depth)
+        metrics.set('send_queue_oldest_age', age)
+        if not self.overloaded and (depth >= self.enter_depth or age >= self.enter_age):
+            logger.warning('Sender overloaded with %s queued messages, the oldest %.1f seconds old. Shedding load',
+                           depth, age)
+            self.overloaded = True
+            metrics.incr('overload_enter_cnt')
+        elif self.overloaded and depth <= self.exit_depth and age <= self.exit_age:
+            logger.info('Sender recovered with %s queued messages. Rechecking %s deferred messages',
+                        depth, len(self.deferred))
+            self.overloaded = False
+            deferred, self.deferred = self.deferred, set()
+            self.recheck(deferred)
+        metrics.set('overload_active', int(self.overloaded))
+
+    def action(self, message):
+        if not self.overloaded or message.get('retry_count') or message.get('to_follower') or \
+                'aggregated_ids' in message:
+            return None
+        for rule in self.rules:
+            if all(message.get(field) in rule[field] for field in ('priority', 'mode', 'application') if field in rule):
+                action = rule['action']
+                # there's nothing in the DB to pick a message without an id up later
+                if action == DEFER and not message.get('message_id'):
+                    return None
+                metrics.incr('overload_shed_cnt' if action == SHED else 'overload_defer_cnt')
+                return action
+        return None
+
+    def defer(self, message_id):
+        '''
+        Returns whether message_id wasn't deferred already.
+        '''
+        if message_id in self.deferred:
+            return False
+        self.deferred.add(message_id)
+        return True
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                logger.exception('Failed checking sender load')
+            sleep(self.check_interval)
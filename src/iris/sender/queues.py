@@ -0,0 +1,335 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from collections import deque, Counter, OrderedDict
+from gevent.lock import Semaphore
+from gevent.queue import Empty
+from iris import metrics
+from .ipc import pack_default, unpack_ext_hook
+import msgpack
+import os
+import struct
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRIORITIES = ['urgent', 'high', 'medium', 'low']
+
+# application -> messages waiting in all send queues with per_application set
+application_backlog = Counter()
+
+
+class LaneQueue(object):
+    '''
+    Drop-in replacement for a mode's gevent send queue, with a lane per message
+    priority so urgent messages don't wait behind a backlog of low priority ones.
+
+    With the strict policy, get() always takes from the most important non-empty
+    lane. With the weighted policy, lanes take turns in proportion to their weights
+    (smooth weighted round robin), so lower lanes still make progress. Messages of
+    priorities not in priorities go in the last lane.
+
+    If per_application is set, each lane keeps a queue per application and shares
+    itself between them by deficit round robin, so one application's storm doesn't
+    hold up the others. Each turn, an application gets its weight from
+    application_weights (default_application_weight if not there) in credit, and
+    sends a message per whole credit.
+    '''
+
+    def __init__(self, mode, priorities=DEFAULT_PRIORITIES, policy='strict', weights=None, per_application=False,
+                 application_weights=None, default_application_weight=1):
+        self.mode = mode
+        self.priorities = list(priorities)
+        self.policy = policy
+        self.weights = [(weights or {}).get(priority, 2 ** (len(self.priorities) - idx - 1))
+                        for idx, priority in enumerate(self.priorities)]
+        self.per_application = per_application
+        self.application_weights = application_weights or {}
+        self.default_application_weight = default_application_weight
+        if min(list(self.application_weights.values()) + [default_application_weight]) <= 0:
+            raise ValueError('Application weights need to be positive')
+        self.lanes = [OrderedDict() for _ in self.priorities]  # application (or None) -> deque
+        self.deficits = [{} for _ in self.priorities]  # application (or None) -> credit left
+        self.lane_sizes = [0] * len(self.priorities)
+        self.credits = [0] * len(self.priorities)
+        self.available = Semaphore(0)
+        self.size = 0
+        self.size_keys = ['send_queue_%s_%s_size' % (mode, priority) for priority in self.priorities]
+        self.wait_keys = ['send_queue_%s_%s_wait_max' % (mode, priority) for priority in self.priorities]
+        metrics.add_new_metrics({key: 0 for key in self.size_keys + self.wait_keys})
+
+    def lane(self, message):
+        try:
+            return self.priorities.index(message.get('priority'))
+        except ValueError:
+            return len(self.priorities) - 1
+
+    def put(self, message, block=True, timeout=None):
+        idx = self.lane(message)
+        application = message.get('application') if self.per_application else None
+        queue = self.lanes[idx].get(application)
+        if queue is None:
+            queue = self.lanes[idx][application] = deque()
+        queue.append((time.time(), message))
+        self.lane_sizes[idx] += 1
+        self.size += 1
+        if self.per_application:
+            application_backlog[application] += 1
+        self.available.release()
+
+    put_nowait = put
+
+    def next_lane(self):
+        if self.policy != 'weighted':
+            return next(idx for idx, size in enumerate(self.lane_sizes) if size)
+        # smooth weighted round robin over the non-empty lanes
+        active = [idx for idx, size in enumerate(self.lane_sizes) if size]
+        total = 0
+        for idx in active:
+            self.credits[idx] += self.weights[idx]
+            total += self.weights[idx]
+        chosen = max(active, key=lambda idx: self.credits[idx])
+        self.credits[chosen] -= total
+        return chosen
+
+    def get(self, block=True, timeout=None):
+        if not self.available.acquire(blocking=block, timeout=timeout if block else None):
+            raise Empty()
+        idx = self.next_lane()
+        lane = self.lanes[idx]
+        deficits = self.deficits[idx]
+        while True:
+            application, queue = next(iter(lane.items()))
+            if deficits.get(application, 0) < 1:
+                weight = self.application_weights.get(application, self.default_application_weight)
+                deficits[application] = deficits.get(application, 0) + weight
+            if deficits[application] >= 1:
+                break
+            # not enough credit for a message yet, so it waits for its next turn
+            lane.move_to_end(application)
+        queued, message = queue.popleft()
+        deficits[application] -= 1
+        if not queue:
+            del lane[application]
+            del deficits[application]
+        elif deficits[application] < 1:
+            # the next application in this lane goes next time
+            lane.move_to_end(application)
+        self.lane_sizes[idx] -= 1
+        self.size -= 1
+
+        wait = time.time() - queued
+        if wait > metrics.stats.get(self.wait_keys[idx], 0):
+            metrics.set(self.wait_keys[idx], wait)
+        if self.per_application:
+            application_backlog[application] -= 1
+            key = 'application_%s_send_wait_max' % application
+            if wait > metrics.stats.get(key, 0):
+                metrics.add_new_metrics({key: 0})
+                metrics.set(key, wait)
+        return message
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def evict(self, idx):
+        '''
+        Takes the newest message of the least important non-empty lane after lane idx
+        out of the queue, to make room for a message of lane idx. None if there isn't any.
+        '''
+        for lowest in range(len(self.lanes) - 1, idx, -1):
+            if self.lane_sizes[lowest]:
+                break
+        else:
+            return None
+        lane = self.lanes[lowest]
+        application, queue = next(reversed(lane.items()))
+        queued, message = queue.pop()
+        if not queue:
+            del lane[application]
+            self.deficits[lowest].pop(application, None)
+        self.available.acquire(blocking=False)
+        self.lane_sizes[lowest] -= 1
+        self.size -= 1
+        if self.per_application:
+            application_backlog[application] -= 1
+        return message
+
+    def qsize(self):
+        return self.size
+
+    def __len__(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def oldest(self):
+        return min((queue[0][0] for lane in self.lanes for queue in lane.values()), default=None)
+
+    def update_metrics(self):
+        for key, size in zip(self.size_keys, self.lane_sizes):
+            metrics.set(key, size)
+        if self.per_application:
+            update_application_metrics()
+
+
+def oldest_queued(send_queue):
+    '''
+    When the message waiting longest in send_queue was queued, or None if it's empty or
+    we don't know.
+    '''
+    if hasattr(send_queue, 'oldest'):
+        return send_queue.oldest()
+    # plain gevent queues of messages stamped by the sender
+    try:
+        return send_queue.queue[0].get('queued')
+    except (AttributeError, IndexError):
+        return None
+
+
+def update_application_metrics():
+    for application, size in list(application_backlog.items()):
+        key = 'application_%s_send_backlog' % application
+        metrics.add_new_metrics({key: 0})
+        metrics.set(key, size)
+        if not size:
+            del application_backlog[application]
+
+
+class SpillQueue(object):
+    '''
+    Bounds a send queue to max_size messages in memory. Past that, messages are
+    appended to the file at path, and read back into the queue as it drains, most
+    important lane first when it's a LaneQueue.
+
+    Messages wait behind spilled ones at least as important as them, so those don't
+    starve. An important message that finds memory full spills the newest message of
+    a less important lane instead of itself.
+
+    Messages spilled by a previous run of the sender are picked up again, except for
+    those with message ids, which the next poll gets from the DB anyway.
+    '''
+
+    HEADER = struct.Struct('>I')
+
+    def __init__(self, queue, mode, path, max_size):
+        self.queue = queue
+        self.path = path
+        self.max_size = max_size
+        self.spilled = 0
+        self.spilled_lanes = {}  # lane -> deque of offsets of its spilled messages
+        self.spill_key = 'send_queue_%s_spill_cnt' % mode
+        self.refill_key = 'send_queue_%s_refill_cnt' % mode
+        self.spilled_key = 'send_queue_%s_spilled_size' % mode
+        metrics.add_new_metrics({self.spill_key: 0, self.refill_key: 0, self.spilled_key: 0})
+        self.recover()
+
+    def recover(self):
+        try:
+            with open(self.path, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = b''
+        messages = []
+        offset = 0
+        while offset + self.HEADER.size <= len(data):
+            length, = self.HEADER.unpack_from(data, offset)
+            payload = data[offset + self.HEADER.size:offset + self.HEADER.size + length]
+            offset += self.HEADER.size + length
+            if len(payload) < length:
+                break
+            message = msgpack.unpackb(payload, raw=False, ext_hook=unpack_ext_hook)
+            if not message.get('message_id'):
+                messages.append(message)
+        self.file = open(self.path, 'w+b')
+        if messages:
+            logger.info('Recovered %s spilled messages from %s', len(messages), self.path)
+        for message in messages:
+            self.spill(message)
+
+    def lane(self, message):
+        return self.queue.lane(message) if hasattr(self.queue, 'lane') else 0
+
+    def spill(self, message, evicted=False):
+        payload = msgpack.packb(message, default=pack_default, use_bin_type=True)
+        offset = self.file.seek(0, os.SEEK_END)
+        self.file.write(self.HEADER.pack(len(payload)) + payload)
+        self.file.flush()
+        offsets = self.spilled_lanes.setdefault(self.lane(message), deque())
+        # messages evicted from memory are older than the ones spilled from their lane
+        if evicted:
+            offsets.appendleft(offset)
+        else:
+            offsets.append(offset)
+        self.spilled += 1
+        metrics.incr(self.spill_key)
+
+    def refill(self):
+        while self.spilled and len(self.queue) < self.max_size:
+            idx = min(self.spilled_lanes)
+            offsets = self.spilled_lanes[idx]
+            self.file.seek(offsets[0])
+            length, = self.HEADER.unpack(self.file.read(self.HEADER.size))
+            message = msgpack.unpackb(self.file.read(length), raw=False, ext_hook=unpack_ext_hook)
+            offsets.popleft()
+            if not offsets:
+                del self.spilled_lanes[idx]
+            self.spilled -= 1
+            self.queue.put(message)
+            metrics.incr(self.refill_key)
+            if not self.spilled:
+                # all read back, so start over with an empty file
+                self.file.truncate(0)
+
+    def put(self, message, block=True, timeout=None):
+        idx = self.lane(message)
+        spilled_ahead = self.spilled and min(self.spilled_lanes) <= idx
+        # the spill file is only read back as the queue drains, so new messages
+        # go after the spilled ones they'd otherwise overtake
+        if not spilled_ahead and len(self.queue) < self.max_size:
+            self.queue.put(message)
+            return
+        evicted = None
+        if not spilled_ahead and hasattr(self.queue, 'evict'):
+            evicted = self.queue.evict(idx)
+            if evicted is not None:
+                self.queue.put(message)
+                message = evicted
+        try:
+            self.spill(message, evicted is not None)
+        except Exception:
+            # better to risk running out of memory than to drop the message
+            logger.exception('Failed spilling message to %s', self.path)
+            self.queue.put(message)
+
+    put_nowait = put
+
+    def get(self, block=True, timeout=None):
+        if self.spilled:
+            try:
+                self.refill()
+            except Exception:
+                logger.exception('Failed reading spilled messages back from %s', self.path)
+        return self.queue.get(block, timeout)
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def qsize(self):
+        return len(self.queue) + self.spilled
+
+    def __len__(self):
+        return len(self.queue) + self.spilled
+
+    def empty(self):
+        return not len(self)
+
+    def oldest(self):
+        return oldest_queued(self.queue)
+
+    def update_metrics(self):
+        metrics.set(self.spilled_key, self.spilled)
+        if hasattr(self.queue, 'update_metrics'):
+            self.queue.update_metrics()
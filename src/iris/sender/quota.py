@@ -4,10 +4,10 @@
 from time import time
 from gevent import spawn, sleep
 from gevent.lock import Semaphore
-from collections import deque
 from datetime import datetime
 import iris.cache
 from iris import metrics
+from .window import SlidingWindowCounter
 import logging
 import ujson
 
@@ -87,11 +87,14 @@ class ApplicationQuota(object):
         else:
             logger.warning('Iris sender_app not configured so notifications for quota breaches will not work')
 
-        self.rates = {}  # application: (hard_buckets, soft_buckets, hard_limit, soft_limit, wait_time, plan_name, (target_name, target_role))
+        self.rates = {}  # application: (hard_window, soft_window, hard_limit, soft_limit, wait_time, plan_name, (target_name, target_role))
         self.last_incidents = {}  # application: (incident_id, time())
         self.last_incidents_mutex = Semaphore()
         self.last_soft_quota_notification_time = {}  # application: time()
         self.last_soft_quota_notification_time_mutex = Semaphore()
+        # Fraction of the applications' messages this sender counts. Partitioned senders each
+        # count only the messages of their own partitions, so their limits shrink to match.
+        self.share = 1
         metrics.add_new_metrics({'quota_hard_exceed_cnt': 0, 'quota_soft_exceed_cnt': 0})
         spawn(self.refresh)
 
@@ -126,24 +129,22 @@ class ApplicationQuota(object):
                 except KeyError:
                     pass
 
-            # Create new ones with fresh buckets
+            # Create new ones with fresh windows of minute buckets
             for key in new_keys - old_keys:
                 hard_limit, soft_limit, hard_duration, soft_duration, wait_time, plan_name, target = new_rates[key]
-                self.rates[key] = (deque([0] * hard_duration, maxlen=hard_duration),  # hard buckets
-                                   deque([0] * soft_duration, maxlen=soft_duration),  # soft buckets
+                self.rates[key] = (SlidingWindowCounter(hard_duration * 60, hard_duration),  # hard window
+                                   SlidingWindowCounter(soft_duration * 60, soft_duration),  # soft window
                                    hard_limit, soft_limit, wait_time, plan_name, target)
 
-            # Update existing ones + append new time interval. Keep same time bucket object if duration hasn't changed, otherwise create new
-            # one and resize accordingly
+            # Update existing ones. Keep the same window if duration hasn't changed, otherwise resize it
             for key in new_keys & old_keys:
                 hard_limit, soft_limit, hard_duration, soft_duration, wait_time, plan_name, target = new_rates[key]
-                self.rates[key] = (self.rates[key][0] if len(self.rates[key][0]) == hard_duration else deque(self.rates[key][0], maxlen=hard_duration),
-                                   self.rates[key][1] if len(self.rates[key][1]) == soft_duration else deque(self.rates[key][1], maxlen=soft_duration),
-                                   hard_limit, soft_limit, wait_time, plan_name, target)
-
-                # Increase minute interval for hard + soft buckets
-                self.rates[key][0].append(0)
-                self.rates[key][1].append(0)
+                hard_window, soft_window = self.rates[key][0:2]
+                if hard_window.duration != hard_duration * 60:
+                    hard_window = hard_window.resized(hard_duration * 60, hard_duration)
+                if soft_window.duration != soft_duration * 60:
+                    soft_window = soft_window.resized(soft_duration * 60, soft_duration)
+                self.rates[key] = (hard_window, soft_window, hard_limit, soft_limit, wait_time, plan_name, target)
 
             metrics.add_new_metrics({'app_%s_quota_%s_usage_pct' % (app, quota_type): 0 for quota_type in ('hard', 'soft') for app in new_keys})
 
@@ -166,14 +167,16 @@ class ApplicationQuota(object):
         if not rate:
             return True
 
-        hard_buckets, soft_buckets, hard_limit, soft_limit, wait_time, plan_name, target = rate
+        hard_window, soft_window, hard_limit, soft_limit, wait_time, plan_name, target = rate
+        hard_limit *= self.share
+        soft_limit *= self.share
 
-        # Increment both buckets for this minute
-        hard_buckets[-1] += 1
-        soft_buckets[-1] += 1
+        # Count this message in both windows
+        now = time()
+        hard_quota_usage = hard_window.add(now=now)
+        soft_quota_usage = soft_window.add(now=now)
 
         # If hard limit breached, disallow sending this message and create incident
-        hard_quota_usage = sum(hard_buckets)
 
         hard_usage_pct = 0
         if hard_limit > 0:
@@ -184,12 +187,10 @@ class ApplicationQuota(object):
             metrics.incr('quota_hard_exceed_cnt')
             if plan_name:
                 with self.last_incidents_mutex:
-                    self.notify_incident(application, hard_limit, len(hard_buckets), plan_name, wait_time)
+                    self.notify_incident(application, hard_limit, len(hard_window.ring), plan_name, wait_time)
             return False
 
         # If soft limit breached, just notify owner and still send
-        soft_quota_usage = sum(soft_buckets)
-
         soft_usage_pct = 0
         if soft_limit > 0:
             soft_usage_pct = (soft_quota_usage // soft_limit) * 100
@@ -199,7 +200,7 @@ class ApplicationQuota(object):
             metrics.incr('quota_soft_exceed_cnt')
             if target:
                 with self.last_soft_quota_notification_time_mutex:
-                    self.notify_target(application, soft_limit, len(soft_buckets), *target)
+                    self.notify_target(application, soft_limit, len(soft_window.ring), *target)
             return True
 
         return True
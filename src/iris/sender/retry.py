@@ -0,0 +1,82 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from heapq import heappush, heappop
+from itertools import count
+from gevent.event import Event
+from time import time
+from iris import metrics
+import random
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class RetryScheduler(object):
+    '''
+    Holds messages that failed to send until their retry is due, then passes them to
+    enqueue(message), so retries back off from a broken vendor instead of going right
+    back in the send queue ahead of fresh messages.
+
+    The nth retry waits base_delay * multiplier ** (n - 1) seconds, at most max_delay,
+    give or take a random jitter fraction of it. modes maps mode names to dicts
+    overriding any of those. Messages that first failed more than max_age seconds ago
+    aren't retried anymore; schedule() returns False for them.
+    '''
+
+    def __init__(self, enqueue, base_delay=1, max_delay=60, multiplier=2, jitter=0.2, max_age=600, modes=None):
+        self.enqueue = enqueue
+        self.defaults = {'base_delay': base_delay, 'max_delay': max_delay, 'multiplier': multiplier,
+                         'jitter': jitter}
+        self.max_age = max_age
+        self.modes = modes or {}
+        self.heap = []  # (due, seq, message)
+        self.seq = count()
+        self.wakeup = Event()
+        metrics.add_new_metrics({'retry_pending': 0, 'retry_scheduled_cnt': 0, 'retry_due_cnt': 0,
+                                 'retry_expired_cnt': 0, 'retry_delay_max': 0})
+
+    def __len__(self):
+        return len(self.heap)
+
+    def delay(self, message):
+        settings = dict(self.defaults, **self.modes.get(message.get('mode'), {}))
+        delay = settings['base_delay'] * settings['multiplier'] ** max(message.get('retry_count', 1) - 1, 0)
+        delay = min(delay, settings['max_delay'])
+        return max(delay * (1 + random.uniform(-settings['jitter'], settings['jitter'])), 0)
+
+    def schedule(self, message, now=None):
+        if now is None:
+            now = time()
+        first_failed = message.setdefault('first_failed', now)
+        if now - first_failed > self.max_age:
+            metrics.incr('retry_expired_cnt')
+            return False
+        delay = self.delay(message)
+        due = now + delay
+        if not self.heap or due < self.heap[0][0]:
+            self.wakeup.set()
+        heappush(self.heap, (due, next(self.seq), message))
+        metrics.incr('retry_scheduled_cnt')
+        metrics.set('retry_pending', len(self.heap))
+        if delay > metrics.stats.get('retry_delay_max', 0):
+            metrics.set('retry_delay_max', delay)
+        return True
+
+    def pop_due(self, now):
+        messages = []
+        while self.heap and self.heap[0][0] <= now:
+            messages.append(heappop(self.heap)[2])
+        metrics.set('retry_pending', len(self.heap))
+        return messages
+
+    def run(self):
+        while True:
+            self.wakeup.clear()
+            for message in self.pop_due(time()):
+                metrics.incr('retry_due_cnt')
+                try:
+                    self.enqueue(message)
+                except Exception:
+                    logger.exception('Failed queueing retry of message %s', message.get('message_id'))
+            self.wakeup.wait(self.heap[0][0] - time() if self.heap else None)
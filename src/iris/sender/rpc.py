@@ -2,11 +2,15 @@
 # See LICENSE in the project root for license information.
 
 import os
-from gevent import Timeout, socket
+from gevent import Timeout, socket, spawn_later
+from gevent.event import AsyncResult
+from gevent.lock import BoundedSemaphore
+from gevent.queue import Queue, Empty
 from gevent.server import StreamServer
 import msgpack
 from ..utils import msgpack_unpack_msg_from_socket, sanitize_unicode_dict
 from . import cache
+from .balancer import FollowerBalancer
 from iris import metrics
 from iris.role_lookup import IrisRoleLookupException
 
@@ -20,6 +24,15 @@ send_funcs = {}
 rpc_timeout = None
 rpc_server = None
 
+# address -> FollowerBatcher, if sender.follower_connections is set
+follower_batchers = {}
+follower_connections_config = None
+# how long followers keep pooled connections from the leader open without batches
+follower_idle_timeout = 300
+
+# Tracks the load followers report, if sender.follower_balancing is set
+follower_balancer = None
+
 
 def msgpack_handle_sets(obj):
     if isinstance(obj, set):
@@ -27,10 +40,49 @@ def msgpack_handle_sets(obj):
 
 
 def generate_msgpack_message_payload(message):
-    return msgpack.packb({'endpoint': 'v0/follower_send', 'data': message}, default=msgpack_handle_sets)
+    payload = {'endpoint': 'v0/follower_send', 'data': message}
+    if follower_balancer is not None:
+        payload['report_load'] = True
+    return msgpack.packb(payload, default=msgpack_handle_sets)
+
+
+def get_load():
+    get_load = send_funcs.get('get_load')
+    return get_load() if get_load else None
+
+
+def load_reported(address, resp, key):
+    '''
+    Followers asked to report their load reply with a dict holding it and the usual
+    response under key. Returns the usual response.
+    '''
+    if not isinstance(resp, dict):
+        return resp
+    if follower_balancer is not None:
+        follower_balancer.update(address, resp.get('load'))
+    return resp.get(key)
+
+
+def prune_followers(addresses):
+    '''
+    Drops what we keep about followers that aren't in addresses anymore.
+    '''
+    addresses = set(addresses)
+    for address in list(follower_batchers):
+        if address not in addresses:
+            logger.info('Closing connections to departed follower %s:%s', *address)
+            follower_batchers.pop(address).close()
+    if follower_balancer is not None:
+        follower_balancer.prune(addresses)
 
 
 def send_message_to_follower(message, address):
+    if follower_connections_config is not None:
+        batcher = follower_batchers.get(address)
+        if batcher is None:
+            batcher = follower_batchers[address] = FollowerBatcher(address, **follower_connections_config)
+        return batcher.send(message)
+
     try:
         payload = generate_msgpack_message_payload(message)
     except TypeError:
@@ -51,6 +103,7 @@ def send_message_to_follower(message, address):
         metrics.incr('rpc_message_pass_fail_cnt')
         return False
 
+    sender_resp = load_reported(address, sender_resp, 'status')
     if sender_resp == 'OK':
         access_logger.info('Successfully passed message (ID %s) to %s for sending',
                            message_id, pretty_address)
@@ -63,6 +116,204 @@ def send_message_to_follower(message, address):
         return False
 
 
+class FollowerClosedConnection(socket.error):
+    '''
+    The follower closed the connection before replying at all, most likely for being
+    idle before our request got to it.
+    '''
+
+
+class FollowerConnection(object):
+    def __init__(self, address):
+        self.sock = socket.create_connection(address)
+        self.unpacker = msgpack.Unpacker()
+        metrics.incr('rpc_follower_connect_cnt')
+
+    def request(self, payload):
+        replied = False
+        try:
+            self.sock.sendall(payload)
+            while True:
+                for resp in self.unpacker:
+                    return resp
+                buf = self.sock.recv(65536)
+                if not buf:
+                    raise socket.error('Follower closed connection')
+                replied = True
+                self.unpacker.feed(buf)
+        except socket.error as e:
+            if replied:
+                raise
+            raise FollowerClosedConnection(str(e))
+
+    def close(self):
+        self.sock.close()
+
+
+class FollowerBatcher(object):
+    '''
+    Passes messages to one follower over up to pool_size long-lived connections. Messages
+    sent within flush_interval seconds of each other go out together in
+    v0/follower_send_batch requests of up to batch_size, which the follower acks message
+    by message. send() returns False for messages that weren't acked, so they can be
+    sent some other way, except for ones whose batch went out but never finished,
+    which the follower may be sending already.
+    '''
+
+    def __init__(self, address, pool_size=4, batch_size=100, flush_interval_ms=5):
+        self.address = address
+        self.pretty_address = '%s:%s' % address
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval_ms / 1000.0
+        self.pending = []  # (message, AsyncResult)
+        self.in_flight = set()  # AsyncResults of messages in requests under way
+        self.flush_scheduled = False
+        self.connections = Queue()
+        self.connection_slots = BoundedSemaphore(pool_size)
+        self.closed = False
+        metrics.add_new_metrics({'rpc_follower_connect_cnt': 0, 'rpc_follower_batch_cnt': 0,
+                                 'rpc_follower_batch_fail_cnt': 0})
+
+    def send(self, message):
+        result = AsyncResult()
+        self.pending.append((message, result))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            spawn_later(self.flush_interval, self.flush)
+        # send_batch() gives up after waiting for a connection and trying two of them,
+        # so this only guards against it never setting the result
+        timeout = None if rpc_timeout is None else self.flush_interval + 3 * rpc_timeout + 1
+        try:
+            return result.get(timeout=timeout)
+        except Timeout:
+            pass
+        if result in self.in_flight:
+            # Sending it some other way too could page twice. Messages the follower
+            # never sends stay active in the DB for the next full poll.
+            logger.error('Timed out waiting for %s to ack message (ID %s). Leaving it to the follower',
+                         self.pretty_address, message.get('message_id', '?'))
+            return True
+        # send_batch() drops messages whose result is set before they go out
+        result.set(False)
+        logger.error('Timed out passing message (ID %s) to %s', message.get('message_id', '?'), self.pretty_address)
+        metrics.incr('rpc_message_pass_fail_cnt')
+        return False
+
+    def flush(self):
+        self.flush_scheduled = False
+        while self.pending:
+            batch, self.pending = self.pending[:self.batch_size], self.pending[self.batch_size:]
+            # send_batch() waits for a free connection, so don't hold up whoever called flush()
+            spawn_later(0, self.send_batch, batch)
+
+    def encode(self, batch):
+        messages = [message for message, _ in batch]
+        try:
+            return batch, self.payload(messages)
+        except TypeError:
+            pass
+        encodable = []
+        for message, result in batch:
+            try:
+                msgpack.packb(message, default=msgpack_handle_sets)
+                encodable.append((message, result))
+            except TypeError:
+                logger.exception('Failed encoding message %s as msgpack', message)
+                metrics.incr('rpc_message_pass_fail_cnt')
+                result.set(False)
+        return encodable, self.payload([message for message, _ in encodable])
+
+    def payload(self, messages):
+        payload = {'endpoint': 'v0/follower_send_batch', 'data': messages}
+        if follower_balancer is not None:
+            payload['report_load'] = True
+        return msgpack.packb(payload, default=msgpack_handle_sets)
+
+    def request_over(self, connection, payload):
+        # connects too if connection is None, within the same timeout
+        try:
+            with Timeout(rpc_timeout):
+                if connection is None:
+                    connection = FollowerConnection(self.address)
+                resp = connection.request(payload)
+        except (Exception, Timeout):
+            if connection is not None:
+                connection.close()
+            raise
+        if self.closed:
+            connection.close()
+        else:
+            self.connections.put(connection)
+        return resp
+
+    def close(self):
+        # requests under way close their connections once they're done
+        self.closed = True
+        while True:
+            try:
+                self.connections.get_nowait().close()
+            except Empty:
+                break
+
+    def request(self, payload):
+        try:
+            connection = self.connections.get_nowait()
+        except Empty:
+            return self.request_over(None, payload)
+        try:
+            return self.request_over(connection, payload)
+        except FollowerClosedConnection:
+            # the follower closed it for being idle, so try a fresh one. Any later
+            # failure, timeouts included, may come after it got the batch, and
+            # retrying would send those messages twice.
+            return self.request_over(None, payload)
+
+    def send_batch(self, batch):
+        encodable = []
+        try:
+            if not self.connection_slots.acquire(timeout=rpc_timeout):
+                logger.error('Failed passing %s messages to %s: no connection free', len(batch), self.pretty_address)
+                metrics.incr('rpc_follower_batch_fail_cnt')
+                return
+            try:
+                # leave out messages whose sender stopped waiting for us
+                encodable, payload = self.encode([(message, result) for message, result in batch if not result.ready()])
+                if not encodable:
+                    return
+                self.in_flight.update(result for _, result in encodable)
+                try:
+                    acks = load_reported(self.address, self.request(payload), 'acks')
+                except (socket.error, Timeout):
+                    logger.exception('Failed passing %s messages to %s', len(encodable), self.pretty_address)
+                    acks = None
+            finally:
+                self.connection_slots.release()
+            metrics.incr('rpc_follower_batch_cnt')
+
+            if not isinstance(acks, list) or len(acks) != len(encodable):
+                if acks is not None:
+                    logger.error('Failed sending %s messages through %s: %s', len(encodable), self.pretty_address, acks)
+                metrics.incr('rpc_follower_batch_fail_cnt')
+                acks = [False] * len(encodable)
+
+            for (message, result), ack in zip(encodable, acks):
+                if ack is True:
+                    access_logger.info('Successfully passed message (ID %s) to %s for sending',
+                                       message.get('message_id', '?'), self.pretty_address)
+                    metrics.incr('rpc_message_pass_success_cnt')
+                else:
+                    metrics.incr('rpc_message_pass_fail_cnt')
+                result.set(ack is True)
+        finally:
+            self.in_flight.difference_update(result for _, result in encodable)
+            # whatever went wrong, senders waiting on these send the messages some other way
+            for _, result in batch:
+                if not result.ready():
+                    result.set(False)
+
+
 def reject_api_request(socket, address, err_msg):
     logger.info('-> %s %s', address, err_msg)
     socket.sendall(msgpack.packb(err_msg))
@@ -189,17 +440,63 @@ def handle_follower_send(socket, address, req):
         access_logger.error('Failed queueing message (ID %s) from leader %s: %s', message_id, address, runtime)
         metrics.incr('follower_message_send_fail_cnt')
 
-    socket.sendall(msgpack.packb(response))
+    if req.get('report_load'):
+        socket.sendall(msgpack.packb({'status': response, 'load': get_load()}))
+    else:
+        socket.sendall(msgpack.packb(response))
+
+
+def handle_follower_send_batch(socket, address, req):
+    messages = req['data']
+    if not isinstance(messages, list):
+        reject_api_request(socket, address, 'INVALID data')
+        return
+
+    acks = []
+    for message in messages:
+        message_id = message.get('message_id', '?')
+        message['to_follower'] = True
+        try:
+            send_funcs['message_send_enqueue'](message)
+            acks.append(True)
+        except Exception:
+            acks.append(False)
+            logger.exception('Queueing message (ID %s) from leader %s failed.', message_id, address)
+            metrics.incr('follower_message_send_fail_cnt')
+    access_logger.info('%s of %s messages from leader %s queued successfully', acks.count(True), len(acks), address)
+
+    if req.get('report_load'):
+        socket.sendall(msgpack.packb({'acks': acks, 'load': get_load()}))
+    else:
+        socket.sendall(msgpack.packb(acks))
+
+
+def handle_incident_created(socket, address, req):
+    data = req.get('data')
+    incident_id = data.get('incident_id') if isinstance(data, dict) else None
+    if not isinstance(incident_id, int):
+        reject_api_request(socket, address, 'INVALID incident_id')
+        return
+
+    access_logger.info('-> %s OK, incident %s created', address, incident_id)
+    send_funcs['escalate_new_incident'](incident_id)
+    socket.sendall(msgpack.packb('OK'))
 
 
 api_request_handlers = {
     'v0/send': handle_api_notification_request,
-    'v0/follower_send': handle_follower_send
+    'v0/follower_send': handle_follower_send,
+    'v0/follower_send_batch': handle_follower_send_batch,
+    'v0/incident_created': handle_incident_created
 }
 
+# Endpoints whose connections are kept open for more requests
+persistent_endpoints = {'v0/follower_send_batch'}
+
 
 def handle_api_request(socket, address):
     metrics.incr('api_request_cnt')
+    keep_open = False
     timeout = Timeout.start_new(rpc_timeout)
     try:
         req = msgpack_unpack_msg_from_socket(socket)
@@ -211,6 +508,7 @@ def handle_api_request(socket, address):
         handler = api_request_handlers.get(req['endpoint'])
         if handler is not None:
             handler(socket, address, req)
+            keep_open = req['endpoint'] in persistent_endpoints
         else:
             logger.info('-> %s unknown request', address)
             socket.sendall(msgpack.packb('UNKNOWN'))
@@ -220,14 +518,56 @@ def handle_api_request(socket, address):
         socket.sendall(msgpack.packb('TIMEOUT'))
     finally:
         timeout.cancel()
+    if keep_open:
+        handle_persistent_connection(socket, address)
     socket.close()
 
 
-def run(sender_config):
+def handle_persistent_connection(socket, address):
+    unpacker = msgpack.Unpacker()
+    while True:
+        req = None
+        # Wait for the next request, giving up quietly on idle connections
+        with Timeout(follower_idle_timeout, False):
+            while req is None:
+                buf = socket.recv(65536)
+                if not buf:
+                    return
+                unpacker.feed(buf)
+                for req in unpacker:
+                    break
+        if req is None:
+            return
+        if not isinstance(req, dict) or req.get('endpoint') not in persistent_endpoints:
+            logger.info('-> %s unexpected request on persistent connection', address)
+            return
+
+        metrics.incr('api_request_cnt')
+        access_logger.info('%s %s', address, req['endpoint'])
+        try:
+            with Timeout(rpc_timeout):
+                api_request_handlers[req['endpoint']](socket, address, req)
+        except Timeout:
+            metrics.incr('api_request_timeout_cnt')
+            logger.warning('-> %s timeout', address)
+            return
+
+
+def listen(sender_config):
+    '''
+    Bind the RPC port without serving it, eg to share it with ingest processes.
+    '''
+    try:
+        return StreamServer.get_listener((sender_config['host'], sender_config['port']))
+    except Exception:
+        logger.exception('Failed binding to sender RPC port')
+        return None
+
+
+def run(sender_config, listener=None, handle=handle_api_request):
     global rpc_server
     try:
-        rpc_server = StreamServer((sender_config['host'], sender_config['port']),
-                                  handle_api_request)
+        rpc_server = StreamServer(listener or (sender_config['host'], sender_config['port']), handle)
         rpc_server.start()
         return True
     except Exception:
@@ -255,6 +595,22 @@ def init(sender_config, _send_funcs):
         rpc_timeout = default_rpc_timeout
     logger.info('RPC timeout is set to %s seconds', rpc_timeout)
 
+    global follower_connections_config, follower_idle_timeout
+    follower_connections = sender_config.get('follower_connections')
+    if follower_connections:
+        follower_connections = dict(follower_connections) if isinstance(follower_connections, dict) else {}
+        follower_idle_timeout = follower_connections.pop('idle_timeout', follower_idle_timeout)
+        follower_connections_config = follower_connections
+        logger.info('Passing messages to followers in batches over pooled connections')
+
+    global follower_balancer
+    follower_balancing = sender_config.get('follower_balancing')
+    if follower_balancing:
+        if not isinstance(follower_balancing, dict):
+            follower_balancing = {}
+        follower_balancer = FollowerBalancer(follower_balancing.get('stale_after', 30))
+        logger.info('Passing messages to the least loaded followers')
+
     access_log_cfg = {
         'filename': './access.log',
         'mode': 'a',
@@ -0,0 +1,56 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from heapq import heappush, heappop
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EscalationScheduler(object):
+    '''
+    Due-time index of (incident_id, plan_notification_id) pairs, so the leader only has to
+    look at notifications whose wait has expired instead of re-aggregating every active
+    message each loop.
+
+    Entries are pushed onto a heap and superseded lazily: scheduling a key again just
+    records its new due time, and older heap entries for that key are skipped when popped.
+    The DB stays the source of truth; anything popped here is re-checked against it.
+    '''
+
+    def __init__(self):
+        self.due = {}  # (incident_id, plan_notification_id) -> due timestamp
+        self.heap = []  # (due, incident_id, plan_notification_id)
+        self.exhausted = set()  # incident ids that went through their last step and may be deactivated
+        self.seeded = False
+
+    def __len__(self):
+        return len(self.due)
+
+    def schedule(self, incident_id, plan_notification_id, due):
+        self.due[(incident_id, plan_notification_id)] = due
+        heappush(self.heap, (due, incident_id, plan_notification_id))
+
+    def next_due(self):
+        while self.heap:
+            due, incident_id, plan_notification_id = self.heap[0]
+            if self.due.get((incident_id, plan_notification_id)) == due:
+                return due
+            heappop(self.heap)
+        return None
+
+    def pop_due(self, now):
+        keys = []
+        while self.heap and self.heap[0][0] <= now:
+            due, incident_id, plan_notification_id = heappop(self.heap)
+            key = (incident_id, plan_notification_id)
+            if self.due.get(key) == due:
+                del self.due[key]
+                keys.append(key)
+        return keys
+
+    def clear(self):
+        self.due = {}
+        self.heap = []
+        self.exhausted = set()
+        self.seeded = False
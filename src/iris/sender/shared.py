@@ -9,6 +9,10 @@ logger = logging.getLogger(__name__)
 # queue for sending messages. mode -> gevent queue
 per_mode_send_queues = {}
 
+# mode -> moving average of recent send times, reported to the leader by followers
+mode_latency = {}
+MODE_LATENCY_WEIGHT = 0.2
+
 
 def add_mode_stat(mode, runtime):
     try:
@@ -16,6 +20,8 @@ def add_mode_stat(mode, runtime):
         if runtime is None:
             stats[mode + '_fail'] += 1
         else:
+            latency = mode_latency.get(mode)
+            mode_latency[mode] = runtime if latency is None else latency + MODE_LATENCY_WEIGHT * (runtime - latency)
             stats[mode + '_total'] += runtime
             stats[mode + '_sent'] += 1
             if runtime > stats[mode + '_max']:
@@ -0,0 +1,76 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Lets the API tell the sender leader about new incidents so their first step
+# goes out right away instead of on the leader's next loop. Best effort only:
+# the leader still picks up every new incident on its periodic sweep. With
+# partitioned escalation, the sender owning the incident's partition is told
+# instead.
+
+from gevent import spawn, socket, Timeout
+import msgpack
+from ..utils import msgpack_unpack_msg_from_socket
+import logging
+logger = logging.getLogger(__name__)
+
+enabled = False
+default_sender_addr = None
+coordinator = None
+timeout = 1
+partition_count = 0
+
+
+def init(config, sender_coordinator=None):
+    global enabled, default_sender_addr, coordinator, timeout, partition_count
+    sender_config = config['sender']
+    enabled = sender_config.get('incident_wakeup', True)
+    leader_sender = sender_config.get('leader_sender', sender_config)
+    default_sender_addr = (leader_sender['host'], leader_sender['port'])
+    coordinator = sender_coordinator
+    timeout = config.get('zookeeper_timeout', timeout)
+    partition_count = int(sender_config.get('partitions') or 0)
+
+
+def get_leader_addr():
+    if coordinator:
+        sender_addr = None
+        with Timeout(timeout, False):
+            sender_addr = coordinator.get_current_leader()
+        if sender_addr:
+            return sender_addr
+    return default_sender_addr
+
+
+def get_sender_addr(incident_id):
+    if coordinator and partition_count:
+        sender_addr = None
+        with Timeout(timeout, False):
+            sender_addr = coordinator.get_partition_owner(incident_id % partition_count)
+        if sender_addr:
+            return sender_addr
+    return get_leader_addr()
+
+
+def notify_incident_created(incident_id):
+    if enabled:
+        spawn(send_incident_created, incident_id)
+
+
+def send_incident_created(incident_id):
+    sender_addr = get_sender_addr(incident_id)
+    try:
+        with Timeout(timeout):
+            s = socket.create_connection(sender_addr)
+            try:
+                s.send(msgpack.packb({'endpoint': 'v0/incident_created', 'data': {'incident_id': incident_id}}))
+                sender_resp = msgpack_unpack_msg_from_socket(s)
+            finally:
+                s.close()
+    except (socket.error, Timeout):
+        logger.warning('Failed notifying sender %s of new incident %s', sender_addr, incident_id)
+        return False
+
+    if sender_resp != 'OK':
+        logger.warning('Sender %s rejected wakeup for incident %s: %s', sender_addr, incident_id, sender_resp)
+        return False
+    return True
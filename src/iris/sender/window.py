@@ -0,0 +1,96 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from time import time
+
+
+class SlidingWindowCounter(object):
+    '''
+    Count of events in the last duration seconds, kept in a ring of buckets duration /
+    buckets seconds wide along with their running total. Buckets are cleared lazily as
+    they fall out of the window, when the counter is next used: advance() clears one
+    bucket per bucket width elapsed, or the whole ring at once after a full window, so
+    add() and total() are amortized O(1) however long the window is.
+    '''
+
+    __slots__ = ('duration', 'width', 'ring', 'head', 'head_bucket', 'count')
+
+    def __init__(self, duration, buckets=60):
+        buckets = max(int(buckets), 1)
+        self.duration = duration
+        self.width = float(duration) / buckets if duration > 0 else 1.0
+        self.ring = [0] * buckets
+        self.head = 0  # index of the current bucket in ring
+        self.head_bucket = None  # number of the current bucket, counting widths from the epoch
+        self.count = 0
+
+    def __repr__(self):
+        return 'SlidingWindowCounter(%s, %s buckets, total=%s)' % (self.duration, len(self.ring), self.count)
+
+    def advance(self, now):
+        bucket = int(now // self.width)
+        if self.head_bucket is None:
+            self.head_bucket = bucket
+            return
+        steps = bucket - self.head_bucket
+        if steps <= 0:
+            return
+        size = len(self.ring)
+        if steps >= size:
+            self.ring = [0] * size
+            self.count = 0
+        else:
+            for _ in range(steps):
+                self.head = (self.head + 1) % size
+                self.count -= self.ring[self.head]
+                self.ring[self.head] = 0
+        self.head_bucket = bucket
+
+    def add(self, count=1, now=None):
+        '''
+        Counts count more events now, and returns the total in the window.
+        '''
+        self.advance(time() if now is None else now)
+        self.ring[self.head] += count
+        self.count += count
+        return self.count
+
+    def total(self, now=None):
+        self.advance(time() if now is None else now)
+        return self.count
+
+    def buckets(self, now=None):
+        '''
+        [start time, count] of each non-empty bucket in the window, newest first.
+        '''
+        self.advance(time() if now is None else now)
+        if self.head_bucket is None:
+            return []
+        size = len(self.ring)
+        return [[(self.head_bucket - offset) * self.width, self.ring[(self.head - offset) % size]]
+                for offset in range(size) if self.ring[(self.head - offset) % size]]
+
+    def restore(self, buckets, now=None):
+        '''
+        Counts the [start time, count] buckets from buckets() that are still in the
+        window, unless we already counted more in them.
+        '''
+        self.advance(time() if now is None else now)
+        size = len(self.ring)
+        for start, count in buckets:
+            # nudge starts computed with another width over float rounding
+            offset = self.head_bucket - int(start / self.width + 1e-9)
+            if 0 <= offset < size:
+                idx = (self.head - offset) % size
+                if count > self.ring[idx]:
+                    self.count += count - self.ring[idx]
+                    self.ring[idx] = count
+        return self
+
+    def resized(self, duration, buckets=60, now=None):
+        '''
+        New counter over duration seconds, with the counts of this one that fit in it.
+        '''
+        if now is None:
+            now = time()
+        return SlidingWindowCounter(duration, buckets).restore(self.buckets(now), now)
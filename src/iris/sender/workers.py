@@ -0,0 +1,301 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+# Optional multi-process sending. The main sender process keeps doing everything
+# it normally does, except actually sending messages: those are handed to worker
+# processes, each running its own vendors and per mode gevent workers, so
+# rendering and vendor IO can use more than one CPU core.
+
+from collections import Counter, defaultdict
+from itertools import count
+from gevent import sleep, spawn, socket, subprocess
+from gevent.event import Event
+from gevent.lock import BoundedSemaphore
+from .ipc import Channel
+from iris import metrics
+import os
+import sys
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Set in the environment of worker processes, to the fd of their end of the channel
+WORKER_FD_ENV = 'SENDER_WORKER_FD'
+# and to their index in the pool
+WORKER_INDEX_ENV = 'SENDER_WORKER_INDEX'
+
+# Key of the sequence number of messages handed to worker processes, so they can be
+# acked however the worker copies them around
+WORKER_SEQ_KEY = 'worker_seq'
+
+
+def merge_stats(worker_stats, gauges=()):
+    '''
+    Add a worker's metrics to this process's. Counters are summed. Gauges, the keys in
+    gauges and *_max, *_min and *_size, are combined: *_size take the latest value,
+    *_min the lowest and the rest the highest.
+    '''
+    gauges = set(gauges)
+    for key, value in worker_stats.items():
+        if key not in metrics.stats:
+            metrics.add_new_metrics({key: 0})
+            metrics.stats[key] = value
+        elif key.endswith('_size'):
+            metrics.stats[key] = value
+        elif key.endswith('_min'):
+            current = metrics.stats[key]
+            metrics.stats[key] = value if current == metrics.stats_reset.get(key) else min(current, value)
+        elif key.endswith('_max') or key in gauges:
+            metrics.stats[key] = max(metrics.stats[key], value)
+        else:
+            metrics.stats[key] += value
+
+
+def sender_argv():
+    # Run the same sender, with the same config, as a child process
+    return [sys.executable, '-m', 'iris.bin.sender'] + sys.argv[1:]
+
+
+def stop_processes(processes, timeout=30):
+    for process in processes:
+        if process.process is not None:
+            process.stop()
+    for process in processes:
+        if process.process is not None:
+            try:
+                process.process.wait(timeout)
+            except subprocess.TimeoutExpired:
+                logger.warning('Killing sender child process %s', process.process.pid)
+                process.process.kill()
+            # handle whatever it sent before exiting
+            process.reader.join(1)
+            process.close()
+
+
+def collect_stats():
+    '''
+    Metrics changed since the last call, which are then reset like metrics.emit() does.
+    '''
+    changed = {key: value for key, value in metrics.stats.items()
+               if isinstance(value, (int, float)) and value != metrics.stats_reset.get(key)}
+    metrics.stats.update(metrics.stats_reset)
+    return changed
+
+
+def stats_report():
+    '''
+    Frame with the metrics changed since the last report, for merge_stats() in the parent.
+    '''
+    changed = collect_stats()
+    return {'stats': changed, 'gauges': [key for key in changed if key in metrics.gauges]}
+
+
+class WorkerProcess(object):
+    def __init__(self, index, argv, fd_env=WORKER_FD_ENV, extra_env=None, inherit_fds=()):
+        self.index = index
+        self.argv = argv
+        self.fd_env = fd_env
+        self.extra_env = extra_env or {}
+        self.inherit_fds = tuple(inherit_fds)
+        self.process = None
+        self.channel = None
+        self.reader = None
+        self.outstanding = {}  # seq -> message
+        self.load = None  # as of its last report
+
+    def start(self, on_frame):
+        parent_sock, child_sock = socket.socketpair()
+        env = dict(os.environ)
+        env.update(self.extra_env)
+        env[self.fd_env] = str(child_sock.fileno())
+        env[WORKER_INDEX_ENV] = str(self.index)
+        self.process = subprocess.Popen(self.argv, pass_fds=(child_sock.fileno(), ) + self.inherit_fds, env=env)
+        child_sock.close()
+        self.channel = Channel(parent_sock)
+        self.outstanding = {}
+        self.load = None
+        self.reader = spawn(self.read, on_frame)
+        logger.info('Started sender worker process %s (pid %s)', self.index, self.process.pid)
+
+    def read(self, on_frame):
+        for frame in self.channel:
+            on_frame(self, frame)
+
+    def is_alive(self):
+        return self.process.poll() is None and bool(self.reader)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+
+    def close(self):
+        self.reader.kill()
+        self.channel.close()
+
+
+class WorkerProcessPool(object):
+    '''
+    Runs process_count worker processes and hands messages to the one with the fewest
+    outstanding. Each may have up to max_outstanding messages in flight; past that,
+    submit() blocks.
+
+    Workers ack messages once they're done with them, which calls message_done(message,
+    recheck); recheck is set for messages the worker gave up retrying. Messages a worker
+    had in flight when it died are passed to message_lost(message).
+    '''
+
+    def __init__(self, process_count, max_outstanding, message_done, message_lost, argv=None):
+        self.argv = argv or sender_argv()
+        self.processes = [WorkerProcess(index, self.argv) for index in range(process_count)]
+        self.slots = BoundedSemaphore(process_count * max_outstanding)
+        self.message_done = message_done
+        self.message_lost = message_lost
+        self.seq = count()
+        metrics.add_new_metrics({'worker_process_cnt': 0, 'worker_process_respawn_cnt': 0,
+                                 'worker_process_outstanding': 0, 'worker_process_lost_cnt': 0})
+
+    def start(self):
+        for process in self.processes:
+            process.start(self.handle_frame)
+        metrics.set('worker_process_cnt', len(self.processes))
+
+    def handle_frame(self, process, frame):
+        for seq, recheck in frame.get('done', []):
+            message = process.outstanding.pop(seq, None)
+            if message is not None:
+                self.slots.release()
+                self.message_done(message, recheck)
+        worker_stats = frame.get('stats')
+        if worker_stats:
+            merge_stats(worker_stats, frame.get('gauges', ()))
+        if 'load' in frame:
+            process.load = frame['load']
+
+    def load(self):
+        '''
+        Send load of the worker processes as of their last reports, in the format of
+        the sender's get_send_load(): queue depths are summed and latencies averaged.
+        '''
+        queues = Counter()
+        latencies = defaultdict(list)
+        for process in self.processes:
+            if not process.load or not process.is_alive():
+                continue
+            queues.update(process.load.get('queues', {}))
+            for mode, latency in process.load.get('latency', {}).items():
+                if latency is not None:
+                    latencies[mode].append(latency)
+        return {'queues': dict(queues),
+                'latency': {mode: sum(values) / len(values) for mode, values in latencies.items()}}
+
+    def submit(self, message):
+        self.slots.acquire()
+        processes = [process for process in self.processes if process.is_alive()]
+        if not processes:
+            self.slots.release()
+            self.lose([message])
+            return False
+        process = min(processes, key=lambda process: len(process.outstanding))
+        seq = next(self.seq)
+        process.outstanding[seq] = message
+        try:
+            process.channel.send({'seq': seq, 'message': message})
+        except (socket.error, TypeError):
+            logger.exception('Failed handing message %s to worker process %s', message.get('message_id'), process.index)
+            del process.outstanding[seq]
+            self.slots.release()
+            self.lose([message])
+            return False
+        return True
+
+    def lose(self, messages):
+        metrics.incr('worker_process_lost_cnt', inc=len(messages))
+        for message in messages:
+            self.message_lost(message)
+
+    def maintain(self):
+        for process in self.processes:
+            if process.is_alive():
+                continue
+            logger.error('Sender worker process %s exited with %s. Respawning', process.index, process.process.poll())
+            metrics.incr('worker_process_respawn_cnt')
+            process.stop()
+            process.close()
+            lost = list(process.outstanding.values())
+            for _ in lost:
+                self.slots.release()
+            process.start(self.handle_frame)
+            self.lose(lost)
+        metrics.set('worker_process_outstanding', sum(len(process.outstanding) for process in self.processes))
+
+    def stop(self, timeout=30):
+        stop_processes(self.processes, timeout)
+
+
+class WorkerChannel(object):
+    '''
+    A worker process's end of the channel. Messages from the parent are passed to
+    enqueue(message); message_done(message) acks them. Acks are sent every ack_interval
+    seconds, after calling before_ack(), and metrics every report_interval seconds,
+    along with get_load() if given.
+    '''
+
+    def __init__(self, fd, enqueue, before_ack=None, ack_interval=0.2, report_interval=5, get_load=None):
+        self.channel = Channel(socket.socket(fileno=fd))
+        self.enqueue = enqueue
+        self.before_ack = before_ack
+        self.get_load = get_load
+        self.ack_interval = ack_interval
+        self.report_interval = report_interval
+        self.pending = set()  # seqs of messages not acked yet
+        self.acks = []
+        self.closed = Event()
+
+    def run(self):
+        try:
+            for frame in self.channel:
+                message = frame['message']
+                message[WORKER_SEQ_KEY] = frame['seq']
+                self.pending.add(frame['seq'])
+                self.enqueue(message)
+        finally:
+            self.closed.set()
+
+    def message_done(self, message, recheck=False):
+        seq = message.get(WORKER_SEQ_KEY)
+        if seq in self.pending:
+            self.pending.discard(seq)
+            self.acks.append((seq, recheck))
+
+    def send_acks(self):
+        if not self.acks:
+            return
+        # messages done during before_ack() wait for the next round, as their
+        # sent status may not be written yet
+        acks, self.acks = self.acks, []
+        if self.before_ack:
+            try:
+                self.before_ack()
+            except Exception:
+                self.acks[:0] = acks
+                raise
+        self.channel.send({'done': acks})
+
+    def run_acks(self):
+        while not self.closed.is_set():
+            sleep(self.ack_interval)
+            try:
+                self.send_acks()
+            except Exception:
+                logger.exception('Failed acking messages to parent sender')
+
+    def run_reports(self):
+        while not self.closed.is_set():
+            sleep(self.report_interval)
+            try:
+                report = stats_report()
+                if self.get_load:
+                    report['load'] = self.get_load()
+                self.channel.send(report)
+            except Exception:
+                logger.exception('Failed sending metrics to parent sender')
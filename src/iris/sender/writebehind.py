@@ -0,0 +1,249 @@
+# Copyright (c) LinkedIn Corporation. All rights reserved. Licensed under the BSD-2 Clause license.
+# See LICENSE in the project root for license information.
+
+from time import time
+from gevent import sleep
+from gevent.event import Event
+from gevent.lock import Semaphore
+from pymysql import DataError
+from iris import metrics
+import logging
+
+logger = logging.getLogger(__name__)
+
+SENT_MESSAGE_SQL = '''UPDATE `message`
+SET `destination`=%s,
+    `mode_id`=%s,
+    `template_id`=%s,
+    `batch`=IFNULL(%s, `batch`),
+    `active`=FALSE,
+    `sent`=NOW()
+WHERE `id`=%s'''
+
+SENT_MESSAGES_SQL = '''UPDATE `message`
+SET `destination`=CASE `id` %(destination)s END,
+    `mode_id`=CASE `id` %(mode_id)s END,
+    `template_id`=CASE `id` %(template_id)s END,%(batch)s
+    `active`=FALSE,
+    `sent`=NOW()
+WHERE `id` IN %%s'''
+
+SENT_MESSAGES_BATCH_COLUMN = '''
+    `batch`=CASE `id` %s ELSE `batch` END,'''
+
+UPDATE_MESSAGE_BODY_SQL = '''UPDATE `message`
+SET `body`=%s,
+    `subject`=%s
+WHERE `id`=%s'''
+
+UPDATE_MESSAGES_BODY_SQL = '''UPDATE `message`
+SET `body`=CASE `id` %(body)s END,
+    `subject`=CASE `id` %(subject)s END
+WHERE `id` IN %%s'''
+
+UPDATE_SHARED_BODY_SQL = '''UPDATE `message`
+SET `body`=%s,
+    `subject`=%s
+WHERE `id` IN %s'''
+
+SENT_STATUS_SQL = '''INSERT INTO `generic_message_sent_status` (`message_id`, `status`)
+VALUES %s
+ON DUPLICATE KEY UPDATE `status` = VALUES(`status`)'''
+
+CASE_WHEN = 'WHEN %s THEN %s'
+
+
+def case_clause(message_ids):
+    return ' '.join([CASE_WHEN] * len(message_ids))
+
+
+class WriteBehindBuffer(object):
+    '''
+    Coalesces the sent/body/subject updates for delivered messages, and their
+    generic_message_sent_status rows, so they're written as a few multi-row statements
+    every flush_interval seconds or max_rows rows instead of several commits per message.
+
+    Pending writes are capped at max_pending rows; past that, callers flush inline.
+    '''
+
+    def __init__(self, db, flush_interval, max_rows, max_pending):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.max_rows = max_rows
+        self.max_pending = max_pending
+        self.sent = {}  # message_id -> (destination, mode_id, template_id, batch_id)
+        self.contents = {}  # message_id -> (body, subject)
+        self.statuses = {}  # message_id -> status
+        self.flush_lock = Semaphore()
+        self.flush_needed = Event()
+        metrics.add_new_metrics({'writebehind_flush_cnt': 0, 'writebehind_flush_fail_cnt': 0,
+                                 'writebehind_flush_rows': 0, 'writebehind_flush_time': 0,
+                                 'writebehind_inline_flush_cnt': 0, 'writebehind_pending': 0})
+
+    def __len__(self):
+        return len(self.sent) + len(self.contents) + len(self.statuses)
+
+    def is_pending(self, message_id):
+        return message_id in self.sent
+
+    def mark_sent(self, message_ids, destination, mode_id, template_id, batch_id, body, subject):
+        for message_id in message_ids:
+            self.sent[message_id] = (destination, mode_id, template_id, batch_id)
+            self.contents[message_id] = (body, subject)
+        self.rows_added()
+
+    def set_status(self, message_id, status):
+        self.statuses[message_id] = status
+        self.rows_added()
+
+    def rows_added(self):
+        pending = len(self)
+        if pending >= self.max_pending:
+            metrics.incr('writebehind_inline_flush_cnt')
+            self.flush()
+        elif pending >= self.max_rows:
+            self.flush_needed.set()
+
+    def run(self):
+        while True:
+            self.flush_needed.wait(self.flush_interval)
+            self.flush_needed.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception('Failed flushing message updates')
+
+    def flush(self):
+        with self.flush_lock:
+            # Swap the buffers out before any IO so new updates go into fresh ones
+            sent, self.sent = self.sent, {}
+            contents, self.contents = self.contents, {}
+            statuses, self.statuses = self.statuses, {}
+            row_count = len(sent) + len(contents) + len(statuses)
+            metrics.set('writebehind_pending', len(self))
+            if not row_count:
+                return
+
+            start = time()
+            connection = None
+            try:
+                connection = self.db.engine.raw_connection()
+                cursor = connection.cursor()
+            except Exception:
+                if connection is not None:
+                    connection.close()
+                # nothing was written, so keep it all for the next flush. Updates that
+                # came in meanwhile are newer than these.
+                sent.update(self.sent)
+                contents.update(self.contents)
+                statuses.update(self.statuses)
+                self.sent, self.contents, self.statuses = sent, contents, statuses
+                metrics.incr('writebehind_flush_fail_cnt')
+                metrics.set('writebehind_pending', len(self))
+                raise
+            try:
+                for chunk in self.chunks(sent):
+                    self.write_sent(cursor, connection, chunk)
+                for chunk in self.chunks(contents):
+                    self.write_contents(cursor, connection, chunk)
+                for chunk in self.chunks(statuses):
+                    self.write_statuses(cursor, connection, chunk)
+            finally:
+                cursor.close()
+                connection.close()
+
+            metrics.incr('writebehind_flush_cnt')
+            metrics.set('writebehind_flush_rows', row_count)
+            metrics.set('writebehind_flush_time', time() - start)
+
+    def chunks(self, rows):
+        items = list(rows.items())
+        for i in range(0, len(items), self.max_rows):
+            yield items[i:i + self.max_rows]
+
+    def execute(self, cursor, connection, sql, params):
+        # this deadlocks sometimes. try until it doesn't.
+        max_retries = 3
+        for i in range(1, max_retries + 1):
+            try:
+                cursor.execute(sql, params)
+                connection.commit()
+                return True
+            except DataError:
+                connection.rollback()
+                return False
+            except Exception:
+                connection.rollback()
+                if i == max_retries:
+                    return False
+                sleep(.2)
+
+    def write_sent(self, cursor, connection, chunk):
+        message_ids = tuple(message_id for message_id, _ in chunk)
+        batched = [(message_id, row[3]) for message_id, row in chunk if row[3] is not None]
+        sql = SENT_MESSAGES_SQL % {
+            'destination': case_clause(chunk),
+            'mode_id': case_clause(chunk),
+            'template_id': case_clause(chunk),
+            'batch': SENT_MESSAGES_BATCH_COLUMN % case_clause(batched) if batched else '',
+        }
+        params = []
+        for column in range(3):
+            for message_id, row in chunk:
+                params += [message_id, row[column]]
+        for message_id, batch_id in batched:
+            params += [message_id, batch_id]
+        params.append(message_ids)
+
+        if self.execute(cursor, connection, sql, params):
+            return
+        metrics.incr('writebehind_flush_fail_cnt')
+        logger.warning('Failed marking %s messages as sent in one go. Falling back to one at a time.', len(chunk))
+        for message_id, (destination, mode_id, template_id, batch_id) in chunk:
+            if not self.execute(cursor, connection, SENT_MESSAGE_SQL,
+                                (destination, mode_id, template_id, batch_id, message_id)):
+                logger.warning('Failed updating message metadata status (message ID %s)', message_id)
+
+    def write_contents(self, cursor, connection, chunk):
+        # messages aggregated into one share their body, so write it once for all of them
+        shared = {}
+        for message_id, content in chunk:
+            shared.setdefault(content, []).append(message_id)
+        chunk = []
+        for (body, subject), message_ids in shared.items():
+            if len(message_ids) == 1:
+                chunk.append((message_ids[0], (body, subject)))
+            elif not self.execute(cursor, connection, UPDATE_SHARED_BODY_SQL, (body, subject, tuple(message_ids))):
+                metrics.incr('writebehind_flush_fail_cnt')
+                logger.warning('Failed updating body+subject shared by %s messages', len(message_ids))
+                chunk += [(message_id, (body, subject)) for message_id in message_ids]
+        if not chunk:
+            return
+
+        message_ids = tuple(message_id for message_id, _ in chunk)
+        sql = UPDATE_MESSAGES_BODY_SQL % {'body': case_clause(chunk), 'subject': case_clause(chunk)}
+        params = []
+        for column in range(2):
+            for message_id, row in chunk:
+                params += [message_id, row[column]]
+        params.append(message_ids)
+
+        if self.execute(cursor, connection, sql, params):
+            return
+        metrics.incr('writebehind_flush_fail_cnt')
+        logger.warning('Failed updating body+subject of %s messages in one go. Falling back to one at a time.', len(chunk))
+        for message_id, (body, subject) in chunk:
+            if not self.execute(cursor, connection, UPDATE_MESSAGE_BODY_SQL, (body, subject, message_id)):
+                logger.warning('Failed updating message body+subject (message ID %s)', message_id)
+
+    def write_statuses(self, cursor, connection, chunk):
+        sql = SENT_STATUS_SQL % ', '.join(['(%s, %s)'] * len(chunk))
+        params = [value for row in chunk for value in row]
+
+        if self.execute(cursor, connection, sql, params):
+            return
+        metrics.incr('writebehind_flush_fail_cnt')
+        logger.warning('Failed setting sent status of %s messages in one go. Falling back to one at a time.', len(chunk))
+        for row in chunk:
+            if not self.execute(cursor, connection, SENT_STATUS_SQL % '(%s, %s)', row):
+                logger.warning('Failed setting message sent status for message %s', row[0])
@@ -6,6 +6,7 @@ import re
 from falcon import HTTP_201, HTTPBadRequest, HTTPInvalidParam
 
 from iris import db
+from iris.sender import wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -96,7 +97,7 @@ class freshping(object):
                 'active': True,
             }
 
-            session.execute(
+            incident_id = session.execute(
                 '''INSERT INTO `incident` (`plan_id`, `created`, `context`,
                                            `current_step`, `active`, `application_id`)
                    VALUES (:plan_id, :created, :context, 0, :active, :application_id)''',
@@ -105,4 +106,5 @@ class freshping(object):
             session.commit()
             session.close()
 
+        wakeup.notify_incident_created(incident_id)
         resp.status = HTTP_201
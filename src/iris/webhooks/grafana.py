@@ -4,6 +4,7 @@ import ujson
 from falcon import HTTP_201, HTTPBadRequest, HTTPInvalidParam
 
 from iris import db
+from iris.sender import wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -75,7 +76,7 @@ class grafana(object):
                 'active': True,
             }
 
-            session.execute(
+            incident_id = session.execute(
                 '''INSERT INTO `incident` (`plan_id`, `created`, `context`,
                                            `current_step`, `active`, `application_id`)
                    VALUES (:plan_id, :created, :context, 0, :active, :application_id)''',
@@ -84,4 +85,5 @@ class grafana(object):
             session.commit()
             session.close()
 
+        wakeup.notify_incident_created(incident_id)
         resp.status = HTTP_201
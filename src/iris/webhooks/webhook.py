@@ -6,6 +6,7 @@ import ujson
 from falcon import HTTP_201, HTTPBadRequest, HTTPNotFound
 
 from iris import db
+from iris.sender import wakeup
 
 logger = logging.getLogger(__name__)
 
@@ -77,6 +78,7 @@ class webhook(object):
             session.commit()
             session.close()
 
+        wakeup.notify_incident_created(incident_id)
         resp.status = HTTP_201
         resp.set_header('Location', '/incidents/%s' % incident_id)
         resp.body = ujson.dumps(incident_id)
@@ -2,6 +2,7 @@ from gevent import spawn, monkey, sleep, socket
 monkey.patch_all()
 
 import pytest  # noqa
+from unittest import mock
 
 zk_address = ('localhost', 2181)
 zk_url = '%s:%s' % zk_address
@@ -68,6 +69,70 @@ class TestFailover():
         assert next(self.instances['c2'].followers) == ('testinstance', 1001)
 
 
+mysql_address = ('127.0.0.1', 3306)
+
+
+def test_mysql_failover():
+    from iris.coordinator.mysql import Coordinator
+    from iris.config import load_config
+    from iris import db
+    import os
+
+    # If we can't connect to MySQL, skip
+    try:
+        sock = socket.socket()
+        sock.connect(mysql_address)
+        sock.close()
+    except socket.error:
+        pytest.skip('Skipping this test as MySQL server is not running/reachable.')
+
+    db.init(load_config(os.path.join(os.path.dirname(__file__), '../configs/config.dev.yaml')))
+    c1 = Coordinator(db, 'testinstance', 1001, True, lock_name='iris_test_sender_leader',
+                     heartbeat_interval=0.1, failover_timeout=0.5)
+    c2 = Coordinator(db, 'testinstance', 1002, True, lock_name='iris_test_sender_leader',
+                     heartbeat_interval=0.1, failover_timeout=0.5)
+    try:
+        c1.update_status()
+        c2.update_status()
+        assert c1.am_i_leader()
+        assert c2.am_i_leader() is False
+        c1.update_status()
+        assert c1.follower_list == [('testinstance', 1002)]
+        assert c2.get_current_leader() == ('testinstance', 1001)
+
+        # c1 hangs without letting go of its connection. c2 takes over once its
+        # heartbeat goes stale.
+        spawn(c2.update_forever)
+        sleep(1.5)
+        assert c2.am_i_leader()
+        assert c1.get_current_leader() == ('testinstance', 1002)
+        c1.update_status()
+        assert c1.am_i_leader() is False
+    finally:
+        c1.leave_cluster()
+        c2.leave_cluster()
+
+
+def test_mysql_lock_connection(mocker):
+    from iris.coordinator.mysql import Coordinator
+
+    db = mocker.MagicMock()
+    connection = mocker.MagicMock()
+    connection.cursor.return_value.fetchall.side_effect = [[], [(1, )]]
+    # get_members() queries on pooled connections
+    db.engine.raw_connection.side_effect = [connection] + [mocker.MagicMock() for _ in range(3)]
+    coordinator = Coordinator(db, 'testinstance', 1001, True)
+    coordinator.update_status()
+    assert coordinator.am_i_leader()
+
+    # the session holding our locks never goes back to the pool
+    connection.detach.assert_called_once_with()
+    connection.autocommit.assert_called_once_with(True)
+    coordinator.reset_connection()
+    connection.close.assert_called_once_with()
+    assert coordinator.connection is None
+
+
 def test_non_cluster():
     from iris.coordinator.noncluster import Coordinator
 
@@ -86,3 +151,231 @@ def test_non_cluster():
     assert next(followers) == ('testinstance', 1002)
     assert next(followers) == ('testinstance', 1001)
     assert next(followers) == ('testinstance', 1002)
+
+
+def test_assign_partitions():
+    from iris.coordinator import assign_partitions
+    from iris.coordinator.noncluster import Coordinator
+
+    members = ['c:1', 'a:1', 'b:1']
+    assignments = [assign_partitions(members, member, 8) for member in members]
+    assert assign_partitions(members, 'a:1', 8) == {0, 3, 6}
+    assert frozenset().union(*assignments) == set(range(8))
+    assert sum(len(assigned) for assigned in assignments) == 8
+    assert assign_partitions(members, 'd:1', 8) == frozenset()
+
+    assert Coordinator(True, []).get_partitions() is None
+    assert Coordinator(False, [], partitions=4).get_partitions() == {0, 1, 2, 3}
+    assert Coordinator(False, [], partitions=4, owned_partitions=[1, 3]).get_partitions() == {1, 3}
+
+
+class FakeZooKeeper(object):
+    '''
+    In-process stand-in for a ZooKeeper ensemble, shared by the clients it hands out,
+    which count the reads they make.
+    '''
+
+    def __init__(self):
+        self.nodes = {}  # path -> [data, session]
+        self.sequence = 0
+        self.watches = {}  # path -> [func]
+
+    def client(self, *args, **kwargs):
+        return FakeKazooClient(self)
+
+    def children(self, path):
+        prefix = path + '/'
+        return [node[len(prefix):] for node in self.nodes if node.startswith(prefix) and '/' not in node[len(prefix):]]
+
+    def changed(self, path):
+        parent = path.rsplit('/', 1)[0]
+        for func in self.watches.get(parent, []):
+            func(self.children(parent))
+
+
+class FakeLock(object):
+    def __init__(self, client, path, identifier):
+        self.client = client
+        self.path = path
+        self.identifier = identifier
+        self.node = None
+        self.is_acquired = False
+
+    def acquire(self, blocking=True, timeout=None):
+        import uuid
+        self.node = self.client.create('%s/%s__lock__' % (self.path, uuid.uuid4().hex), self.identifier.encode('utf-8'),
+                                       ephemeral=True, sequence=True)
+        first = min(self.client.get_children(self.path), key=lambda child: child[-10:])
+        if self.node.endswith(first):
+            self.is_acquired = True
+        else:
+            self.client.delete(self.node)
+        return self.is_acquired
+
+    def release(self):
+        self.client.delete(self.node)
+        self.is_acquired = False
+
+    def cancel(self):
+        pass
+
+    def contenders(self):
+        return [self.client.get('%s/%s' % (self.path, child))[0].decode('utf-8')
+                for child in sorted(self.client.get_children(self.path), key=lambda child: child[-10:])]
+
+
+class FakeKazooClient(object):
+    def __init__(self, server):
+        from functools import partial
+        from kazoo.client import KazooState
+        from kazoo.recipe.party import Party
+        self.server = server
+        self.state = KazooState.CONNECTED
+        self.listeners = []
+        self.reads = 0
+        self.Lock = partial(FakeLock, self)
+        self.Party = partial(Party, self)
+
+    def start_async(self):
+        from gevent.event import Event
+        event = Event()
+        event.set()
+        return event
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def ensure_path(self, path):
+        parts = path.strip('/').split('/')
+        for i in range(len(parts)):
+            self.server.nodes.setdefault('/' + '/'.join(parts[:i + 1]), [b'', None])
+
+    def ChildrenWatch(self, path, func):
+        from kazoo.exceptions import NoNodeError
+        if path not in self.server.nodes:
+            raise NoNodeError()
+        self.server.watches.setdefault(path, []).append(func)
+        func(self.get_children(path))
+
+    def get_children(self, path):
+        self.reads += 1
+        return self.server.children(path)
+
+    def get(self, path):
+        from kazoo.exceptions import NoNodeError
+        self.reads += 1
+        try:
+            return self.server.nodes[path][0], mock.Mock(version=0)
+        except KeyError:
+            raise NoNodeError()
+
+    def create(self, path, value=b'', ephemeral=False, sequence=False, makepath=False):
+        from kazoo.exceptions import NodeExistsError
+        self.ensure_path(path.rsplit('/', 1)[0])
+        if sequence:
+            self.server.sequence += 1
+            path += '%010d' % self.server.sequence
+        if path in self.server.nodes:
+            raise NodeExistsError()
+        self.server.nodes[path] = [value, self if ephemeral else None]
+        self.server.changed(path)
+        return path
+
+    def delete(self, path, version=-1):
+        from kazoo.exceptions import NoNodeError
+        if self.server.nodes.pop(path, None) is None:
+            raise NoNodeError()
+        self.server.changed(path)
+
+    def expire(self):
+        from kazoo.client import KazooState
+        self.state = KazooState.LOST
+        for listener in self.listeners:
+            listener(self.state)
+        for path, (_, session) in list(self.server.nodes.items()):
+            if session is self:
+                self.delete(path)
+
+
+def test_watched_membership(mocker):
+    from iris.coordinator.kazoo import Coordinator
+
+    zk = FakeZooKeeper()
+    mocker.patch('iris.coordinator.kazoo.KazooClient', zk.client)
+    mocker.patch('iris.metrics.stats')
+
+    c1 = Coordinator('fake', 'sender1', 1001, True)
+    c1.update_status()
+    c2 = Coordinator('fake', 'sender2', 1002, True)
+    c2.update_status()
+    assert c1.am_i_leader()
+    assert c2.am_i_leader() is False
+    # c2 saw the lock was held, so didn't try for it
+    assert len(zk.children('/iris/sender_leader')) == 1
+
+    # c1 learns of c2 joining from its watch
+    assert c1.changed.is_set()
+    c1.update_status()
+    assert c1.follower_list == [('sender2', 1002)]
+    assert c2.get_current_leader() == ('sender1', 1001)
+
+    # nothing changed, so nothing is read from ZK
+    reads = c1.zk.reads, c2.zk.reads
+    c1.changed.clear()
+    c1.update_status()
+    c2.update_status()
+    assert c2.get_current_leader() == ('sender1', 1001)
+    assert (c1.zk.reads, c2.zk.reads) == reads
+    assert not c1.changed.is_set()
+    assert c1.settled() and c2.settled()
+
+    # a read only client, like the API's, follows along too
+    api = Coordinator('fake', None, None, False)
+    assert api.get_current_leader() == ('sender1', 1001)
+    assert sorted(api.get_current_followers()) == [('sender1', 1001), ('sender2', 1002)]
+
+    # c1 going away wakes c2, which takes over
+    c2.changed.clear()
+    c1.zk.expire()
+    assert c2.changed.is_set()
+    c2.update_status()
+    assert c2.am_i_leader()
+    assert c2.follower_list == []
+    assert api.get_current_leader() == ('sender2', 1002)
+
+
+def test_watched_partitions(mocker):
+    from iris.coordinator.kazoo import Coordinator
+
+    zk = FakeZooKeeper()
+    mocker.patch('iris.coordinator.kazoo.KazooClient', zk.client)
+    mocker.patch('iris.metrics.stats')
+
+    c1 = Coordinator('fake', 'sender1', 1001, True, partitions=4)
+    c1.update_status()
+    assert c1.get_partitions() == {0, 1, 2, 3}
+
+    # c1 hands half its partitions over once c2 joins and its sender stopped escalating
+    # them, which c2 claims on its next update
+    c2 = Coordinator('fake', 'sender2', 1002, True, partitions=4)
+    c2.update_status()
+    assert c2.get_partitions() == frozenset()
+    assert not c2.settled()
+    c1.update_status()
+    assert c1.get_partitions() == {0, 2}
+    assert c1.releasing == {1, 3}
+    assert not c1.settled()
+    c2.update_status()
+    assert c2.get_partitions() == frozenset()
+    c1.stopped_escalating({1, 2, 3})
+    assert c1.stopped == {1, 3}
+    c1.update_status()
+    assert c1.releasing == frozenset()
+    c2.update_status()
+    assert c1.get_partitions() == {0, 2}
+    assert c2.get_partitions() == {1, 3}
+    assert c1.settled() and c2.settled()
+    assert c1.get_partition_owner(3) == ('sender2', 1002)
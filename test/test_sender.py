@@ -373,6 +373,29 @@ def test_quotas(mocker):
         assert quotas.allow_send({'application': 'app_without_quota'})
 
 
+def test_quotas_partition_share(mocker):
+    from iris.sender.quota import ApplicationQuota
+    from gevent import sleep
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.sender.quota.ApplicationQuota.get_new_rules',
+                 return_value=[(
+                     'testapp', 4, 2, 120, 120, 'testuser',
+                     'user', 'iris-plan', 10
+                 )])
+    mocker.patch('iris.sender.quota.ApplicationQuota.notify_incident')
+    notify_target = mocker.patch('iris.sender.quota.ApplicationQuota.notify_target')
+    quotas = ApplicationQuota(None, None, None, None, {})
+    sleep(1)
+
+    # owning half the partitions, this sender gets half of each limit
+    quotas.share = 0.5
+    assert quotas.allow_send({'application': 'testapp'})
+    assert not notify_target.called
+    assert quotas.allow_send({'application': 'testapp'})  # Breach soft quota
+    assert notify_target.called
+    assert not quotas.allow_send({'application': 'testapp'})  # Breach hard quota
+
+
 def test_aggregate_audit_msg(mocker):
     from iris.bin.sender import (
         fetch_and_prepare_message, message_queue, per_mode_send_queues,
@@ -390,10 +413,9 @@ def test_aggregate_audit_msg(mocker):
         fake_message['application'],
         fake_message['priority'],
         fake_message['target'])
-    from collections import defaultdict
-    plan_aggregate_windows[msg_aggregate_key] = defaultdict(int)
-    plan_aggregate_windows[msg_aggregate_key][now] = 10
-    plan_aggregate_windows[msg_aggregate_key][now - 60] = 10
+    from iris.sender.window import SlidingWindowCounter
+    plan_aggregate_windows[msg_aggregate_key] = SlidingWindowCounter(fake_plan['threshold_window']).restore(
+        [[now, 10], [now - 60, 10]], now)
 
     mocker.patch('iris.bin.sender.cache').plans = {fake_plan['id']: fake_plan}
 
@@ -415,6 +437,57 @@ def test_aggregate_audit_msg(mocker):
         "Aggregated with key (19546, test-app, high, test-user)")
 
 
+def test_aggregation_checkpoint_restore(mocker, tmpdir):
+    import iris.bin.sender
+    from iris.bin.sender import (checkpoint_aggregation_state, restore_aggregation_state,
+                                 fetch_and_prepare_message, message_queue, restored_queue_keys)
+    from iris.sender.checkpoint import AggregationCheckpoint
+    from iris.sender.window import SlidingWindowCounter
+
+    mocker.patch('iris.metrics.stats')
+    mocker.patch('iris.bin.sender.cache').plans = {fake_plan['id']: fake_plan}
+    mocker.patch('iris.bin.sender.message_send_enqueue')
+    mocker.patch.object(iris.bin.sender, 'partition_count', 0)
+    mocker.patch.object(iris.bin.sender, 'escalation_partitions', None)
+    checkpoint = AggregationCheckpoint(None, str(tmpdir.join('checkpoint.json')))
+    mocker.patch.object(iris.bin.sender, 'aggregation_checkpoint', checkpoint)
+
+    now = time.time()
+    key = (fake_message['plan_id'], fake_message['application'], fake_message['priority'], fake_message['target'])
+    window = SlidingWindowCounter(fake_plan['threshold_window'])
+    window.add(3, now - 3600)
+    window.add(5, now - 60)
+    window.add(10, now)
+    mocker.patch.object(iris.bin.sender, 'plan_aggregate_windows', {key: window})
+    mocker.patch.object(iris.bin.sender, 'aggregation', {key: now})
+    mocker.patch.object(iris.bin.sender, 'sent', {key: now - 10})
+    mocker.patch.object(iris.bin.sender, 'queues', {key: {fake_message['message_id']}})
+    mocker.patch.object(iris.bin.sender, 'messages', {fake_message['message_id']: dict(fake_message)})
+    checkpoint_aggregation_state(now)
+
+    # a sender taking over starts out empty
+    mocker.patch.object(iris.bin.sender, 'plan_aggregate_windows', {})
+    mocker.patch.object(iris.bin.sender, 'aggregation', {})
+    mocker.patch.object(iris.bin.sender, 'sent', {})
+    mocker.patch.object(iris.bin.sender, 'queues', {})
+    mocker.patch.object(iris.bin.sender, 'messages', {})
+    restore_aggregation_state()
+
+    # old buckets past the plan's threshold window aren't kept
+    assert iris.bin.sender.plan_aggregate_windows[key].total(now) == 15
+    assert iris.bin.sender.aggregation[key] == now
+    assert iris.bin.sender.sent[key] == now - 10
+    assert restored_queue_keys == {fake_message['message_id']: key}
+
+    # the polled message goes straight back into its aggregation queue
+    init_queue_with_item(message_queue, dict(fake_message))
+    fetch_and_prepare_message()
+    assert iris.bin.sender.queues[key] == {fake_message['message_id']}
+    assert fake_message['message_id'] in iris.bin.sender.messages
+    assert not restored_queue_keys
+    iris.bin.sender.message_send_enqueue.assert_not_called()
+
+
 def test_handle_api_notification_request_invalid_message(mocker):
     mocker.patch('iris.bin.sender.set_target_contact').return_value = True
     mocker.patch('iris.metrics.stats')
@@ -515,3 +588,1227 @@ def test_sanitize_unicode_dict():
     good_render = template.render(**sanitize_unicode_dict(bad_context))
     assert '\\xe2' not in good_render
     assert b'\xe2\x80\x99'.decode('utf-8') in good_render
+
+
+def test_create_messages_batched(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import create_messages, INSERT_MESSAGE_SQL
+
+    mock_cache = mocker.patch('iris.bin.sender.cache')
+    mock_cache.incidents = {1: {'application_id': 5}, 2: {'application_id': 5}}
+    mock_cache.plan_notifications = {
+        10: {'role_id': 1, 'target_id': 1, 'plan_id': 3, 'priority_id': 2, 'optional': 0},
+        11: {'role_id': 2, 'target_id': 1, 'plan_id': 3, 'priority_id': 2, 'optional': 0},
+    }
+    mock_cache.roles = {1: {'name': 'team'}, 2: {'name': 'bogus'}}
+    mock_cache.targets = {1: {'name': 'foo'}}
+    mock_cache.plans = {3: {'creator': 'owner'}}
+    mock_cache.target_names = {'a': {'id': 100}, 'b': {'id': 101}, 'owner': {'id': 102}}
+    mock_cache.targets_for_role.side_effect = lambda role, target: ['a', 'b'] if role == 'team' else None
+    mocker.patch('iris.bin.sender.api_cache').priorities = {'low': {'id': 1}}
+    mock_auditlog = mocker.patch('iris.bin.sender.auditlog')
+    mocker.patch('iris.metrics.stats')
+    mock_db = mocker.patch('iris.bin.sender.db')
+    mock_cursor = mock_db.engine.raw_connection().cursor()
+    mock_cursor.lastrowid = 1234
+    mocker.patch.object(iris.bin.sender, 'escalate_batch_size', 100)
+
+    msg_count, error_incident_ids = create_messages([(1, 10), (2, 10), (2, 11)])
+    assert msg_count == 5
+    assert not error_incident_ids
+
+    calls = mock_cursor.execute.call_args_list
+    assert len(calls) == 2
+
+    # plan owner redirect is written on its own so the audit log gets its message id
+    assert calls[0][0] == (INSERT_MESSAGE_SQL, (3, 11, 2, 5, 102, 1, mocker.ANY))
+    assert mock_auditlog.message_change.call_args[0][0] == 1234
+
+    # everything else goes out as one multi-row insert
+    sql, params = calls[1][0]
+    assert sql.count('(NOW(), ') == 4
+    assert params == [3, 10, 1, 5, 100, 2, '', 3, 10, 1, 5, 101, 2, '',
+                      3, 10, 2, 5, 100, 2, '', 3, 10, 2, 5, 101, 2, '']
+
+    # a failed redirect only fails its own incident; the batched rows are still written
+    mock_cursor.execute.reset_mock()
+    mock_auditlog.reset_mock()
+    mocker.patch('iris.bin.sender.insert_message', side_effect=Exception('retries exceeded'))
+    msg_count, error_incident_ids = create_messages([(1, 10), (2, 11)])
+    assert msg_count == 2
+    assert error_incident_ids == {2}
+    assert not mock_auditlog.message_change.called
+    sql, params = mock_cursor.execute.call_args[0]
+    assert params == [3, 10, 1, 5, 100, 2, '', 3, 10, 1, 5, 101, 2, '']
+
+
+def test_escalation_scheduler():
+    from iris.sender.scheduler import EscalationScheduler
+
+    scheduler = EscalationScheduler()
+    assert scheduler.next_due() is None
+
+    scheduler.schedule(1, 10, 100)
+    scheduler.schedule(2, 20, 50)
+    scheduler.schedule(3, 30, 300)
+    # rescheduling supersedes the earlier due time
+    scheduler.schedule(2, 20, 200)
+    assert len(scheduler) == 3
+    assert scheduler.next_due() == 100
+
+    assert scheduler.pop_due(99) == []
+    assert scheduler.pop_due(200) == [(1, 10), (2, 20)]
+    assert len(scheduler) == 1
+    assert scheduler.next_due() == 300
+
+    scheduler.exhausted.add(4)
+    scheduler.seeded = True
+    scheduler.clear()
+    assert len(scheduler) == 0
+    assert scheduler.next_due() is None
+    assert not scheduler.exhausted
+    assert not scheduler.seeded
+
+
+def test_handle_api_request_v0_incident_created(mocker):
+    from iris.bin.sender import escalate_new_incident, incident_wakeup_queue
+    from iris.sender.rpc import handle_api_request, send_funcs
+    import iris.bin.sender
+
+    send_funcs['escalate_new_incident'] = escalate_new_incident
+    mocker.patch('iris.metrics.stats')
+    mock_coordinator = mocker.patch.object(iris.bin.sender, 'coordinator')
+    mock_coordinator.am_i_leader.return_value = True
+
+    mock_address = mocker.MagicMock()
+    mock_socket = mocker.MagicMock()
+    mock_socket.recv.return_value = msgpack.packb({
+        'endpoint': 'v0/incident_created',
+        'data': {'incident_id': 1234},
+    })
+
+    handle_api_request(mock_socket, mock_address)
+
+    mock_socket.sendall.assert_called_with(msgpack.packb('OK'))
+    assert incident_wakeup_queue.get_nowait() == 1234
+
+    # followers leave it to the leader's next sweep
+    mock_coordinator.am_i_leader.return_value = False
+    handle_api_request(mock_socket, mock_address)
+    mock_socket.sendall.assert_called_with(msgpack.packb('OK'))
+    assert incident_wakeup_queue.empty()
+
+
+def test_escalate_new_incidents_wakes_poll(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import escalate_new_incidents, poll_wakeup
+
+    mocker.patch('iris.metrics.stats')
+    mocker.patch.object(iris.bin.sender, 'db')
+    mocker.patch.object(iris.bin.sender, 'process_new_incidents', return_value=({1234: (1, 1)}, {1: 1}))
+    create_messages = mocker.patch.object(iris.bin.sender, 'create_escalation_messages', return_value=0)
+    poll_wakeup.clear()
+
+    escalate_new_incidents({1234})
+    assert not poll_wakeup.is_set()
+
+    # messages it creates are polled without waiting for the main loop
+    create_messages.return_value = 2
+    escalate_new_incidents({1234})
+    assert poll_wakeup.is_set()
+    poll_wakeup.clear()
+
+
+def test_poll_wakeup_worker(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import poll_wakeup_worker
+    import pytest
+
+    mock_wakeup = mocker.patch.object(iris.bin.sender, 'poll_wakeup')
+    mock_wakeup.wait.side_effect = [None, None, StopIteration]
+    mocker.patch.object(iris.bin.sender, 'poll_wakeup_interval', 1)
+    mocker.patch.object(iris.bin.sender, 'owns_escalation', return_value=True)
+    mock_poll = mocker.patch.object(iris.bin.sender, 'poll')
+    mock_sleep = mocker.patch.object(iris.bin.sender, 'sleep')
+    mocker.patch('iris.bin.sender.time').time.side_effect = [1000, 1000, 1000.25, 1000.25]
+
+    # back to back wakeups are spaced out by poll_wakeup_interval
+    with pytest.raises(StopIteration):
+        poll_wakeup_worker()
+    assert mock_poll.call_count == 2
+    assert [call[0][0] for call in mock_sleep.call_args_list] == [0, 0.75]
+
+
+def test_escalate_due_wakes_poll(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import escalate_due, poll_wakeup
+
+    mocker.patch.object(iris.bin.sender, 'db')
+    escalate_notifications = mocker.patch.object(iris.bin.sender, 'escalate_notifications', return_value=0)
+    poll_wakeup.clear()
+
+    escalate_due()
+    assert not poll_wakeup.is_set()
+
+    escalate_notifications.return_value = 3
+    escalate_due()
+    assert poll_wakeup.is_set()
+    poll_wakeup.clear()
+
+
+def test_partitioned_escalation(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import partition_filter, owns_incident, owns_escalation, update_escalation_partitions
+
+    mock_coordinator = mocker.patch.object(iris.bin.sender, 'coordinator')
+    mock_quota = mocker.patch.object(iris.bin.sender, 'quota')
+    mock_coordinator.am_i_leader.return_value = False
+    mocker.patch.object(iris.bin.sender, 'partition_count', 0)
+    mocker.patch.object(iris.bin.sender, 'escalation_partitions', None)
+    assert partition_filter('`incident`.`id`') == ''
+    assert not owns_incident(5)
+    assert not owns_escalation()
+
+    mocker.patch.object(iris.bin.sender, 'partition_count', 4)
+    mocker.patch.object(iris.bin.sender, 'messages', {1: {'incident_id': 5}, 2: {'incident_id': 6}})
+    mocker.patch.object(iris.bin.sender, 'queues', {(1, 1): {1, 2}})
+    mock_coordinator.get_partitions.return_value = frozenset([1, 3])
+    update_escalation_partitions()
+
+    assert partition_filter('`incident`.`id`') == ' AND MOD(`incident`.`id`, 4) IN (1, 3)'
+    assert owns_escalation()
+    assert owns_incident(5)
+    assert not owns_incident(6)
+    # quota limits are scaled to the share of partitions we own
+    assert mock_quota.share == 0.5
+    # messages held for aggregation from partitions we don't own are dropped
+    assert list(iris.bin.sender.messages) == [1]
+    assert iris.bin.sender.queues[(1, 1)] == {1}
+
+    # a partition going elsewhere stops being escalated right away, and the coordinator
+    # is told once escalations in progress are done
+    from iris.bin.sender import confirm_released_partitions
+    mock_coordinator.get_partitions.return_value = frozenset([1])
+    mock_coordinator.releasing = frozenset([3])
+    assert not owns_incident(7)
+    assert partition_filter('`incident`.`id`') == ' AND MOD(`incident`.`id`, 4) IN (1)'
+    confirm_released_partitions()
+    mock_coordinator.stopped_escalating.assert_called_once_with(frozenset([0, 2, 3]))
+
+    mock_coordinator.get_partitions.return_value = frozenset()
+    update_escalation_partitions()
+    assert not owns_escalation()
+    assert mock_quota.share == 0
+    assert partition_filter('`incident`.`id`') == ' AND MOD(`incident`.`id`, 4) IN (NULL)'
+
+
+def test_poll_incremental(mocker):
+    import iris.bin.sender
+    from iris.bin.sender import (poll, reset_poll, message_queue, poll_recheck_ids, UNSENT_MESSAGES_SQL,
+                                 UNSENT_MESSAGES_SINCE_FILTER, UNSENT_MESSAGES_SINCE_OR_IDS_FILTER)
+
+    mocker.patch('iris.metrics.stats')
+    mock_db = mocker.patch('iris.bin.sender.db')
+    mock_cursor = mock_db.engine.raw_connection().cursor()
+    mocker.patch.object(iris.bin.sender, 'messages', {})
+    mocker.patch.object(iris.bin.sender, 'message_ids_being_sent', set())
+    mocker.patch.object(iris.bin.sender, 'poll_watermark_lag', 60)
+    mock_time = mocker.patch('iris.bin.sender.time')
+    reset_poll()
+
+    def poll_ids(now, *ids):
+        mock_time.time.return_value = now
+        mock_cursor.__iter__.return_value = [{'message_id': i} for i in ids]
+        poll()
+        polled = []
+        while not message_queue.empty():
+            polled.append(message_queue.get()['message_id'])
+        return polled
+
+    # first pass scans every active message
+    assert poll_ids(1000, 1, 2) == [1, 2]
+    assert mock_cursor.execute.call_args[0] == (UNSENT_MESSAGES_SQL % '',)
+
+    # the watermark stays below ids seen less than poll_watermark_lag seconds ago,
+    # and rows already polled aren't queued again
+    assert poll_ids(1000.01, 1, 2, 3) == [3]
+    assert mock_cursor.execute.call_args[0] == (UNSENT_MESSAGES_SQL % UNSENT_MESSAGES_SINCE_FILTER, (0,))
+
+    # so a lower id committed after back to back polls is still picked up
+    assert poll_ids(1000.02, 2, 3, 4) == [4]
+    assert poll_ids(1000.03, 1, 2, 3, 4) == []
+    assert poll_ids(1030, 1, 2, 3, 4, 6) == [6]
+    assert poll_ids(1030.01, 1, 2, 3, 4, 5, 6) == [5]
+
+    # once they're old enough, only newer ids are fetched
+    assert poll_ids(1060.02, 5, 6, 7) == [7]
+    assert poll_ids(1090.01, 5, 6, 7) == []
+    assert mock_cursor.execute.call_args[0] == (UNSENT_MESSAGES_SQL % UNSENT_MESSAGES_SINCE_FILTER, (4,))
+
+    # messages the sender gave up on are fetched again by id
+    poll_recheck_ids.add(1)
+    assert poll_ids(1090.02, 1) == [1]
+    assert mock_cursor.execute.call_args[0] == (UNSENT_MESSAGES_SQL % UNSENT_MESSAGES_SINCE_OR_IDS_FILTER, (6, (1,)))
+    reset_poll()
+
+
+def test_write_behind_buffer(mocker):
+    from iris.sender.writebehind import (WriteBehindBuffer, SENT_MESSAGE_SQL, UPDATE_MESSAGE_BODY_SQL,
+                                         UPDATE_SHARED_BODY_SQL, SENT_STATUS_SQL)
+    import pytest
+
+    mocker.patch('iris.metrics.stats')
+    mock_db = mocker.MagicMock()
+    mock_cursor = mock_db.engine.raw_connection().cursor()
+    buf = WriteBehindBuffer(mock_db, 1, 500, 1000)
+
+    buf.mark_sent([1, 2], 'foo@example.com', 3, 4, 'abc', 'body', 'subject')
+    buf.set_status(1, True)
+    assert len(buf) == 5
+    assert buf.is_pending(2)
+
+    buf.flush()
+    assert len(buf) == 0
+    assert not buf.is_pending(2)
+
+    calls = mock_cursor.execute.call_args_list
+    assert len(calls) == 3
+    sql, params = calls[0][0]
+    assert '`batch`=CASE `id` WHEN %s THEN %s WHEN %s THEN %s ELSE `batch` END' in sql
+    assert params == [1, 'foo@example.com', 2, 'foo@example.com', 1, 3, 2, 3, 1, 4, 2, 4, 1, 'abc', 2, 'abc', (1, 2)]
+    assert calls[1][0] == (UPDATE_SHARED_BODY_SQL, ('body', 'subject', (1, 2)))
+    assert calls[2][0] == (SENT_STATUS_SQL % '(%s, %s)', [1, True])
+
+    # if a multi-row statement keeps failing, rows are written one at a time
+    mock_cursor.execute.reset_mock()
+    mock_cursor.execute.side_effect = [Exception()] * 3 + [None] * 2 + [None] * 3
+    mocker.patch('iris.sender.writebehind.sleep')
+    buf.mark_sent([5, 6], 'bar@example.com', 3, None, None, 'body', 'subject')
+    buf.flush()
+    calls = mock_cursor.execute.call_args_list
+    assert calls[3][0] == (SENT_MESSAGE_SQL, ('bar@example.com', 3, None, None, 5))
+    assert calls[4][0] == (SENT_MESSAGE_SQL, ('bar@example.com', 3, None, None, 6))
+    assert calls[5][0][0] != UPDATE_MESSAGE_BODY_SQL
+
+    # messages with their own body are still updated together
+    mock_cursor.execute.reset_mock()
+    mock_cursor.execute.side_effect = None
+    buf.mark_sent([7], 'foo@example.com', 3, 4, None, 'one', 'subject')
+    buf.mark_sent([8], 'foo@example.com', 3, 4, None, 'two', 'subject')
+    buf.flush()
+    assert mock_cursor.execute.call_args_list[1][0][1] == [7, 'one', 8, 'two', 7, 'subject', 8, 'subject', (7, 8)]
+
+    # nothing is lost if we can't connect
+    mock_db.engine.raw_connection.side_effect = Exception('db down')
+    buf.mark_sent([9], 'foo@example.com', 3, 4, None, 'body', 'subject')
+    buf.set_status(9, True)
+    with pytest.raises(Exception):
+        buf.flush()
+    assert len(buf) == 3
+    assert buf.is_pending(9)
+
+
+def test_auditlog_buffer(mocker):
+    from iris.sender import auditlog
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', {})
+    mock_db = mocker.patch('iris.sender.auditlog.db')
+    mock_cursor = mock_db.engine.raw_connection().cursor()
+    mocker.patch.object(auditlog, 'change_queue', None)
+    auditlog.init_buffer(max_queue_size=3, max_batch_size=2, max_put_wait=0)
+
+    auditlog.message_change(1, auditlog.MODE_CHANGE, 'sms', 'email', 'foo')
+    auditlog.message_change(2, auditlog.MODE_CHANGE, 'sms', 'email', 'bar')
+    auditlog.message_change(1, auditlog.SENT_CHANGE, '', '', 'baz')
+    # no room left, so this gets dropped
+    auditlog.message_change(3, auditlog.SENT_CHANGE, '', '', 'dropped')
+    assert not mock_cursor.execute.called
+
+    auditlog.flush()
+    calls = mock_cursor.execute.call_args_list
+    assert len(calls) == 2
+    assert calls[0][0][0].count('NOW()') == 2
+    assert calls[0][0][1] == [1, auditlog.MODE_CHANGE, 'sms', 'email', 'foo',
+                              2, auditlog.MODE_CHANGE, 'sms', 'email', 'bar']
+    assert calls[1][0][1] == [1, auditlog.SENT_CHANGE, '', '', 'baz']
+    assert auditlog.change_queue.empty()
+    assert metrics.stats['auditlog_overflow_cnt'] == 1
+    assert metrics.stats['auditlog_drop_cnt'] == 1
+
+
+def test_contact_index_lookups(mocker):
+    from iris.sender.contacts import ContactIndex
+    import pytest
+
+    mocker.patch('iris.metrics.stats')
+    index = ContactIndex(mocker.MagicMock(), 60)
+    # nothing loaded yet, so everything goes to the DB
+    assert index.lookup_priority('foo', 'app', 1) is None
+
+    index.index = {
+        'users': {'foo': 10, 'bar': 11},
+        'applications': {'app': 5},
+        'mode_names': {1: 'email', 2: 'sms', 3: 'drop'},
+        'mode_ids': {'email': 1, 'sms': 2, 'drop': 3},
+        'contacts': {(10, 1): 'foo@example.com', (10, 2): '+1 123-456-7890', (11, 1): 'bar@example.com'},
+        'target_application_modes': {(10, 5, 1): 2},
+        'default_application_modes': {},
+        'target_modes': {(11, 1): 3},
+        'priority_modes': {1: 1, 2: 1},
+        'application_modes': {(5, 1), (5, 2)},
+        'category_overrides': {(10, 7): 2},
+        'category_modes': {7: 1},
+        'sms_overrides': {('+1 123-456-7890', 2)},
+    }
+
+    # per app setting wins over the priority default
+    assert index.lookup_priority('foo', 'app', 1) == ('+1 123-456-7890', 'sms', 2)
+    assert index.lookup_priority('foo', 'app', 2) == ('foo@example.com', 'email', 1)
+    # bar wants to drop, which this app doesn't allow
+    with pytest.raises(ValueError):
+        index.lookup_priority('bar', 'app', 1)
+    # unknown users and apps are misses
+    assert index.lookup_priority('baz', 'app', 1) is None
+    assert index.lookup_priority('foo', 'other-app', 1) is None
+
+    assert index.lookup_destination('foo', mode='email') == 'foo@example.com'
+    with pytest.raises(ValueError):
+        index.lookup_destination('bar', mode_id=2)
+    assert index.lookup_category('foo', 7) == ('+1 123-456-7890', 'sms', 2)
+    assert index.lookup_category('bar', 7) == ('bar@example.com', 'email', 1)
+    assert index.has_sms_override('+1 123-456-7890', 2)
+
+
+def test_render_cache(mocker):
+    from iris.sender.cache import Templates, RenderCache
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', {})
+    mock_engine = mocker.MagicMock()
+    mock_engine.raw_connection().cursor().__iter__.return_value = [
+        ('foo', 1, 'app', 'email', 'Incident {{ number }}', 'Hi {{ iris.target }}, {{ number }} broke'),
+        ('foo', 1, 'app', 'sms', '', '{% for k in iris %}{{ k }}{% endfor %}'),
+    ]
+    templates = Templates(mock_engine)
+    template = templates['foo']
+    email_template = template['app']['email']
+    assert email_template['subject_iris_attributes'] == frozenset()
+    assert email_template['body_iris_attributes'] == frozenset(['target'])
+    assert template['app']['sms']['body_iris_attributes'] is None
+
+    render_cache = RenderCache(3)
+
+    def render(message_id, target, incident_id=10, mode='email'):
+        message = {'template': 'foo', 'application': 'app', 'incident_id': incident_id,
+                   'context': {'number': incident_id, 'iris': {'message_id': message_id, 'target': target}}}
+        mode_template = template['app'][mode]
+        return (render_cache.render(message, template, mode_template, mode, 'subject'),
+                render_cache.render(message, template, mode_template, mode, 'body'))
+
+    assert render(1, 'alice') == ('1 Incident 10', 'Hi alice, 10 broke')
+    assert render(2, 'bob') == ('2 Incident 10', 'Hi bob, 10 broke')
+    assert render(3, 'alice') == ('3 Incident 10', 'Hi alice, 10 broke')
+    # the subject is rendered once for the incident, the body once per target
+    assert metrics.stats['render_cache_miss_cnt'] == 3
+    assert metrics.stats['render_cache_hit_cnt'] == 3
+
+    assert render(4, 'alice', incident_id=11) == ('4 Incident 11', 'Hi alice, 11 broke')
+    assert metrics.stats['render_cache_eviction_cnt'] == 2
+    assert len(render_cache.data) == 3
+
+    # templates using iris in ways we can't follow aren't cached
+    assert render(5, 'alice', mode='sms') == ('5', 'message_idtarget')
+    assert metrics.stats['render_cache_uncacheable_cnt'] == 1
+
+
+def test_template_bulk_load_and_bytecode_cache(mocker, tmpdir):
+    from iris.sender import cache
+    import jinja2
+
+    mocker.patch('iris.sender.cache.template_bytecode_cache', None)
+    mock_engine = mocker.MagicMock()
+    mock_engine.raw_connection().cursor().__iter__.return_value = [
+        ('foo', 1, 'app', 'email', 'Hello {{ name }}', 'Body {{ iris.message_id }}'),
+        ('bar', 2, 'app', 'email', 'Bar', 'Bar body'),
+    ]
+    templates = cache.Templates(mock_engine)
+    loaded = templates.load(['foo', 'bar', 'baz'])
+    # all templates come from one query
+    assert mock_engine.raw_connection().cursor().execute.call_count == 1
+    assert loaded['baz'] == {}
+    assert templates['bar']['id'] == 2
+    assert templates['foo']['app']['email']['subject'].render(name='x') == 'Hello x'
+    assert templates['bar']['app']['email']['subject'].render(iris={'message_id': 3}) == '3 Bar'
+
+    bytecode_cache = jinja2.FileSystemBytecodeCache(str(tmpdir))
+    mocker.patch('iris.sender.cache.template_bytecode_cache', bytecode_cache)
+    compile_spy = mocker.spy(templates.env, 'compile')
+    first = cache.compile_template(templates.env, 'template/1/app/email/body', 'Hi {{ name }}')
+    assert compile_spy.call_count == 1
+    assert len(tmpdir.listdir()) == 1
+    second = cache.compile_template(cache.Templates(mock_engine).env, 'template/1/app/email/body', 'Hi {{ name }}')
+    assert compile_spy.call_count == 1
+    assert first.render(name='a') == second.render(name='a') == 'Hi a'
+    # changed source for the same name is recompiled
+    assert cache.compile_template(templates.env, 'template/1/app/email/body', 'Bye {{ name }}').render(name='a') == 'Bye a'
+    assert compile_spy.call_count == 2
+
+
+def test_cache_snapshot(mocker, tmpdir):
+    from iris.sender import cache
+    from iris.sender.window import SlidingWindowCounter
+
+    mocker.patch('iris.sender.cache.template_bytecode_cache', None)
+    mocker.patch('iris.sender.cache.spawn')
+    template_engine = mocker.MagicMock()
+    template_engine.raw_connection().cursor().__iter__.return_value = [
+        ('foo', 1, 'app', 'email', 'Hello {{ name }}', 'Body {{ iris.message_id }}'),
+    ]
+    plan_engine = mocker.MagicMock()
+    plan_engine.raw_connection().cursor().__iter__.side_effect = [
+        iter([dict(fake_plan, steps=None, tracking_template=None, id=7, name='plan-a', active=1)]),
+        iter([{'id': 70, 'plan_id': 7, 'step': 1}, {'id': 71, 'plan_id': 7, 'step': 2}]),
+    ]
+    templates = cache.Templates(template_engine)
+    templates.load(['foo'])
+    templates.active = {1: 'foo'}
+    plans = cache.Plans(plan_engine)
+    plans.load([7])
+    plans.active = {7: 'plan-a'}
+    reprioritization = cache.TargetReprioritization(None)
+    reprioritization.rates[('alice', 'call')] = ('sms', '+1', 3, SlidingWindowCounter(120, 2))
+    reprioritization.rates[('alice', 'call')][-1].add(2)
+    mocker.patch.multiple(cache, templates=templates, plans=plans, target_reprioritization=reprioritization,
+                          targets_for_role=cache.RoleTargets([], None, ['alice', 'bob']))
+    path = str(tmpdir.join('cache.msgpack'))
+    assert cache.save_snapshot(path)
+
+    # a fresh sender restores it without querying anything
+    engine = mocker.MagicMock()
+    mocker.patch.multiple(cache, templates=cache.Templates(engine), plans=cache.Plans(engine),
+                          target_reprioritization=cache.TargetReprioritization(engine),
+                          targets_for_role=cache.RoleTargets([], engine, cache.read_snapshot(path)['active_targets']))
+    cache.restore_snapshot(cache.read_snapshot(path))
+    assert cache.targets_for_role.active_targets == {'alice', 'bob'}
+    assert cache.templates['foo']['app']['email']['subject'].render(name='x') == 'Hello x'
+    assert cache.plans['plan-a']['steps'] == {1: [70], 2: [71]}
+    assert cache.plans[7] is cache.plans['plan-a']
+    dst_mode, destination, count, buckets = cache.target_reprioritization.rates[('alice', 'call')]
+    assert (dst_mode, destination, count, buckets.duration, buckets.total()) == ('sms', '+1', 3, 120, 2)
+    engine.raw_connection.assert_not_called()
+
+    # snapshots from another version are ignored
+    mocker.patch('iris.sender.cache.SNAPSHOT_VERSION', cache.SNAPSHOT_VERSION + 1)
+    assert cache.read_snapshot(path) is None
+
+
+def test_worker_process_pool(mocker):
+    import sys
+    from iris.sender import workers
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', {'email_cnt': 2, 'email_max': 3})
+    mocker.patch('iris.metrics.stats_reset', {'email_cnt': 0, 'email_max': 0})
+
+    # stand-in worker process which acks everything it's sent and reports a metric
+    worker_script = '''
+from gevent import monkey, spawn
+monkey.patch_all()
+import os
+from iris.sender.workers import WorkerChannel, WORKER_FD_ENV
+from iris import metrics
+metrics.stats.update({'email_cnt': 0, 'email_max': 0})
+def enqueue(message):
+    metrics.stats['email_cnt'] += 1
+    metrics.stats['email_max'] = max(metrics.stats['email_max'], message['runtime'])
+    channel.message_done(message, message['message_id'] == 2)
+channel = WorkerChannel(int(os.environ[WORKER_FD_ENV]), enqueue, ack_interval=0.01, report_interval=0.01)
+spawn(channel.run_acks)
+spawn(channel.run_reports)
+channel.run()
+'''
+    done = []
+    lost = []
+    pool = workers.WorkerProcessPool(2, 2, lambda message, recheck: done.append((message['message_id'], recheck)),
+                                     lost.append, argv=[sys.executable, '-c', worker_script])
+    pool.start()
+    try:
+        for message_id in range(1, 6):
+            assert pool.submit({'message_id': message_id, 'runtime': message_id})
+        with gevent.Timeout(10):
+            while len(done) < 5 or metrics.stats['email_cnt'] < 7:
+                gevent.sleep(0.05)
+        assert sorted(done) == [(1, False), (2, True), (3, False), (4, False), (5, False)]
+        assert metrics.stats['email_max'] == 5
+        assert not lost
+
+        # messages in flight on a dead worker are handed back
+        process = pool.processes[0]
+        process.outstanding[100] = {'message_id': 100}
+        pool.slots.acquire()
+        process.process.kill()
+        process.process.wait()
+        pool.maintain()
+        assert lost == [{'message_id': 100}]
+        assert metrics.stats['worker_process_respawn_cnt'] == 1
+        assert pool.processes[0].is_alive()
+    finally:
+        pool.stop()
+
+
+def test_ingest_forwarder(mocker):
+    from gevent import socket
+    from iris.sender.ipc import Channel
+    from iris.sender.ingest import IngestForwarder, IngestProcessPool
+    from iris.sender.workers import stats_report
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', {})
+    mocker.patch('iris.metrics.stats_reset', {})
+    child_sock, parent_sock = socket.socketpair()
+    forwarder = IngestForwarder(Channel(child_sock), 3, batch_size=2)
+    forwarder.message_send_enqueue({'target': 'foo', 'application': 'app'})
+    assert not forwarder.flush_needed.is_set()
+    forwarder.message_send_enqueue({'target': 'bar', 'application': 'app'})
+    assert forwarder.flush_needed.is_set()
+    forwarder.escalate_new_incident(10)
+    forwarder.flush()
+    assert metrics.stats['ingest_3_forward_cnt'] == 2
+    forwarder.channel.send(stats_report())
+
+    queued = []
+    incidents = []
+    pool = IngestProcessPool(1, parent_sock, queued.append, incidents.append)
+    frames = iter(Channel(parent_sock))
+    pool.handle_frame(pool.processes[0], next(frames))
+    assert [message['target'] for message in queued] == ['foo', 'bar']
+    assert incidents == [10]
+    assert metrics.stats['ingest_forwarded_cnt'] == 2
+
+    pool.handle_frame(pool.processes[0], next(frames))
+    assert metrics.stats['ingest_3_forward_cnt'] == 2
+
+
+def test_child_process_load(mocker):
+    from iris.sender import workers, ingest
+
+    # worker processes' load stands in for the parent's
+    pool = workers.WorkerProcessPool(2, 2, None, None, argv=['true'])
+    for process, load in zip(pool.processes, [{'queues': {'email': 3}, 'latency': {'email': 1.0}},
+                                              {'queues': {'email': 1, 'sms': 2}, 'latency': {'email': 3.0}}]):
+        mocker.patch.object(process, 'is_alive', return_value=True)
+        pool.handle_frame(process, {'load': load})
+    assert pool.load() == {'queues': {'email': 4, 'sms': 2}, 'latency': {'email': 2.0}}
+
+    # ingest processes pass on the parent's load while it's fresh
+    forwarder = ingest.IngestForwarder(mocker.MagicMock(), 0)
+    assert forwarder.get_load() is None
+    forwarder.update_load({'queues': {'email': 1}, 'latency': {}})
+    assert forwarder.get_load() == {'queues': {'email': 1}, 'latency': {}}
+    forwarder.parent_load_time -= ingest.LOAD_STALE_AFTER + 1
+    assert forwarder.get_load() is None
+
+
+def test_merge_stats(mocker):
+    from iris.sender.workers import merge_stats
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', {'sent_cnt': 1, 'flush_time': 0.5, 'queue_size': 3, 'delay_max': 2})
+    mocker.patch('iris.metrics.stats_reset', {'sent_cnt': 0, 'flush_time': 0, 'queue_size': 0, 'delay_max': 0})
+    for _ in range(2):
+        merge_stats({'sent_cnt': 2, 'flush_time': 0.25, 'queue_size': 1, 'delay_max': 1}, ['flush_time', 'queue_size'])
+    assert metrics.stats == {'sent_cnt': 5, 'flush_time': 0.5, 'queue_size': 1, 'delay_max': 2}
+
+
+def test_worker_channel_acks_after_flush(mocker):
+    from gevent import socket
+    from iris.sender.workers import WorkerChannel
+    import pytest
+
+    child_sock, parent_sock = socket.socketpair()
+    channel = WorkerChannel(child_sock.detach(), lambda message: None)
+    channel.channel = mocker.MagicMock()
+    first, second = {'id': 1, 'worker_seq': 1}, {'id': 2, 'worker_seq': 2}
+    channel.pending = {1, 2}
+
+    # a message done while flushing is acked after its status is written by the next flush
+    def flush():
+        channel.message_done(second)
+    channel.before_ack = flush
+    channel.message_done(first)
+    channel.send_acks()
+    channel.channel.send.assert_called_once_with({'done': [(1, False)]})
+    assert channel.acks == [(2, False)]
+
+    # nothing is acked if flushing fails
+    channel.before_ack = mocker.Mock(side_effect=Exception('db down'))
+    with pytest.raises(Exception):
+        channel.send_acks()
+    assert channel.acks == [(2, False)]
+    assert channel.channel.send.call_count == 1
+
+    # copies of a message are acked as that message, once
+    channel.pending.add(3)
+    channel.message_done(dict({'id': 3, 'worker_seq': 3}))
+    channel.message_done({'id': 3, 'worker_seq': 3})
+    assert channel.acks == [(2, False), (3, False)]
+    parent_sock.close()
+
+
+def test_follower_send_batch(mocker):
+    from collections import defaultdict
+    from gevent.server import StreamServer
+    from unittest import mock
+    from iris.sender import rpc
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    queued = []
+
+    def message_send_enqueue(message):
+        if message.get('fail'):
+            raise ValueError('bad message')
+        queued.append(message)
+
+    mocker.patch.dict(rpc.send_funcs, {'message_send_enqueue': message_send_enqueue})
+    accepted = []
+
+    def handle(sock, address):
+        accepted.append(address)
+        rpc.handle_api_request(sock, address)
+
+    server = StreamServer(('127.0.0.1', 0), handle)
+    server.start()
+    try:
+        batcher = rpc.FollowerBatcher(('127.0.0.1', server.server_port), pool_size=1, batch_size=3)
+        messages = [{'message_id': 1}, {'message_id': 2, 'fail': True}, {'message_id': 3}]
+        sends = [gevent.spawn(batcher.send, message) for message in messages]
+        gevent.joinall(sends, timeout=5)
+        assert [send.value for send in sends] == [True, False, True]
+        assert [message['message_id'] for message in queued] == [1, 3]
+        assert all(message['to_follower'] for message in queued)
+
+        # the connection is reused for the next batch
+        assert batcher.send({'message_id': 4})
+        assert len(accepted) == 1
+        assert rpc.metrics.stats['rpc_follower_batch_cnt'] == 2
+        assert rpc.metrics.stats['rpc_message_pass_success_cnt'] == 3
+    finally:
+        server.stop()
+
+    # unacked messages are left for the caller to send some other way
+    batcher = rpc.FollowerBatcher(('127.0.0.1', server.server_port))
+    assert batcher.send({'message_id': 5}) is False
+
+    # as are messages of batches that failed unexpectedly
+    mocker.patch.object(batcher, 'request', side_effect=ValueError('unexpected'))
+    assert batcher.send({'message_id': 6}) is False
+
+    # and ones whose batch never went out
+    mocker.patch.object(rpc, 'rpc_timeout', 0.01)
+    with mock.patch.object(rpc, 'spawn_later'):
+        assert batcher.send({'message_id': 7}) is False
+    # which it then leaves out
+    batch, batcher.pending, batcher.flush_scheduled = batcher.pending, [], False
+    mocker.patch.object(batcher, 'request', side_effect=AssertionError('sent anyway'))
+    batcher.send_batch(batch)
+
+    # once a batch went out, the follower may be sending it already
+    def stuck(payload):
+        gevent.sleep(2)
+        return {'acks': [True]}
+    mocker.patch.object(batcher, 'request', side_effect=stuck)
+    assert batcher.send({'message_id': 8}) is True
+
+
+def test_follower_batch_retries(mocker):
+    from collections import defaultdict
+    from gevent import socket, Timeout
+    from iris.sender import rpc
+    import pytest
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+
+    # only a connection closed before any reply counts as closed for being idle
+    for reply in (b'', msgpack.packb({'acks': [True]})[:3]):
+        connection = rpc.FollowerConnection.__new__(rpc.FollowerConnection)
+        connection.sock, follower_sock = socket.socketpair()
+        connection.unpacker = msgpack.Unpacker()
+        follower_sock.sendall(reply)
+        follower_sock.shutdown(socket.SHUT_WR)
+        with pytest.raises(socket.error) as e:
+            connection.request(b'payload')
+        assert isinstance(e.value, rpc.FollowerClosedConnection) == (not reply)
+        connection.close()
+        follower_sock.close()
+
+    batcher = rpc.FollowerBatcher(('127.0.0.1', 1))
+    fresh = mocker.patch.object(rpc, 'FollowerConnection')
+    fresh.return_value.request.return_value = {'acks': [True]}
+    idle = mocker.MagicMock()
+    idle.request.side_effect = rpc.FollowerClosedConnection('closed')
+    batcher.connections.put(idle)
+    assert batcher.request(b'payload') == {'acks': [True]}
+    idle.close.assert_called_once_with()
+    fresh.assert_called_once_with(('127.0.0.1', 1))
+
+    # timeouts aren't retried, as the follower may have the batch already
+    batcher.connections.get_nowait()
+    slow = mocker.MagicMock()
+    slow.request.side_effect = Timeout()
+    batcher.connections.put(slow)
+    with pytest.raises(Timeout):
+        batcher.request(b'payload')
+    slow.close.assert_called_once_with()
+    assert fresh.call_count == 1
+
+
+def test_prune_followers(mocker):
+    from iris.sender import rpc
+    from iris.sender.balancer import FollowerBalancer
+
+    mocker.patch('iris.metrics.stats')
+    staying, departed = rpc.FollowerBatcher(('a', 1)), rpc.FollowerBatcher(('b', 1))
+    connection = mocker.MagicMock()
+    departed.connections.put(connection)
+    mocker.patch.dict(rpc.follower_batchers, {('a', 1): staying, ('b', 1): departed}, clear=True)
+    balancer = FollowerBalancer()
+    balancer.update(('a', 1), {'queues': {}})
+    balancer.update(('b', 1), {'queues': {}})
+    mocker.patch.object(rpc, 'follower_balancer', balancer)
+
+    rpc.prune_followers([('a', 1)])
+    assert rpc.follower_batchers == {('a', 1): staying}
+    assert list(balancer.loads) == [('a', 1)]
+    connection.close.assert_called_once_with()
+    assert departed.closed and not staying.closed
+
+
+def test_follower_balancing(mocker):
+    from collections import defaultdict
+    from iris.sender import rpc
+    from iris.sender.balancer import FollowerBalancer
+    import iris.bin.sender
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    balancer = FollowerBalancer(stale_after=30)
+    mocker.patch.object(rpc, 'follower_balancer', balancer)
+    followers = [('a', 1), ('b', 1)]
+
+    # nothing reported yet, so go round robin
+    assert balancer.choose(followers, 'email') is None
+
+    # followers report their load in replies when asked to
+    assert msgpack.unpackb(rpc.generate_msgpack_message_payload({}))['report_load'] is True
+    assert rpc.load_reported(('a', 1), {'status': 'OK', 'load': {'queues': {'email': 50}, 'latency': {'email': 2.0}}},
+                             'status') == 'OK'
+    assert rpc.load_reported(('b', 1), {'status': 'OK', 'load': {'queues': {'email': 2, 'sms': 5}, 'latency': {'email': 0.5}}},
+                             'status') == 'OK'
+    assert rpc.load_reported(('c', 1), 'OK', 'status') == 'OK'
+    for _ in range(10):
+        assert balancer.choose(followers, 'email') == ('b', 1)
+    # a's queue for sms is empty
+    assert balancer.choose(followers, 'sms') == ('a', 1)
+
+    mock_coordinator = mocker.patch.object(iris.bin.sender, 'coordinator')
+    mock_coordinator.follower_list = followers + [('c', 1)]
+    mock_coordinator.followers = iter([('a', 1), ('b', 1), ('c', 1)])
+    mocker.patch('random.sample', return_value=[('a', 1), ('b', 1)])
+    candidates = iris.bin.sender.follower_candidates({'mode': 'email'})
+    assert list(candidates) == [('b', 1), ('a', 1), ('c', 1)]
+
+    # stale reports are ignored
+    mocker.patch('iris.sender.balancer.time', return_value=time.time() + 60)
+    assert balancer.choose(followers, 'email') is None
+    assert iris.metrics.stats['follower_balance_fallback_cnt'] == 2
+
+
+def test_lane_queue(mocker):
+    from collections import Counter, defaultdict
+    from gevent.queue import Empty
+    from iris.sender.queues import LaneQueue
+    import pytest
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+
+    strict = LaneQueue('email')
+    for i in range(3):
+        strict.put({'message_id': i, 'priority': 'low'})
+    strict.put({'message_id': 3, 'priority': 'urgent'})
+    strict.put({'message_id': 4})
+    assert len(strict) == 5
+    strict.update_metrics()
+    from iris import metrics
+    assert metrics.stats['send_queue_email_low_size'] == 4
+    # urgent first, then in order, with unknown priorities in the last lane
+    assert [strict.get(True, 1)['message_id'] for _ in range(5)] == [3, 0, 1, 2, 4]
+    assert strict.empty()
+    with pytest.raises(Empty):
+        strict.get(True, 0.01)
+    with pytest.raises(Empty):
+        strict.get_nowait()
+
+    # weighted lanes take turns by weight
+    weighted = LaneQueue('email', ['high', 'low'], 'weighted', {'high': 3, 'low': 1})
+    for i in range(40):
+        weighted.put({'message_id': i, 'priority': 'high' if i % 2 else 'low'})
+    first = Counter(weighted.get()['priority'] for _ in range(20))
+    assert first == {'high': 15, 'low': 5}
+
+    # applications in a lane take turns
+    per_app = LaneQueue('email', per_application=True)
+    for i in range(3):
+        per_app.put({'message_id': i, 'priority': 'high', 'application': 'storm'})
+    per_app.put({'message_id': 3, 'priority': 'high', 'application': 'quiet'})
+    assert [per_app.get()['message_id'] for _ in range(4)] == [0, 3, 1, 2]
+
+
+def test_spill_queue(mocker, tmpdir):
+    from collections import defaultdict
+    from gevent.queue import Queue
+    from iris.sender.queues import SpillQueue
+    from iris import metrics
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    path = str(tmpdir.join('send_queue_email.spill'))
+
+    spill_queue = SpillQueue(Queue(), 'email', path, 2)
+    for i in range(5):
+        spill_queue.put({'message_id': i, 'body': 'hi'})
+    assert len(spill_queue.queue) == 2
+    assert len(spill_queue) == 5
+    assert metrics.stats['send_queue_email_spill_cnt'] == 3
+
+    # spilled messages come back as the queue drains
+    assert [spill_queue.get()['message_id'] for _ in range(3)] == [0, 1, 2]
+    assert metrics.stats['send_queue_email_refill_cnt'] == 2
+    # new messages wait behind spilled ones even with room in memory
+    spill_queue.put({'message_id': 5, 'body': 'hi'})
+    spill_queue.put({'message_id': None, 'body': 'no id'})
+    assert len(spill_queue.queue) == 1
+    assert len(spill_queue) == 4
+
+    # after a restart, only spilled messages the DB doesn't have are recovered
+    recovered = SpillQueue(Queue(), 'email', path, 2)
+    assert len(recovered) == 1
+    assert recovered.get() == {'message_id': None, 'body': 'no id'}
+    assert recovered.empty()
+
+    # bounded aggregation leaves the rest in the DB
+    from iris.bin import sender
+    mocker.patch('iris.bin.sender.max_held_messages', 1)
+    mocker.patch('iris.bin.sender.messages', {})
+    mocker.patch('iris.bin.sender.queues', {})
+    mocker.patch('iris.bin.sender.polled_message_ids', {1, 2})
+    sender.hold_message('key', {'message_id': 1})
+    sender.hold_message('key', {'message_id': 2})
+    assert sender.queues == {'key': {1}}
+    assert sender.polled_message_ids == {1}
+    assert metrics.stats['aggregation_deferred_cnt'] == 1
+
+
+def test_spill_queue_in_worker(mocker, tmpdir):
+    from collections import defaultdict
+    from gevent import socket
+    from gevent.queue import Queue
+    from iris.sender.ipc import Channel
+    from iris.sender.queues import SpillQueue
+    from iris.sender.workers import WorkerChannel
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    child_sock, parent_sock = socket.socketpair()
+    spill_queue = SpillQueue(Queue(), 'email', str(tmpdir.join('worker0_send_queue_email.spill')), 1)
+    channel = WorkerChannel(child_sock.detach(), spill_queue.put)
+    parent = Channel(parent_sock)
+    for seq in range(1, 4):
+        parent.send({'seq': seq, 'message': {'message_id': seq, 'body': 'hi'}})
+    reader = gevent.spawn(channel.run)
+    with gevent.Timeout(5):
+        while len(spill_queue) < 3:
+            gevent.sleep(0.01)
+    assert spill_queue.spilled == 2
+
+    # messages read back from the spill file are still acked to the parent
+    for _ in range(3):
+        channel.message_done(spill_queue.get())
+    channel.send_acks()
+    assert next(iter(parent)) == {'done': [[1, False], [2, False], [3, False]]}
+    assert not channel.pending
+    reader.kill()
+    parent.close()
+
+
+def test_spill_queue_lanes(mocker, tmpdir):
+    from collections import defaultdict
+    from iris.sender.queues import LaneQueue, SpillQueue
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    spill_queue = SpillQueue(LaneQueue('email'), 'email', str(tmpdir.join('send_queue_email.spill')), 2)
+    for i in range(3):
+        spill_queue.put({'message_id': i, 'priority': 'low'})
+
+    # urgent messages take the place of low priority ones in memory
+    spill_queue.put({'message_id': 3, 'priority': 'urgent'})
+    spill_queue.put({'message_id': 4, 'priority': 'urgent'})
+    assert len(spill_queue.queue) == 2
+    assert list(spill_queue.spilled_lanes) == [3]
+    # once memory is all urgent, urgent messages spill too, but are read back first
+    spill_queue.put({'message_id': 5, 'priority': 'urgent'})
+    spill_queue.put({'message_id': 6, 'priority': 'low'})
+    assert sorted(spill_queue.spilled_lanes) == [0, 3]
+
+    assert [spill_queue.get()['message_id'] for _ in range(7)] == [3, 4, 5, 0, 1, 2, 6]
+    assert spill_queue.empty()
+    assert not spill_queue.spilled_lanes
+
+
+def test_application_fair_queuing(mocker):
+    from collections import Counter, defaultdict
+    from iris.sender import queues
+    from iris import metrics
+    import pytest
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    mocker.patch('iris.sender.queues.application_backlog', Counter())
+
+    fair = queues.LaneQueue('email', per_application=True, application_weights={'important': 3, 'slow': 0.5})
+    for i in range(30):
+        fair.put({'message_id': i, 'priority': 'high', 'application': 'noisy'})
+    for i in range(30, 40):
+        fair.put({'message_id': i, 'priority': 'high', 'application': 'important'})
+    for i in range(40, 45):
+        fair.put({'message_id': i, 'priority': 'high', 'application': 'slow'})
+    fair.update_metrics()
+    assert metrics.stats['application_noisy_send_backlog'] == 30
+
+    # each round, important sends 3, noisy 1 and slow 1 every other round
+    first = Counter(fair.get()['application'] for _ in range(9))
+    assert first == {'important': 6, 'noisy': 2, 'slow': 1}
+    fair.update_metrics()
+    assert metrics.stats['application_noisy_send_backlog'] == 28
+    assert 'application_noisy_send_wait_max' in metrics.stats
+
+    # everything still comes out, in order per application
+    rest = [fair.get()['message_id'] for _ in range(36)]
+    assert [i for i in rest if i < 30] == list(range(2, 30))
+    assert fair.empty()
+
+    with pytest.raises(ValueError):
+        queues.LaneQueue('email', per_application=True, application_weights={'broken': 0})
+
+
+def test_overload_shedding(mocker):
+    from collections import defaultdict
+    from gevent.queue import Queue
+    from iris.sender.overload import OverloadController, SHED, DEFER
+    from iris.sender import auditlog
+    from iris.bin import sender
+    from iris import metrics
+    import time
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    rechecked = set()
+    send_queues = {'email': Queue(), 'sms': Queue()}
+    controller = OverloadController(send_queues, rechecked.update, enter_depth=4, enter_age=60,
+                                    rules=[{'priority': 'low', 'action': 'shed'},
+                                           {'priority': ['medium', 'high'], 'mode': 'email', 'action': 'defer'}])
+    low = {'message_id': 1, 'priority': 'low', 'mode': 'sms'}
+    medium = {'message_id': 2, 'priority': 'medium', 'mode': 'email'}
+    urgent = {'message_id': 3, 'priority': 'urgent', 'mode': 'email'}
+    assert controller.action(low) is None
+
+    # too old
+    send_queues['email'].put({'queued': time.time() - 100})
+    controller.check()
+    assert controller.overloaded
+    assert metrics.stats['send_queue_oldest_age'] >= 100
+    assert controller.action(low) == SHED
+    assert controller.action(medium) == DEFER
+    assert controller.action(urgent) is None
+    assert controller.action(dict(low, retry_count=1)) is None
+    assert controller.action(dict(medium, message_id=None)) is None
+    assert metrics.stats['overload_shed_cnt'] == 1
+    assert metrics.stats['overload_defer_cnt'] == 1
+
+    # still between the exit and enter depths, so stays overloaded
+    send_queues['email'].get()
+    for _ in range(3):
+        send_queues['sms'].put({'queued': time.time()})
+    controller.defer(2)
+    controller.check()
+    assert controller.overloaded
+    send_queues['sms'].get()
+    controller.check()
+    assert not controller.overloaded
+    assert rechecked == {2}
+    assert metrics.stats['overload_enter_cnt'] == 1
+
+    # the sender drops shed messages and leaves deferred ones active
+    controller.overloaded = True
+    mocker.patch('iris.bin.sender.overload_controller', controller)
+    mocker.patch('iris.bin.sender.message_ids_being_sent', {1, 2})
+    mocker.patch('iris.bin.sender.spawn')
+    drop = mocker.patch('iris.bin.sender.drop_message')
+    assert sender.shed_overload(dict(low))
+    drop.assert_called_once()
+    assert drop.call_args[0][1] == auditlog.OVERLOAD_CHANGE
+    assert sender.shed_overload(dict(medium))
+    assert controller.deferred == {2}
+    assert sender.message_ids_being_sent == set()
+    sender.spawn.assert_called_once()
+    assert not sender.shed_overload(dict(urgent))
+
+
+def test_retry_backoff(mocker):
+    from collections import defaultdict
+    from iris.sender.retry import RetryScheduler
+    from iris import metrics
+    import gevent
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    enqueued = []
+    retries = RetryScheduler(enqueued.append, base_delay=1, max_delay=5, jitter=0, max_age=60,
+                             modes={'call': {'base_delay': 10, 'max_delay': 100}})
+    assert retries.delay({'mode': 'sms', 'retry_count': 1}) == 1
+    assert retries.delay({'mode': 'sms', 'retry_count': 3}) == 4
+    assert retries.delay({'mode': 'sms', 'retry_count': 10}) == 5
+    assert retries.delay({'mode': 'call', 'retry_count': 2}) == 20
+
+    retries.schedule({'message_id': 1, 'mode': 'sms', 'retry_count': 2}, now=100)
+    retries.schedule({'message_id': 2, 'mode': 'sms', 'retry_count': 1}, now=100)
+    assert len(retries) == 2
+    assert metrics.stats['retry_pending'] == 2
+    assert [m['message_id'] for m in retries.pop_due(101)] == [2]
+    assert [m['message_id'] for m in retries.pop_due(102)] == [1]
+    assert not retries.schedule({'message_id': 3, 'mode': 'sms', 'retry_count': 2, 'first_failed': 0}, now=100)
+    assert metrics.stats['retry_expired_cnt'] == 1
+
+    # the scheduler greenlet passes messages on once due
+    retries.defaults['base_delay'] = 0.01
+    task = gevent.spawn(retries.run)
+    gevent.sleep(0)
+    retries.schedule({'message_id': 4, 'mode': 'sms', 'retry_count': 1})
+    gevent.sleep(0.1)
+    task.kill()
+    assert [m['message_id'] for m in enqueued] == [4]
+    assert not retries.heap
+
+    # messages waiting for their retry stay marked as being sent, so polls skip them
+    from iris.bin import sender
+    mocker.patch('iris.bin.sender.db')
+    mocker.patch('iris.bin.sender.quota')
+    mocker.patch('iris.bin.sender.update_message_sent_status')
+    mocker.patch('iris.bin.sender.distributed_send_message').return_value = (False, True)
+    mocker.patch('iris.bin.sender.retry_scheduler', retries)
+    mocker.patch('iris.bin.sender.message_ids_being_sent', {5})
+    message = {'message_id': 5, 'mode': 'email', 'target': 'alice', 'body': 'hi'}
+    assert not sender.send_queued_message(message, None)
+    assert sender.message_ids_being_sent == {5}
+    assert len(retries) == 1
+    # until it's given up on
+    message['first_failed'] = 0
+    assert sender.send_queued_message(message, None)
+    assert sender.message_ids_being_sent == set()
+
+
+def test_sliding_window_counter():
+    from iris.sender.window import SlidingWindowCounter
+
+    window = SlidingWindowCounter(60, 6)
+    assert window.add(now=1000) == 1
+    assert window.add(2, now=1005) == 3
+    assert window.add(now=1015) == 4
+    # the first bucket falls out of the window
+    assert window.total(1065) == 1
+    assert window.buckets(1065) == [[1010.0, 1]]
+    # long idle spells clear it all at once
+    assert window.total(5000) == 0
+
+    window = SlidingWindowCounter(60, 6)
+    window.add(3, now=1000)
+    window.add(4, now=1030)
+    resized = window.resized(20, 2, now=1035)
+    assert resized.total(1035) == 4
+    # restoring keeps the higher count of each bucket
+    resized.restore([[1030, 2], [1020, 5], [900, 7]], now=1035)
+    assert resized.total(1035) == 9
+
+    # add() does as much bucket work over a long window as over a short one, even
+    # while buckets rotate: one write to count, and one per bucket cleared
+    class CountingRing(list):
+        writes = 0
+
+        def __setitem__(self, index, value):
+            self.writes += 1
+            super(CountingRing, self).__setitem__(index, value)
+
+    def ring_writes(buckets):
+        counter = SlidingWindowCounter(buckets, buckets)
+        counter.ring = CountingRing(counter.ring)
+        for tick in range(20000):
+            counter.add(now=tick * 0.5)
+        return counter.ring.writes
+
+    assert ring_writes(100000) == ring_writes(10) < 20000 * 2
+
+
+def test_cache_single_flight(mocker):
+    from collections import defaultdict
+    from iris.sender import cache
+    from iris import metrics
+    import gevent
+    import pytest
+
+    mocker.patch('iris.metrics.stats', defaultdict(int))
+    engine = mocker.MagicMock()
+    cursor = engine.raw_connection().cursor()
+    cursor.execute.side_effect = lambda sql, key: gevent.sleep(0.01)
+    cursor.fetchone.return_value = {'id': 1}
+    incidents = cache.Cache(engine, 'SELECT * FROM `incident` WHERE `id`=%s', None)
+
+    # concurrent misses for the same key share a single query
+    lookups = [gevent.spawn(incidents.__getitem__, 1) for _ in range(10)]
+    gevent.joinall(lookups)
+    assert [lookup.value for lookup in lookups] == [{'id': 1}] * 10
+    assert cursor.execute.call_count == 1
+    assert metrics.stats['cache_coalesced_cnt'] == 9
+    assert incidents[1] == {'id': 1}
+    assert cursor.execute.call_count == 1
+
+    # everyone waiting gets the error, which isn't cached
+    def fail(sql, key):
+        gevent.sleep(0.01)
+        raise RuntimeError('gone away')
+    cursor.execute.side_effect = fail
+    lookups = [gevent.spawn(incidents.__getitem__, 2) for _ in range(3)]
+    gevent.joinall(lookups)
+    assert all(isinstance(lookup.exception, RuntimeError) for lookup in lookups)
+    assert 2 not in incidents.data
+    cursor.execute.side_effect = None
+    assert incidents[2] == {'id': 1}
+
+    # killing the loading greenlet fails its waiters instead of leaving them hanging
+    cursor.execute.side_effect = lambda sql, key: gevent.sleep(10)
+    loader = gevent.spawn(incidents.__getitem__, 3)
+    gevent.sleep(0)
+    waiters = [gevent.spawn(incidents.__getitem__, 3) for _ in range(3)]
+    gevent.sleep(0)
+    loader.kill()
+    gevent.joinall(waiters, timeout=1)
+    assert all(waiter.ready() and isinstance(waiter.exception, Exception) for waiter in waiters)
+    assert 3 not in incidents.single_flight.calls
+    cursor.execute.side_effect = None
+    assert incidents[3] == {'id': 1}
+
+    # role lookups too
+    role_lookup = mocker.Mock()
+    role_lookup.get.side_effect = lambda role, target: gevent.sleep(0.01) or ['alice', 'carol']
+    mocker.patch('iris.sender.cache.spawn')
+    role_targets = cache.RoleTargets([role_lookup], engine, ['alice', 'bob'])
+    lookups = [gevent.spawn(role_targets, 'oncall', 'team') for _ in range(5)]
+    gevent.joinall(lookups)
+    assert [lookup.value for lookup in lookups] == [{'alice'}] * 5
+    assert role_lookup.get.call_count == 1
+    with pytest.raises(KeyError):
+        incidents.single_flight('x', {}.__getitem__, 'x')
+    assert not incidents.single_flight.calls